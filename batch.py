@@ -0,0 +1,312 @@
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from physics import Vector2
+
+
+NUMPY_AVAILABLE = np is not None
+
+
+class PhysicsBatch:
+    # name: number of columns (0 for a scalar column), dtype
+    FIELDS = {
+        'position': (2, float),
+        'rotation': (0, float),
+        'heading': (2, float),
+        'transform_version': (0, int),
+        'previous_position': (2, float),
+        'previous_rotation': (0, float),
+        'mass': (0, float),
+
+        'linear_velocity': (2, float),
+        'angular_velocity': (0, float),
+        'linear_torque': (0, float),
+        'angular_torque': (0, float),
+
+        'linear_acceleration': (0, float),
+        'angular_acceleration': (0, float),
+        'desired_velocity': (2, float),
+        'active': (0, bool),
+    }
+
+    def __init__(self, capacity: int = 64):
+        if not NUMPY_AVAILABLE:
+            raise ImportError('PhysicsBatch requires numpy')
+
+        self.capacity: int = capacity
+        self.size: int = 0
+        self.agents: list = []
+
+        self.arrays: dict = {name: self._allocate(name, capacity) for name in self.FIELDS}
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, agent):
+        return agent.batch is self
+
+    def _allocate(self, name: str, capacity: int):
+        columns, dtype = self.FIELDS[name]
+        if columns:
+            return np.zeros((capacity, columns), dtype=dtype)
+        return np.zeros(capacity, dtype=dtype)
+
+    def _grow(self):
+        self.capacity *= 2
+        for name, array in self.arrays.items():
+            new_array = self._allocate(name, self.capacity)
+            new_array[:self.size] = array[:self.size]
+            self.arrays[name] = new_array
+
+    def get(self, name: str, index: int):
+        if self.FIELDS[name][0]:
+            return Vector2(*self.arrays[name][index].tolist())
+        return self.arrays[name][index].item()
+
+    def set(self, name: str, index: int, value):
+        if self.FIELDS[name][0]:
+            self.arrays[name][index] = value.x, value.y
+        else:
+            self.arrays[name][index] = value
+
+    def add(self, agent):
+        if agent.batch is not None:
+            agent.batch.remove(agent)
+
+        if self.size == self.capacity:
+            self._grow()
+
+        index = self.size
+        for name in self.FIELDS:
+            self.set(name, index, getattr(agent, name))
+            agent.__dict__.pop(name, None)
+
+        agent.batch = self
+        agent.batch_index = index
+
+        self.agents.append(agent)
+        self.size += 1
+
+    def remove(self, agent):
+        if agent.batch is not self:
+            return
+
+        index = agent.batch_index
+        for name in self.FIELDS:
+            agent.__dict__[name] = self.get(name, index)
+
+        agent.batch = None
+        agent.batch_index = -1
+
+        # Moves the last row into the freed one to keep rows contiguous
+        last = self.size - 1
+        if index != last:
+            for array in self.arrays.values():
+                array[index] = array[last]
+
+            moved_agent = self.agents[last]
+            moved_agent.batch_index = index
+            self.agents[index] = moved_agent
+
+        self.agents.pop()
+        self.size -= 1
+
+    def clear(self):
+        for agent in reversed(self.agents):
+            self.remove(agent)
+
+    def get_resting_agents(self) -> list:
+        # Inactive agents that stopped moving and can be put to sleep
+        n = self.size
+        resting = (~self.arrays['active'][:n]
+                   & ~self.arrays['linear_velocity'][:n].any(axis=1)
+                   & (self.arrays['angular_velocity'][:n] == 0))
+        return [self.agents[index] for index in np.flatnonzero(resting)]
+
+    def save_state(self):
+        n = self.size
+        self.arrays['previous_position'][:n] = self.arrays['position'][:n]
+        self.arrays['previous_rotation'][:n] = self.arrays['rotation'][:n]
+
+    def begin_interpolation(self, alpha: float):
+        # Moves every row to the blend of its previous and current transform, returns what to restore
+        n = self.size
+        saved = (self.arrays['position'][:n].copy(), self.arrays['rotation'][:n].copy(),
+                 self.arrays['heading'][:n].copy())
+
+        self.arrays['position'][:n] += (alpha - 1) * (saved[0] - self.arrays['previous_position'][:n])
+        self.arrays['rotation'][:n] += (alpha - 1) * (saved[1] - self.arrays['previous_rotation'][:n])
+        self._update_heading(slice(0, n))
+        self.arrays['transform_version'][:n] += 1
+
+        return saved
+
+    def end_interpolation(self, saved: tuple):
+        n = len(saved[1])
+        self.arrays['position'][:n] = saved[0]
+        self.arrays['rotation'][:n] = saved[1]
+        self.arrays['heading'][:n] = saved[2]
+        self.arrays['transform_version'][:n] += 1
+
+    def _update_heading(self, rows):
+        # Recomputes (cos, sin) only for the given rows (a mask or a slice of the used rows)
+        radians = np.radians(self.arrays['rotation'][:self.size][rows])
+        self.arrays['heading'][:self.size][rows] = np.stack((np.cos(radians), np.sin(radians)), axis=1)
+
+    def step(self, delta: float):
+        # Vectorized PhysicsRectAgent.update + PhysicsDynamicRect.update for every row
+        n = self.size
+        if not n:
+            return
+
+        position = self.arrays['position'][:n]
+        rotation = self.arrays['rotation'][:n]
+
+        linear_velocity = self.arrays['linear_velocity'][:n]
+        angular_velocity = self.arrays['angular_velocity'][:n]
+
+        active = self.arrays['active'][:n]
+        if active.any():
+            desired_velocity = self.arrays['desired_velocity'][:n][active]
+            agent_rotation = rotation[active]
+
+            desired_rotation = np.degrees(np.arctan2(desired_velocity[:, 1], desired_velocity[:, 0])) - 90
+            desired_angular_velocity = simplify_angles(desired_rotation - agent_rotation)
+
+            angular_limit = self.arrays['angular_acceleration'][:n][active] * delta
+            correction_angular_velocity = np.clip(desired_angular_velocity - angular_velocity[active],
+                                                  -angular_limit, angular_limit)
+            angular_velocity[active] += correction_angular_velocity
+
+            # Projection of the desired velocity on the agent's forward axis, (0, 1) rotated by the heading
+            heading = self.arrays['heading'][:n][active]
+            forward = np.stack((-heading[:, 1], heading[:, 0]), axis=1)
+            projection_length = np.einsum('ij,ij->i', desired_velocity, forward)
+            projection = projection_length[:, None] * forward
+
+            correction_vector = projection - linear_velocity[active]
+            correction_length = np.hypot(correction_vector[:, 0], correction_vector[:, 1])
+            linear_limit = self.arrays['linear_acceleration'][:n][active] * delta
+
+            clamped = correction_length > linear_limit
+            correction_vector[clamped] *= (linear_limit[clamped] / correction_length[clamped])[:, None]
+            linear_velocity[active] += correction_vector
+
+        linear_friction = self.arrays['linear_torque'][:n] * delta
+        speed = np.hypot(linear_velocity[:, 0], linear_velocity[:, 1])
+
+        moving = speed > linear_friction
+        linear_velocity[moving] -= (linear_friction[moving] / speed[moving])[:, None] * linear_velocity[moving]
+        linear_velocity[~moving] = 0
+
+        angular_friction = self.arrays['angular_torque'][:n] * delta
+        turning = np.abs(angular_velocity) > angular_friction
+        angular_velocity[turning] -= angular_friction[turning] * np.sign(angular_velocity[turning])
+        angular_velocity[~turning] = 0
+
+        position += delta * linear_velocity
+        rotation += delta * angular_velocity
+        self._update_heading(turning)
+
+        # Invalidates the cached vertices of the agents that moved
+        self.arrays['transform_version'][:n] += moving | turning
+
+
+def simplify_angles(angles):
+    # Vectorized physics.simplify_angle
+    sign = np.sign(angles)
+    angles = sign * np.fmod(np.abs(angles), 360)
+    return np.where(np.abs(angles) > 180, -sign * (360 - np.abs(angles)), angles)
+
+
+class BodyArrays:
+    # Centers, axes, half extents and radii of a set of bodies, for batched narrow phase tests
+    def __init__(self, objects: list):
+        if not NUMPY_AVAILABLE:
+            raise ImportError('BodyArrays requires numpy')
+
+        n = len(objects)
+        self.objects: list = objects
+        self.index: dict = {obj: i for i, obj in enumerate(objects)}
+
+        self.centers = np.zeros((n, 2))
+        self.axes = np.zeros((n, 2, 2))
+        self.half_extents = np.zeros((n, 2))
+        self.radii = np.zeros(n)
+        self.circles = np.zeros(n, dtype=bool)
+
+        for i, obj in enumerate(objects):
+            position = obj.position
+            self.centers[i] = position.x, position.y
+
+            if hasattr(obj, 'radius'):
+                self.radii[i] = obj.radius
+                self.circles[i] = True
+            else:
+                width_axis, height_axis = obj.get_edge_normals()
+                self.axes[i] = (width_axis.x, width_axis.y), (height_axis.x, height_axis.y)
+                self.half_extents[i] = 0.5 * obj.rect.x, 0.5 * obj.rect.y
+
+    def overlap(self, first, second):
+        # Boolean mask of the (first[k], second[k]) index pairs that overlap
+        first = np.asarray(first, dtype=np.intp)
+        second = np.asarray(second, dtype=np.intp)
+        mask = np.zeros(len(first), dtype=bool)
+
+        first_circles = self.circles[first]
+        second_circles = self.circles[second]
+
+        boxes = ~first_circles & ~second_circles
+        if boxes.any():
+            a, b = first[boxes], second[boxes]
+            mask[boxes] = sat_obb_obb(self.centers[a], self.axes[a], self.half_extents[a],
+                                      self.centers[b], self.axes[b], self.half_extents[b])
+
+        box_circle = ~first_circles & second_circles
+        if box_circle.any():
+            a, b = first[box_circle], second[box_circle]
+            mask[box_circle] = sat_obb_circle(self.centers[a], self.axes[a], self.half_extents[a],
+                                              self.centers[b], self.radii[b])
+
+        circle_box = first_circles & ~second_circles
+        if circle_box.any():
+            a, b = first[circle_box], second[circle_box]
+            mask[circle_box] = sat_obb_circle(self.centers[b], self.axes[b], self.half_extents[b],
+                                              self.centers[a], self.radii[a])
+
+        circles = first_circles & second_circles
+        if circles.any():
+            a, b = first[circles], second[circles]
+            difference = self.centers[b] - self.centers[a]
+            mask[circles] = np.einsum('ij,ij->i', difference, difference) <= (self.radii[a] + self.radii[b]) ** 2
+
+        return mask
+
+
+def sat_obb_obb(centers_a, axes_a, half_a, centers_b, axes_b, half_b):
+    # Separating axis test over the 2 + 2 face normals of each box pair.
+    # Boxes that only touch are not overlapping, like with physics.intersect
+    difference = centers_b - centers_a
+    separated = np.zeros(len(difference), dtype=bool)
+
+    for axes in (axes_a, axes_b):
+        for k in range(2):
+            axis = axes[:, k]
+            distance = np.abs(np.einsum('ij,ij->i', difference, axis))
+            radius_a = (np.abs(np.einsum('ij,ij->i', axes_a[:, 0], axis)) * half_a[:, 0]
+                        + np.abs(np.einsum('ij,ij->i', axes_a[:, 1], axis)) * half_a[:, 1])
+            radius_b = (np.abs(np.einsum('ij,ij->i', axes_b[:, 0], axis)) * half_b[:, 0]
+                        + np.abs(np.einsum('ij,ij->i', axes_b[:, 1], axis)) * half_b[:, 1])
+            separated |= distance >= radius_a + radius_b
+
+    return ~separated
+
+
+def sat_obb_circle(centers, axes, half_extents, circle_centers, radii):
+    # Distance from each circle center to the closest point of its box, in the box frame
+    difference = circle_centers - centers
+    local = np.einsum('ijk,ik->ij', axes, difference)
+    outside = local - np.clip(local, -half_extents, half_extents)
+    return np.einsum('ij,ij->i', outside, outside) < radii ** 2
@@ -0,0 +1,760 @@
+import gc
+import random
+import sys
+import time
+import timeit
+
+import physics
+import settings
+from physics import Vector2
+
+from spatial import SpatialHash, ContactCache
+
+
+def _report(name: str, seconds: float, operations: int):
+    print(f'{name:<40} {operations / seconds:>14,.0f} ops/s')
+
+
+def bench_vector(operations: int = 200_000):
+    # Allocating arithmetic against the in-place and fused helpers of Vector2
+    position = Vector2(10, 20)
+    velocity = Vector2(3, 4)
+    other = Vector2(40, -12)
+    delta = 1 / 60
+
+    def allocating_integration():
+        nonlocal position
+        position = position + delta * velocity
+
+    def inplace_integration():
+        position.add_scaled_(velocity, delta)
+
+    def allocating_normalize():
+        return velocity.normalize()
+
+    def inplace_normalize():
+        return velocity.copy().normalize_()
+
+    def distance():
+        return position.dist(other) < 32
+
+    def squared_distance():
+        return position.dist_sq(other) < 32 * 32
+
+    def construct():
+        return Vector2(1.5, 2.5)
+
+    def construct_from_points():
+        return Vector2(position, other)
+
+    pairs = [
+        ('position = position + delta * velocity', allocating_integration),
+        ('position.add_scaled_(velocity, delta)', inplace_integration),
+        ('velocity.normalize()', allocating_normalize),
+        ('velocity.copy().normalize_()', inplace_normalize),
+        ('position.dist(other) < r', distance),
+        ('position.dist_sq(other) < r * r', squared_distance),
+        ('Vector2(x, y)', construct),
+        ('Vector2(point_a, point_b)', construct_from_points),
+    ]
+
+    for name, function in pairs:
+        _report(name, timeit.timeit(function, number=operations), operations)
+
+
+def _random_cars(n: int, area: float):
+    return [physics.PhysicsDynamicRect(None, (random.uniform(0, area), random.uniform(0, area)),
+                                       rotation=random.uniform(0, 360), rect=Vector2(40, 80))
+            for _ in range(n)]
+
+
+def bench_broad_phase(counts: tuple = (1000, 5000, 10000), cars_per_km2: float = 250):
+    # Candidate pairs and narrow tests of the uniform grid against the all-pairs loop
+    random.seed(0)
+    for n in counts:
+        cars = _random_cars(n, 1000 * (n / cars_per_km2) ** 0.5)
+
+        broad_phase = SpatialHash(cell_size=80)
+        for car in cars:
+            broad_phase.insert(car)
+        broad_phase.reset_counters()
+
+        start = time.perf_counter()
+        for car in cars:
+            car.position = car.position + Vector2(random.uniform(-5, 5), random.uniform(-5, 5))
+            broad_phase.update(car)
+
+        for car, car2 in broad_phase.get_candidate_pairs():
+            broad_phase.counters['narrow_tests'] += 1
+            if car.is_colliding_with(car2):
+                broad_phase.counters['collisions'] += 1
+        elapsed = time.perf_counter() - start
+
+        counters = broad_phase.counters
+        print(f'{n:>6} agents: {n * (n - 1):>12,} ordered pairs, {counters["candidate_pairs"]:>8,} candidates, '
+              f'{counters["narrow_tests"]:>8,} tests, {counters["rebucketed"]:>6,} rebucketed, '
+              f'{counters["collisions"]:>5,} collisions, {1000 * elapsed:8.1f} ms/frame')
+
+    n = min(min(counts), 500)
+    cars = _random_cars(n, 1000 * (n / cars_per_km2) ** 0.5)
+    start = time.perf_counter()
+    for car in cars:
+        for car2 in cars:
+            if car != car2:
+                car.is_colliding_with(car2)
+    print(f'{n:>6} agents, all ordered pairs: {1000 * (time.perf_counter() - start):8.1f} ms/frame')
+
+
+def bench_contacts(n: int = 5000, frames: int = 20, cars_per_km2: float = 250):
+    # Pairs recomputed from the grid every frame against the persistent contact cache
+    def colliding(pairs):
+        return [(car, car2) for car, car2 in pairs if car.is_colliding_with(car2)]
+
+    for name in ('rebuilt pairs', 'contact cache'):
+        random.seed(0)
+        cars = _random_cars(n, 1000 * (n / cars_per_km2) ** 0.5)
+        broad_phase = SpatialHash(cell_size=80)
+        contacts = ContactCache(broad_phase, margin=16)
+        for car in cars:
+            if name == 'contact cache':
+                contacts.insert(car)
+            else:
+                broad_phase.insert(car)
+
+        start = time.perf_counter()
+        for _ in range(frames):
+            for car in cars:
+                car.position = car.position + Vector2(random.uniform(-3, 3), random.uniform(-3, 3))
+
+            broad_phase.reset_counters()
+            if name == 'contact cache':
+                for car in cars:
+                    contacts.update(car)
+                contacts.update_contacts(colliding)
+            else:
+                for car in cars:
+                    broad_phase.update(car)
+                pairs = list(broad_phase.get_candidate_pairs())
+                broad_phase.counters['narrow_tests'] += len(pairs)
+                colliding(pairs)
+        elapsed = time.perf_counter() - start
+
+        print(f'{name:<14} {n:>6} agents: {broad_phase.counters["narrow_tests"]:>7,} narrow tests in the last frame, '
+              f'{1000 * elapsed / frames:8.1f} ms/frame')
+
+
+def bench_narrow_phase(counts: tuple = (1000, 10000, 50000)):
+    # Scalar is_colliding_with against one batched separating axis test over the same pairs
+    import batch
+
+    random.seed(0)
+    for n in counts:
+        first = _random_cars(n, 40 * n ** 0.5)
+        # Candidate pairs are close to each other, like the ones coming out of the broad phase
+        second = [physics.PhysicsDynamicRect(None, car.position + Vector2(random.uniform(-60, 60), random.uniform(-60, 60)),
+                                             rotation=random.uniform(0, 360), rect=Vector2(40, 80))
+                  for car in first]
+        cars = first + second
+
+        start = time.perf_counter()
+        scalar = [car.is_colliding_with(car2) or car2.is_colliding_with(car) for car, car2 in zip(first, second)]
+        scalar_elapsed = time.perf_counter() - start
+
+        start = time.perf_counter()
+        bodies = batch.BodyArrays(cars)
+        mask = bodies.overlap(range(n), range(n, 2 * n))
+        batched_elapsed = time.perf_counter() - start
+
+        missed = sum(1 for hit, batched_hit in zip(scalar, mask) if hit and not batched_hit)
+        print(f'{n:>6} pairs: scalar {1000 * scalar_elapsed:8.1f} ms ({sum(scalar):>5} hits), '
+              f'batched {1000 * batched_elapsed:7.1f} ms ({int(mask.sum()):>5} hits, {missed} missed)')
+
+
+def bench_kernels(operations: int = 100_000):
+    # Every kernel backend that can run here, on the same inputs
+    import kernels
+
+    random.seed(0)
+    xs = [float(x) for x in range(0, 2000, 128)]
+    ys = [random.uniform(-0.01, 0.01) for _ in xs]
+    segments = [tuple(random.uniform(-100, 100) for _ in range(8)) for _ in range(1000)]
+
+    backends = ['python'] + (['numba'] if kernels.NUMBA_AVAILABLE else [])
+    for backend in backends:
+        kernels.use_backend(backend)
+        path_xs, path_ys = kernels.as_array(xs), kernels.as_array(ys)
+        # Warm up, so the numba timings do not include the compilation
+        kernels.path_segments(path_xs, path_ys, 0.04)
+        kernels.segments_intersect(*segments[0])
+        kernels.lane_points(0.0, 0.0, 2000.0, 0.0, 40.0, 128.0)
+
+        _report(f'{backend} path_segments', timeit.timeit(
+            lambda: kernels.path_segments(path_xs, path_ys, 0.04), number=operations // 10), operations // 10)
+        _report(f'{backend} segments_intersect', timeit.timeit(
+            lambda: [kernels.segments_intersect(*segment) for segment in segments], number=operations // 1000), operations)
+        _report(f'{backend} lane_points', timeit.timeit(
+            lambda: kernels.lane_points(0.0, 0.0, 2000.0, 0.0, 40.0, 128.0), number=operations), operations)
+
+    kernels.use_backend(settings.kernel_backend)
+
+
+def _grid_roads(side: int, spacing: float = 200, removed: float = 0.1):
+    # side x side joints, two way single lane roads between grid neighbors, some of them removed
+    import city
+
+    joints = [Vector2(x * spacing, y * spacing) for y in range(side) for x in range(side)]
+    graph = city.RoadGraph(joints, [])
+    for y in range(side):
+        for x in range(side):
+            index = y * side + x
+            for neighbor in ((index + 1) if x + 1 < side else None, (index + side) if y + 1 < side else None):
+                if neighbor is not None and random.random() >= removed:
+                    graph.set_lanes(index, neighbor, 1)
+                    graph.set_lanes(neighbor, index, 1)
+    return graph
+
+
+def _linear_scan_shortest_path(graph, start_index: int, end_index: int):
+    # The original RoadGraph.get_shortest_path: linear minimum search over every joint, no early exit
+    unvisited_indexes = list(range(graph.n_joints))
+    path_lengths = [float('inf') for _ in range(graph.n_joints)]
+    previous_joints = [-1 for _ in range(graph.n_joints)]
+
+    path_lengths[start_index] = 0
+
+    while unvisited_indexes:
+        current_min_index = None
+        for index in unvisited_indexes:
+            if current_min_index is None:
+                current_min_index = index
+            elif path_lengths[index] < path_lengths[current_min_index]:
+                current_min_index = index
+
+        for neighbor in graph.get_neighbors_of(current_min_index):
+            tentative_value = path_lengths[current_min_index] + graph.lengths[current_min_index][neighbor]
+            if tentative_value < path_lengths[neighbor]:
+                path_lengths[neighbor] = tentative_value
+                previous_joints[neighbor] = current_min_index
+
+        unvisited_indexes.pop(unvisited_indexes.index(current_min_index))
+
+    return path_lengths[end_index]
+
+
+def bench_shortest_path(sides: tuple = (20, 50, 100, 200), queries: int = 20, linear_scan_limit: int = 2500):
+    # Linear scan Dijkstra (up to linear_scan_limit joints), heap Dijkstra and A* on the same random queries
+    def path_length(graph, path):
+        return sum(graph.lengths[path[k + 1]][path[k]] for k in range(len(path) - 1))
+
+    random.seed(0)
+    for side in sides:
+        graph = _grid_roads(side)
+        pairs = [(random.randrange(graph.n_joints), random.randrange(graph.n_joints)) for _ in range(queries)]
+
+        timings = []
+        if graph.n_joints <= linear_scan_limit:
+            start = time.perf_counter()
+            expected = [_linear_scan_shortest_path(graph, *pair) for pair in pairs]
+            timings.append(f'linear scan {1000 * (time.perf_counter() - start) / queries:9.2f} ms')
+        else:
+            expected = None
+
+        lengths = {}
+        for name, heuristic in (('dijkstra', False), ('a*', True)):
+            start = time.perf_counter()
+            paths = [graph.get_shortest_path(*pair, heuristic=heuristic) for pair in pairs]
+            timings.append(f'{name} {1000 * (time.perf_counter() - start) / queries:8.2f} ms')
+            lengths[name] = [float('inf') if path is None else path_length(graph, path) for path in paths]
+
+        # Every search has to find paths of the same length
+        agree = all(abs(a - b) < 1e-6 or a == b for a, b in zip(lengths['dijkstra'], lengths['a*']))
+        if expected is not None:
+            agree = agree and all(abs(a - b) < 1e-6 or a == b for a, b in zip(expected, lengths['dijkstra']))
+
+        print(f'{graph.n_joints:>6} joints: ' + ', '.join(timings) + f' per query, same lengths: {agree}')
+
+
+def bench_routing(sides: tuple = (10, 20, 40), queries: int = 1000):
+    # Building the next hop table, then reading routes from it against A* searches
+    random.seed(0)
+    for side in sides:
+        graph = _grid_roads(side)
+        pairs = [(random.randrange(graph.n_joints), random.randrange(graph.n_joints)) for _ in range(queries)]
+
+        start = time.perf_counter()
+        table = graph.enable_routing(background=False)
+        build_elapsed = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for pair in pairs:
+            graph.get_shortest_path(*pair)
+        search_elapsed = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for pair in pairs:
+            table.get_path(*pair)
+        table_elapsed = time.perf_counter() - start
+
+        # Moving a corner joint away only repairs the trees that used its roads
+        table.counters['rebuilt'] = 0
+        table.counters['repaired'] = 0
+        start = time.perf_counter()
+        graph.set_joint_position(0, graph.joints[0] + Vector2(-50, -50))
+        edit_elapsed = time.perf_counter() - start
+
+        print(f'{graph.n_joints:>5} joints: table built in {1000 * build_elapsed:8.1f} ms, '
+              f'a* {1e6 * search_elapsed / queries:8.1f} us/route, table {1e6 * table_elapsed / queries:6.1f} us/route, '
+              f'joint moved in {1000 * edit_elapsed:6.1f} ms ({table.counters["repaired"]} trees repaired, '
+              f'{table.counters["rebuilt"]} rebuilt)')
+
+
+def _deep_size(obj, seen: set = None) -> int:
+    # Bytes of obj and of the lists, tuples, dicts and numbers it holds, each object counted once
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(_deep_size(key, seen) + _deep_size(value, seen) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(_deep_size(item, seen) for item in obj)
+    return size
+
+
+def _path_length(graph, path: list[int] | None) -> float | None:
+    # Rounded, equally short routes may take different joints
+    if path is None:
+        return None
+    return round(sum(graph.lengths[path[k + 1]][path[k]] for k in range(len(path) - 1)), 6)
+
+
+def bench_contraction_hierarchy(sides: tuple = (30, 100), queries: int = 200):
+    # Preprocessing time and memory of the hierarchy, then its queries against A* on the same pairs
+    from routing import ContractionHierarchy
+
+    random.seed(0)
+    for side in sides:
+        graph = _grid_roads(side)
+        pairs = [(random.randrange(graph.n_joints), random.randrange(graph.n_joints)) for _ in range(queries)]
+
+        start = time.perf_counter()
+        hierarchy = ContractionHierarchy(graph.lengths, graph.version)
+        build_elapsed = time.perf_counter() - start
+        memory = _deep_size((hierarchy.rank, hierarchy.up_out, hierarchy.up_in, hierarchy.middle))
+
+        start = time.perf_counter()
+        expected = [graph.get_shortest_path(*pair) for pair in pairs]
+        search_elapsed = time.perf_counter() - start
+
+        start = time.perf_counter()
+        paths = [hierarchy.get_path(*pair) for pair in pairs]
+        query_elapsed = time.perf_counter() - start
+
+        agree = all(_path_length(graph, path) == _path_length(graph, other) for path, other in zip(paths, expected))
+        print(f'{graph.n_joints:>6} joints: built in {build_elapsed:6.2f} s, {memory / 2 ** 20:6.1f} MiB, '
+              f'{hierarchy.counters["shortcuts"]:>6} shortcuts, a* {1000 * search_elapsed / queries:7.2f} ms, '
+              f'hierarchy {1000 * query_elapsed / queries:5.2f} ms per query, same lengths: {agree}')
+
+
+class _PathAgent:
+    # Just what CityPathfinding needs to route a car
+    def __init__(self, position: Vector2):
+        self.position: Vector2 = position
+        self.path: list = []
+        self.route_dropped = None
+
+    def set_path(self, path: list):
+        self.path = path
+
+    def set_route(self, path: list, target: int, roads: list, lanes: list, road_ends: list):
+        self.path = path
+
+
+def bench_route_cache(side: int = 10, cars: int = 5000, hubs: int = 8):
+    # Cars starting from a few hub joints toward random targets, with and without the route cache
+    import city
+
+    default_bytes = settings.route_cache_bytes
+    for max_bytes in (0, default_bytes, 16 * 1024):
+        random.seed(0)
+        graph = _grid_roads(side)
+
+        settings.route_cache_bytes = max_bytes
+        pathfinding = city.CityPathfinding([], [], graph, graph)
+        settings.route_cache_bytes = default_bytes
+        hub_joints = random.sample(range(graph.n_joints), hubs)
+        agents = [_PathAgent(graph.joints[random.choice(hub_joints)]) for _ in range(cars)]
+
+        start = time.perf_counter()
+        for agent in agents:
+            pathfinding._set_agent_random_path(agent, graph)
+        elapsed = time.perf_counter() - start
+
+        counters = graph.route_cache.counters if graph.route_cache else {}
+        print(f'cache {max_bytes:>9,} bytes: {1e6 * elapsed / cars:8.1f} us/route {counters}')
+
+
+def _distance_matrix(graph):
+    # The original RoadGraph.recalculate_distance_matrix: every joint to joint distance
+    return [[joint1.dist(joint2.x, joint2.y) for joint2 in graph.joints] for joint1 in graph.joints]
+
+
+def bench_joint_move(sides: tuple = (10, 16, 44, 100), frames: int = 60):
+    # Dragging one joint for a second at 60 frames per second, with the listeners a default CityPathfinding
+    # registers on its roads. First the original n^2 distance matrix and every edge per frame, then the moves
+    # themselves: with the next hop table repairing during the drag, and paused until the release as the
+    # editor does it. The table works in a background thread, which slows the moves down meanwhile
+    import os
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    import city
+
+    random.seed(0)
+    for side in sides:
+        graph = _grid_roads(side)
+        city.CityPathfinding([], [], graph, graph)
+        table = graph.routing
+        if table is not None:
+            table.wait()
+        index = graph.n_joints // 2 + side // 2
+
+        listeners = ', '.join(type(listener).__name__ for listener in graph.listeners)
+        print(f'{graph.n_joints:>6} joints, listeners: {listeners}')
+
+        timings = []
+        if side <= 30:
+            start = time.perf_counter()
+            for _ in range(frames):
+                _distance_matrix(graph)
+            timings.append(f'distance matrix {1000 * (time.perf_counter() - start) / frames:8.3f} ms')
+
+        start = time.perf_counter()
+        for _ in range(frames):
+            graph.recalculate_edge_lengths()
+        timings.append(f'all edges {1000 * (time.perf_counter() - start) / frames:7.3f} ms')
+        print('    ' + ', '.join(timings) + ' per frame')
+
+        for paused in ((False, True) if table is not None else (False,)):
+            if paused:
+                graph.pause_routing()
+
+            moves = []
+            for frame in range(frames):
+                frame_start = time.perf_counter()
+                graph.set_joint_position(index, graph.joints[index] + Vector2(1, frame % 3 - 1))
+                moves.append(1000 * (time.perf_counter() - frame_start))
+                time.sleep(max(0.0, 1 / 60 - (time.perf_counter() - frame_start)))
+
+            start = time.perf_counter()
+            graph.resume_routing()
+            if table is not None:
+                table.wait()
+            caught_up = time.perf_counter() - start
+
+            moves.sort()
+            mode = 'routing paused' if paused else 'routing live' if table is not None else 'no next hop table'
+            print(f'    {mode:<17}: move median {moves[len(moves) // 2]:6.3f} ms, max {moves[-1]:6.3f} ms, '
+                  f'table caught up {1000 * caught_up:7.1f} ms after the release')
+
+
+def _linear_scan_closest_joint(graph, position):
+    # The original RoadGraph.get_closest_joint_to
+    min_distance = float('inf')
+    closest_joint = None
+
+    for index, joint in enumerate(graph.joints):
+        if joint.dist(position.x, position.y) < min_distance:
+            min_distance = joint.dist(position.x, position.y)
+            closest_joint = index
+
+    return closest_joint
+
+
+def bench_closest_joint(sides: tuple = (10, 30, 100), queries: int = 2000):
+    # Closest joint to random positions (what every new car route starts with): linear scan against the grid
+    random.seed(0)
+    for side in sides:
+        graph = _grid_roads(side)
+        extent = 200 * side
+        positions = [Vector2(random.uniform(0, extent), random.uniform(0, extent)) for _ in range(queries)]
+
+        start = time.perf_counter()
+        expected = [_linear_scan_closest_joint(graph, position) for position in positions]
+        scan_elapsed = time.perf_counter() - start
+
+        start = time.perf_counter()
+        found = [graph.get_closest_joint_to(position) for position in positions]
+        grid_elapsed = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for position in positions:
+            graph.get_joint_at(position)
+        pick_elapsed = time.perf_counter() - start
+
+        print(f'{graph.n_joints:>6} joints: linear scan {1e6 * scan_elapsed / queries:8.1f} us, '
+              f'grid {1e6 * grid_elapsed / queries:5.1f} us, picking {1e6 * pick_elapsed / queries:5.1f} us '
+              f'per query, same joints: {expected == found}')
+
+
+def bench_batch_routes(sides: tuple = (30, 50), workers: tuple = (2, 4, None)):
+    # A route from every joint to a random target, like the first frame after spawning: in process, then in
+    # the worker pool (the first batch includes starting the pool)
+    from routing import BatchRoutePlanner
+
+    random.seed(0)
+    for side in sides:
+        graph = _grid_roads(side)
+        requests = [(index, random.randrange(graph.n_joints)) for index in range(graph.n_joints)]
+
+        start = time.perf_counter()
+        expected = [graph.get_route(*request) for request in requests]
+        print(f'{graph.n_joints:>6} joints, {len(requests)} routes: in process {time.perf_counter() - start:6.2f} s')
+
+        for n_workers in workers:
+            planner = BatchRoutePlanner(graph, n_workers)
+            timings = []
+            for _ in range(2):
+                start = time.perf_counter()
+                routes = planner.plan(requests)
+                timings.append(f'{time.perf_counter() - start:6.2f} s')
+            planner.close()
+
+            print(f'    {planner.workers:>2} workers: first batch {timings[0]}, next batch {timings[1]}, '
+                  f'same routes: {routes == expected}')
+
+        # The same with a contraction hierarchy, which the workers query as well
+        graph.build_contraction_hierarchy()
+        start = time.perf_counter()
+        hierarchy_routes = [graph.get_route(*request) for request in requests]
+        print(f'    with a contraction hierarchy, in process {time.perf_counter() - start:6.2f} s')
+
+        for n_workers in workers:
+            planner = BatchRoutePlanner(graph, n_workers)
+            start = time.perf_counter()
+            routes = planner.plan(requests)
+            elapsed = time.perf_counter() - start
+            planner.close()
+
+            same_lengths = all(_path_length(graph, route) == _path_length(graph, other)
+                               for route, other in zip(routes, expected))
+            print(f'    {planner.workers:>2} workers: first batch {elapsed:6.2f} s, '
+                  f'same routes: {routes == hierarchy_routes}, same lengths as A*: {same_lengths}')
+
+
+def bench_road_geometry(side: int = 20, frames: int = 20, routes: int = 2000):
+    # Rendering the roads and building route waypoints with the geometry rebuilt every time against cached
+    import os
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    import graphics
+    import city
+
+    random.seed(0)
+    graph = _grid_roads(side)
+    for i, j, _ in list(graph.get_edges()):
+        graph.set_lanes(i, j, random.randint(1, 3))
+
+    window = graphics.Window([600, 600])
+    camera = type('Camera', (), {'schematic': False, 'get_relative_position': lambda self, position: position})()
+
+    pathfinding = city.CityPathfinding([], [], graph, graph)
+    requests = []
+    for _ in range(routes):
+        index_path = graph.get_route(random.randrange(graph.n_joints), random.randrange(graph.n_joints))
+        if index_path:
+            requests.append((index_path, tuple(random.randint(0, graph.get_lanes(index_path[k], index_path[k + 1]) - 1)
+                                               for k in range(len(index_path) - 1))))
+
+    for cached in (False, True):
+        graph.geometry.clear()
+        start = time.perf_counter()
+        for _ in range(frames):
+            if not cached:
+                graph.geometry.clear()
+            graph.render_to(window, camera)
+        render_elapsed = time.perf_counter() - start
+
+        graph.geometry.clear()
+        start = time.perf_counter()
+        for index_path, lanes in requests:
+            if not cached:
+                graph.geometry.clear()
+            pathfinding._get_lane_waypoints(graph, index_path, lanes)
+        route_elapsed = time.perf_counter() - start
+
+        print(f'{"cached" if cached else "rebuilt"}: {1000 * render_elapsed / frames:6.1f} ms per frame '
+              f'({graph.n_joints} joints), {1e6 * route_elapsed / len(requests):6.1f} us per route waypoints')
+
+
+def bench_reroute(side: int = 20, cars: int = 2000, edits: int = 20):
+    # Removing a road under a city of routed cars: routing only the cars that drove along it again,
+    # against routing every car again
+    import os
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    import city
+    from maps import Blueprints
+
+    random.seed(0)
+    graph = _grid_roads(side, removed=0)
+    pathfinding = city.CityPathfinding([], [], graph, graph)
+    agents = [Blueprints.car_ct.get_car(position=random.choice(graph.joints)) for _ in range(cars)]
+    for agent in agents:
+        pathfinding._set_agent_random_path(agent, graph)
+    pathfinding.agents += agents
+
+    edges = random.sample([(i, j) for i, j, _ in graph.get_edges() if i < j], edits)
+
+    start = time.perf_counter()
+    affected = 0
+    for i, j in edges:
+        graph.set_lanes(i, j, 0)
+        graph.set_lanes(j, i, 0)
+        affected += len(pathfinding.replanning)
+        pathfinding._replan_agents()
+    targeted_elapsed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(edits):
+        for agent in agents:
+            pathfinding._set_agent_path(agent, graph, agent.path_target if agent.path_target != -1 else 0)
+    all_elapsed = time.perf_counter() - start
+
+    print(f'{cars} cars, {graph.n_joints} joints: {1000 * targeted_elapsed / edits:7.2f} ms per edit '
+          f'({affected / edits:.0f} cars routed again), every car routed again {1000 * all_elapsed / edits:7.2f} ms')
+
+
+def _pop_and_lookahead(path: list, position, min_difference: float, min_distance: float):
+    # The original Car.follow_path: waypoints popped from the front, the lookahead normalizing both vectors
+    # for every candidate waypoint
+    if path and position.dist(path[0].x, path[0].y) <= min_distance:
+        path.pop(0)
+    if not path:
+        return Vector2(0, 0)
+
+    desired_velocity = path[0] - position
+    for vertex in path[1:]:
+        next_desired_velocity = vertex - position
+        if abs(desired_velocity.normalize() - next_desired_velocity.normalize()) < min_difference:
+            desired_velocity = desired_velocity + next_desired_velocity
+        else:
+            break
+    return desired_velocity
+
+
+def bench_follow_path(lengths: tuple = (2000, 20000, 200000), frames: int = 2000):
+    # A car driving along a straight road of the given length: set_path once, then follow_path every frame
+    import os
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    import city
+    from maps import Blueprints
+
+    spacing = settings.path_intermediate_points_distance
+    for length in lengths:
+        path = [Vector2(x, 0.0) for x in range(0, length, spacing)]
+        car = Blueprints.car_ct.get_car(position=Vector2(-10, 0))
+        # Compiles the kernel first with the numba backend
+        car.set_path(path[:2])
+
+        start = time.perf_counter()
+        car.set_path(list(path))
+        set_elapsed = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for _ in range(frames):
+            car.follow_path()
+        follow_elapsed = time.perf_counter() - start
+
+        original_path = list(path)
+        start = time.perf_counter()
+        for _ in range(frames):
+            _pop_and_lookahead(original_path, car.position, settings.min_next_desired_difference, settings.path_min_distance)
+        original_elapsed = time.perf_counter() - start
+
+        print(f'{len(path):>5} waypoints: set_path {1000 * set_elapsed:7.2f} ms, follow_path '
+              f'{1e6 * follow_elapsed / frames:6.2f} us per frame, original {1e6 * original_elapsed / frames:9.2f} us')
+
+
+def bench_car_following(side: int = 30, counts: tuple = (500, 2000, 8000), steps: int = 20):
+    # One car following step (lane occupancy sort and the IDM) for many routed cars
+    import os
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    import city
+    from maps import Blueprints
+    from traffic import CarFollowing
+
+    random.seed(0)
+    graph = _grid_roads(side, removed=0)
+    pathfinding = city.CityPathfinding([], [], graph, graph)
+    for count in counts:
+        cars = [Blueprints.car_ct.get_car(position=random.choice(graph.joints)) for _ in range(count)]
+        for car in cars:
+            pathfinding._set_agent_random_path(car, graph)
+
+        following = CarFollowing(settings.following_time_headway, settings.following_min_gap,
+                                 settings.following_deceleration)
+        start = time.perf_counter()
+        for _ in range(steps):
+            following.update(cars, 1 / 60)
+        elapsed = time.perf_counter() - start
+
+        led = sum(following.occupancy.leaders != -1)
+        print(f'{count:>5} cars: {1000 * elapsed / steps:6.2f} ms per step, {led} following a leader')
+
+
+def bench_car_pool(side: int = 40, cycles: int = 20):
+    # Spawning a car at every joint and despawning them all again, with fresh cars and with the car pool
+    import os
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    import city
+    from maps import Blueprints
+
+    blueprints = [Blueprints.car_ct, Blueprints.car_ft, Blueprints.car_p, Blueprints.car_c1, Blueprints.car_c2]
+    graph = _grid_roads(side, removed=0)
+    for pool_size in (0, settings.car_pool_size):
+        random.seed(0)
+        pathfinding = city.CityPathfinding([], [], graph, graph, blueprints)
+        pathfinding.car_pool = city.CarPool(pool_size) if pool_size else None
+
+        collections = sum(stats['collections'] for stats in gc.get_stats())
+        start = time.perf_counter()
+        for _ in range(cycles):
+            cars = pathfinding.spawn_agents(density=1)
+            for car in cars[::2]:
+                car.crash()
+            pathfinding.clear_agents()
+        elapsed = time.perf_counter() - start
+        collections = sum(stats['collections'] for stats in gc.get_stats()) - collections
+
+        pool = pathfinding.car_pool
+        counters = f'hit rate {pool.get_hit_rate():.2f} {pool.counters}' if pool is not None else ''
+        print(f'pool {pool_size:>5}: {1000 * elapsed / cycles:7.2f} ms per {len(cars)} cars, '
+              f'{collections:>3} gc collections {counters}')
+
+
+BENCHMARKS = {
+    'vector': bench_vector,
+    'broad_phase': bench_broad_phase,
+    'contacts': bench_contacts,
+    'narrow_phase': bench_narrow_phase,
+    'kernels': bench_kernels,
+    'shortest_path': bench_shortest_path,
+    'routing': bench_routing,
+    'route_cache': bench_route_cache,
+    'contraction_hierarchy': bench_contraction_hierarchy,
+    'joint_move': bench_joint_move,
+    'closest_joint': bench_closest_joint,
+    'batch_routes': bench_batch_routes,
+    'road_geometry': bench_road_geometry,
+    'reroute': bench_reroute,
+    'follow_path': bench_follow_path,
+    'car_following': bench_car_following,
+    'car_pool': bench_car_pool,
+}
+
+
+if __name__ == '__main__':
+    selected = sys.argv[1:] or list(BENCHMARKS)
+    for key in selected:
+        print(f'--- {key} ---')
+        BENCHMARKS[key]()
@@ -1,4 +1,8 @@
+import math
 import random
+from concurrent.futures import Future, ProcessPoolExecutor
+from contextlib import contextmanager
+from itertools import accumulate
 
 import graphics
 from graphics import Sprite
@@ -6,6 +10,18 @@ from graphics import Sprite
 import physics
 from physics import Point2, Vector2, Object
 
+import kernels
+
+import batch
+from batch import PhysicsBatch, BodyArrays
+
+import traffic
+from traffic import CarFollowing
+
+from spatial import SpatialHash, ContactCache, PointGrid, BoundingVolumeHierarchy, aabb_union
+
+from routing import NextHopTable, RouteCache, ContractionHierarchy, BatchRoutePlanner, search_path
+
 import settings
 from settings import Color
 
@@ -68,6 +84,101 @@ class Building(physics.PhysicsStaticRect):
             window.render(roof_image, edge_position)
 
 
+class _RoadMatrixRow:
+    # Row i of RoadMatrixView, reads and writes the lanes of the edges leaving joint i
+    __slots__ = ('graph', 'index')
+
+    def __init__(self, graph, index: int):
+        self.graph = graph
+        self.index: int = index
+
+    def __getitem__(self, j: int) -> int:
+        if j < 0:
+            j += self.graph.n_joints
+        if not 0 <= j < self.graph.n_joints:
+            raise IndexError('road matrix index out of range')
+        return self.graph.adjacency[self.index].get(j, 0)
+
+    def __setitem__(self, j: int, lanes: int):
+        if j < 0:
+            j += self.graph.n_joints
+        self.graph.set_lanes(self.index, j, lanes)
+
+    def __len__(self):
+        return self.graph.n_joints
+
+    def __iter__(self):
+        lanes = self.graph.adjacency[self.index]
+        return (lanes.get(j, 0) for j in range(self.graph.n_joints))
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class RoadMatrixView:
+    # Dense n x n lanes matrix on top of the sparse adjacency of a RoadGraph, for matrix[i][j] reads and writes.
+    # Iterating a row costs O(n), use RoadGraph.adjacency where performance matters
+    __slots__ = ('graph',)
+
+    def __init__(self, graph):
+        self.graph = graph
+
+    def __getitem__(self, i: int) -> _RoadMatrixRow:
+        if i < 0:
+            i += self.graph.n_joints
+        if not 0 <= i < self.graph.n_joints:
+            raise IndexError('road matrix index out of range')
+        return _RoadMatrixRow(self.graph, i)
+
+    def __len__(self):
+        return self.graph.n_joints
+
+    def __iter__(self):
+        return (_RoadMatrixRow(self.graph, i) for i in range(self.graph.n_joints))
+
+    def __repr__(self):
+        return repr([list(row) for row in self])
+
+
+class RoadGeometryCache:
+    # World space geometry of a RoadGraph built on first use: the waypoints of every lane of an edge,
+    # and the polygons a road (both directions) is rendered with. A listener of the graph, which drops
+    # the geometry of the edges that changed
+    def __init__(self):
+        # (i, j) -> {lane: waypoints from i to j}
+        self.lanes: dict[tuple[int, int], dict[int, list[Vector2]]] = {}
+        # (lower joint, higher joint) -> [(corners, color)]
+        self.roads: dict[tuple[int, int], list[tuple]] = {}
+
+        self.counters: dict[str, int] = {
+            'lane_hits': 0,
+            'lane_misses': 0,
+            'road_hits': 0,
+            'road_misses': 0,
+            'invalidated': 0,
+        }
+
+    def joint_added(self, index: int):
+        pass
+
+    def edges_changed(self, changes: list[tuple]):
+        for i, j, _, _ in changes:
+            if self.lanes.pop((i, j), None) is not None:
+                self.counters['invalidated'] += 1
+            self.roads.pop((min(i, j), max(i, j)), None)
+
+    def rebuild(self):
+        self.counters['invalidated'] += len(self.lanes)
+        self.clear()
+
+    def clear(self):
+        self.lanes.clear()
+        self.roads.clear()
+
+
 class RoadGraph:
     def __init__(self, joints: list[Vector2], matrix: list[list], color_variant: int = 0):
         self.joints: list[Vector2] = joints
@@ -76,10 +187,33 @@ class RoadGraph:
         self.selected_road: list[int, int] = [-1, -1]
         self.n_joints = len(joints)
 
-        self.matrix: list[list] = matrix
-
-        self.distance_matrix: list[list] = [[0 for _ in range(self.n_joints)] for _ in range(self.n_joints)]
-        self.recalculate_distance_matrix()
+        # Bumped on every change of the joints or roads
+        self.version: int = 0
+
+        # Objects told about every change of the graph, see add_listener
+        self.listeners: list = []
+        # Optional all pairs next hop table, one of the listeners
+        self.routing: NextHopTable | None = None
+        # Optional cache of routes and their waypoints, one of the listeners
+        self.route_cache: RouteCache | None = None
+        # Optional contraction hierarchy, only used while the graph is at the version it was built for
+        self.hierarchy: ContractionHierarchy | None = None
+        # The graph version of the hierarchy being built in the background, if any
+        self.hierarchy_build_version: int | None = None
+
+        # adjacency[i][j] is the number of lanes from joint i to joint j, lengths[i][j] the length of that edge
+        # and incoming[j] the joints with an edge to j. Only existing edges are stored
+        self.adjacency: list[dict[int, int]] = []
+        self.lengths: list[dict[int, float]] = []
+        self.incoming: list[set[int]] = []
+        # Upper bound of the lanes of any edge, it only grows until the adjacency is rebuilt
+        self.max_lanes: int = 0
+        self.matrix = matrix
+
+        # Grid index over the joint positions, for closest joint and picking queries
+        self.joint_grid = PointGrid(settings.joint_grid_cell_size)
+        for index, joint in enumerate(self.joints):
+            self.joint_grid.insert(index, joint.x, joint.y)
 
         self.s_joint_color: tuple
         self.s_road_color: tuple
@@ -102,100 +236,311 @@ class RoadGraph:
             case _:
                 raise 'invalid color variant for RoadGraph: ' + str(color_variant)
 
-    def recalculate_distance_matrix(self):
-        self.distance_matrix = [[0 for _ in range(self.n_joints)] for _ in range(self.n_joints)]
+        # Lane waypoints and road polygons, rebuilt per edge when it changes
+        self.geometry = RoadGeometryCache()
+        self.add_listener(self.geometry)
+
+    @property
+    def matrix(self) -> RoadMatrixView:
+        return RoadMatrixView(self)
+
+    @matrix.setter
+    def matrix(self, matrix: list[list]):
+        # Rebuilds the adjacency from a dense lanes matrix, like the ones maps are stored with
+        self.adjacency = [{} for _ in range(self.n_joints)]
+        self.lengths = [{} for _ in range(self.n_joints)]
+        self.incoming = [set() for _ in range(self.n_joints)]
+        self.max_lanes = 0
+
+        for i, row in enumerate(matrix):
+            for j, lanes in enumerate(row):
+                if lanes:
+                    self._set_lanes(i, j, lanes)
+
+        self._notify('rebuild')
+
+    # ___ Change notifications ___________________
+    # Listeners implement joint_added(index), called before the roads of the new joint are reported,
+    # edges_changed(changes) with the (i, j, old length, new length) of every edge i -> j whose length,
+    # geometry or lanes changed (None for a missing edge), and rebuild() after the whole adjacency was replaced.
+    # They are called once the graph is up to date
+
+    def add_listener(self, listener):
+        if listener not in self.listeners:
+            self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    def _notify(self, event: str, *arguments):
+        for listener in self.listeners:
+            getattr(listener, event)(*arguments)
+
+    def enable_routing(self, background: bool = True) -> NextHopTable:
+        if self.routing is None:
+            self.routing = NextHopTable(self, background)
+            self.add_listener(self.routing)
+        return self.routing
+
+    def build_contraction_hierarchy(self, background: bool = False) -> ContractionHierarchy | None:
+        # Has to be called again after the graph changed, routes are searched meanwhile. In the background it is
+        # built in a worker process from a copy of the roads and set once done, None is returned until then
+        if self.hierarchy is not None and self.hierarchy.version == self.version:
+            return self.hierarchy
+
+        lengths = [dict(lengths) for lengths in self.lengths]
+        if not background:
+            self.hierarchy = ContractionHierarchy(lengths, self.version)
+            return self.hierarchy
+
+        if self.hierarchy_build_version != self.version:
+            self.hierarchy_build_version = self.version
+            executor = ProcessPoolExecutor(1)
+            executor.submit(ContractionHierarchy, lengths, self.version).add_done_callback(self._set_hierarchy)
+            executor.shutdown(wait=False)
+        return None
+
+    def _set_hierarchy(self, future: Future):
+        # Called from a thread of the executor. A build of an older version finishing late is dropped
+        hierarchy = future.result()
+        if self.hierarchy is None or hierarchy.version > self.hierarchy.version:
+            self.hierarchy = hierarchy
+
+    def enable_route_cache(self, max_bytes: int) -> RouteCache:
+        if self.route_cache is None:
+            self.route_cache = RouteCache(max_bytes)
+            self.add_listener(self.route_cache)
+        return self.route_cache
+
+    def pause_routing(self):
+        # A dragged joint changes its roads every frame, the next hop table repairs them once after resume_routing
+        if self.routing is not None:
+            self.routing.pause()
+
+    def resume_routing(self):
+        if self.routing is not None:
+            self.routing.resume()
+
+    def get_lanes(self, i: int, j: int) -> int:
+        return self.adjacency[i].get(j, 0)
+
+    def set_lanes(self, i: int, j: int, lanes: int):
+        change = self._set_lanes(i, j, lanes)
+        if change is not None:
+            self._notify('edges_changed', [change])
+
+    def _set_lanes(self, i: int, j: int, lanes: int) -> tuple | None:
+        # Returns (i, j, old length, new length), None for a missing edge, or None if the lanes stayed the same
+        self.version += 1
+        old_lanes = self.adjacency[i].get(j, 0)
+        old_length = self.lengths[i].get(j)
+        if lanes:
+            self.adjacency[i][j] = lanes
+            self.lengths[i][j] = self.joints[i].dist(self.joints[j].x, self.joints[j].y)
+            self.incoming[j].add(i)
+            self.max_lanes = max(self.max_lanes, lanes)
+        else:
+            self.adjacency[i].pop(j, None)
+            self.lengths[i].pop(j, None)
+            self.incoming[j].discard(i)
+
+        if lanes == old_lanes:
+            return None
+        return i, j, old_length, self.lengths[i].get(j)
+
+    def get_edges(self):
+        # (i, j, lanes) for every directed edge
+        for i, lanes in enumerate(self.adjacency):
+            for j, n_lanes in lanes.items():
+                yield i, j, n_lanes
+
+    def get_incident_edges(self, index: int):
+        # (i, j) for every edge from or to the joint
+        for j in self.adjacency[index]:
+            yield index, j
+        for i in self.incoming[index]:
+            if i != index:
+                yield i, index
+
+    def recalculate_edge_lengths(self) -> list[tuple]:
+        # Recomputes every edge, returns the (i, j, old length, new length) of the ones that changed.
+        # A moved joint only needs its incident edges, see set_joint_position
+        changes = []
+        for i, lengths in enumerate(self.lengths):
+            joint = self.joints[i]
+            for j, old_length in lengths.items():
+                lengths[j] = joint.dist(self.joints[j].x, self.joints[j].y)
+                if lengths[j] != old_length:
+                    changes.append((i, j, old_length, lengths[j]))
+
+        return changes
+
+    def get_lane_points(self, i: int, j: int, lane: int) -> list[Vector2]:
+        # Waypoints along a lane of the road i -> j, from i to j. Lane 0 is the one next to the road axis.
+        # Cached, the list and its points are shared and must not be changed
+        edge_lanes = self.geometry.lanes.get((i, j))
+        if edge_lanes is None:
+            edge_lanes = self.geometry.lanes[(i, j)] = {}
+
+        points = edge_lanes.get(lane)
+        if points is not None:
+            self.geometry.counters['lane_hits'] += 1
+            return points
+
+        start = self.joints[i]
+        end = self.joints[j]
+        xs, ys = kernels.lane_points(start.x, start.y, end.x, end.y, (0.5 + lane) * settings.road_size,
+                                     settings.path_intermediate_points_distance)
+        points = edge_lanes[lane] = [Vector2(x, y) for x, y in zip(xs, ys)]
+        self.geometry.counters['lane_misses'] += 1
+        return points
+
+    def get_road_polygons(self, i: int, j: int) -> list[tuple]:
+        # (corners, color) of the asphalt and the markings of the road between i and j, both directions
+        key = (min(i, j), max(i, j))
+        polygons = self.geometry.roads.get(key)
+        if polygons is not None:
+            self.geometry.counters['road_hits'] += 1
+            return polygons
+
+        start = self.joints[i]
+        end = self.joints[j]
+        lanes = self.get_lanes(i, j) + self.get_lanes(j, i)
+        polygons = self.geometry.roads[key] = []
+
+        def add_line(line_start: Vector2, line_end: Vector2, width: float, color: tuple,
+                     dash: float = 1, gap: float = 0):
+            for dash_start, dash_end in graphics.get_dashes(line_start, line_end, dash, gap):
+                corners = graphics.get_line_polygon(dash_start, dash_end, width)
+                if corners:
+                    polygons.append((corners, color))
+
+        def add_line_edges(width: float, dash: float = 1, gap: float = 0):
+            for edge_start, edge_end in graphics.get_line_edges(start, end, width):
+                add_line(edge_start, edge_end, settings.marking_size, Color.MARKING_WHITE, dash, gap)
+
+        self.geometry.counters['road_misses'] += 1
+        add_line(start, end, self.road_size * lanes, self.road_color)
+        if self.road_color == Color.ASPHALT:
+            return polygons
 
-        for i, joint1 in enumerate(self.joints):
-            for j, joint2 in enumerate(self.joints):
-                self.distance_matrix[i][j] = joint1.dist(joint2.x, joint2.y)
+        add_line_edges(self.road_size * lanes)
+
+        match lanes:
+            case 1:
+                pass
+            case 2:
+                add_line(start, end, settings.marking_size, Color.MARKING_WHITE,
+                         settings.dotted_marking[0], settings.dotted_marking[1])
+            case _:
+                add_line(start, end, settings.marking_size, Color.MARKING_WHITE)
+                for n_roads in range(2, lanes, 2):
+                    add_line_edges(self.road_size * n_roads, settings.dotted_marking[0], settings.dotted_marking[1])
+
+        return polygons
 
     def get_joint_radius(self, index: int):
-        max_roads = max(self.matrix[index])
+        max_roads = max(self.adjacency[index].values(), default=0)
         return self.road_size * max_roads
 
     def get_closest_joint_to(self, position: Vector2):
-        min_distance = float('inf')
-        closest_joint = None
-
-        for index, joint in enumerate(self.joints):
-            if joint.dist(position.x, position.y) < min_distance:
-                min_distance = joint.dist(position.x, position.y)
-                closest_joint = index
-
-        return closest_joint
+        return self.joint_grid.nearest(position.x, position.y)
+
+    def get_closest_joints_to(self, position: Vector2, k: int) -> list[int]:
+        # Up to k joints, closest first
+        return self.joint_grid.k_nearest(position.x, position.y, k)
+
+    def get_joints_within(self, position: Vector2, radius: float) -> list[int]:
+        return sorted(self.joint_grid.query_radius(position.x, position.y, radius))
+
+    def get_joint_at(self, position: Vector2) -> int | None:
+        # Lowest index joint whose circle (get_joint_radius, by its lane count) contains the position
+        for index in self.get_joints_within(position, self.road_size * self.max_lanes):
+            if self.joints[index].dist(position.x, position.y) <= self.get_joint_radius(index):
+                return index
+        return None
+
+    def get_route(self, start_index: int, end_index: int) -> list[int] | None:
+        # Same as get_shortest_path, read from the next hop table when it has the destination's tree,
+        # or queried from the contraction hierarchy when it is up to date
+        if self.routing is not None and self.routing.has_tree(end_index):
+            path = self.routing.get_path(start_index, end_index)
+            # An outdated tree may miss roads added since, no route from it is searched again
+            if path is not None or self.routing.is_up_to_date(end_index):
+                return path
+        if self.hierarchy is not None and self.hierarchy.version == self.version:
+            return self.hierarchy.get_path(start_index, end_index)
+        return self.get_shortest_path(start_index, end_index)
+
+    def is_route_up_to_date(self, end_index: int) -> bool:
+        # False while get_route may answer from an outdated next hop table tree, such routes are not cached
+        return self.routing is None or not self.routing.has_tree(end_index) or self.routing.is_up_to_date(end_index)
 
     def get_neighbors_of(self, index: int):
-        connections = []
-        for j in range(self.n_joints):
-            if self.matrix[index][j] != 0:
-                connections.append(j)
-
-        return connections
-
-    def get_shortest_path(self, start_index: int, end_index: int):
-        # Dijkstra algorithm
-
-        unvisited_indexes = list(range(self.n_joints))
-        path_lengths = [float('inf') for _ in range(self.n_joints)]
-        previous_joints = [-1 for _ in range(self.n_joints)]
-
-        path_lengths[start_index] = 0
-
-        while unvisited_indexes:
-            current_min_index = None
-            for index in unvisited_indexes:
-                if current_min_index is None:
-                    current_min_index = index
-                elif path_lengths[index] < path_lengths[current_min_index]:
-                    current_min_index = index
-
-            neighbors = self.get_neighbors_of(current_min_index)
-            for neighbor in neighbors:
-                tentative_value = path_lengths[current_min_index] + self.distance_matrix[current_min_index][neighbor]
-                if tentative_value < path_lengths[neighbor]:
-                    path_lengths[neighbor] = tentative_value
-
-                    previous_joints[neighbor] = current_min_index
-
-            unvisited_indexes.pop(unvisited_indexes.index(current_min_index))
-
-        path = []
-        index = end_index
-
-        while index != start_index:
-            path.append(index)
-            index = previous_joints[index]
-
-        path.append(start_index)
+        return list(self.adjacency[index])
+
+    def get_shortest_path(self, start_index: int, end_index: int, heuristic: bool = None) -> list[int] | None:
+        # Joint indexes from end_index back to start_index, None if end_index can't be reached.
+        # With the heuristic it is A*, guided by the straight distance to the target, which never overestimates
+        # since roads are straight. Without it, Dijkstra. Both stop once the target is settled
+        if heuristic is None:
+            heuristic = settings.path_search == 'astar'
+
+        target = self.joints[end_index]
+        if heuristic:
+            def estimate(index: int) -> float:
+                return self.joints[index].dist(target.x, target.y)
+        else:
+            def estimate(index: int) -> float:
+                return 0
 
-        return path
+        return search_path(self.lengths, start_index, end_index, estimate)
 
     def add_joint(self, position: Vector2, connected_index: int, connection_to_new: int = 1, connection_from_new: int = 1):
         self.joints.append(position)
         self.n_joints += 1
+        self.version += 1
+        self.joint_grid.insert(self.n_joints - 1, position.x, position.y)
 
-        self.matrix = [i + [0] for i in self.matrix]
-        self.matrix.append([0] * self.n_joints)
+        self.adjacency.append({})
+        self.lengths.append({})
+        self.incoming.append(set())
 
-        self.matrix[connected_index][-1] = connection_to_new
-        self.matrix[-1][connected_index] = connection_from_new
+        new_index = self.n_joints - 1
+        self._notify('joint_added', new_index)
 
-        self.recalculate_distance_matrix()
+        self.set_lanes(connected_index, new_index, connection_to_new)
+        self.set_lanes(new_index, connected_index, connection_from_new)
 
     def set_joint_position(self, index: int, new_position: Vector2):
+        # Only the edges of the moved joint change. All of them are reported, even if their length stayed
+        # the same, since their geometry did not
         self.joints[index] = new_position
-        self.recalculate_distance_matrix()
+        self.version += 1
+        self.joint_grid.move(index, new_position.x, new_position.y)
+
+        changes = []
+        for i, j in self.get_incident_edges(index):
+            old_length = self.lengths[i][j]
+            self.lengths[i][j] = self.joints[i].dist(self.joints[j].x, self.joints[j].y)
+            changes.append((i, j, old_length, self.lengths[i][j]))
+
+        if changes:
+            self._notify('edges_changed', changes)
 
     def render_to(self, window: graphics.Window, camera):
+        # Every road is rendered once, from its higher joint and in the order of (higher joint, lower joint).
+        # That is the last of the two passes the dense matrix renderer made over each road, so the dashes
+        # start from the same end and overlapping roads stack the same way
         for i in range(self.n_joints):
-            for j in range(self.n_joints):
-                if not (self.matrix[i][j] or self.matrix[j][i]):
-                    continue
-
+            for j in sorted(self.adjacency[i].keys() | self.incoming[i]):
+                if j > i:
+                    break
                 self.render_road_to(window, camera, i, j)
 
         for index, joint in enumerate(self.joints):
-            max_roads = max(self.matrix[index])
+            max_roads = max(self.adjacency[index].values(), default=0)
 
             if camera.schematic:
                 color = self.s_joint_color
@@ -209,6 +554,7 @@ class RoadGraph:
 
     def render_road_to(self, window: graphics.Window, camera, i: int, j: int):
         relative_position = camera.get_relative_position(Vector2(0, 0))
+        lanes = self.get_lanes(i, j) + self.get_lanes(j, i)
 
         if camera.schematic:
             color = self.s_road_color
@@ -216,47 +562,12 @@ class RoadGraph:
                 color = Color.sSELECTED
             window.render_line(relative_position + (camera.schematic_scale * self.joints[i]),
                                relative_position + (camera.schematic_scale * self.joints[j]),
-                               width=camera.schematic_scale * self.road_size * (
-                                           self.matrix[i][j] + self.matrix[j][i]),
+                               width=camera.schematic_scale * self.road_size * lanes,
                                color=color)
             return
 
-        window.render_line(relative_position + self.joints[i],
-                           relative_position + self.joints[j],
-                           width=self.road_size * (self.matrix[i][j] + self.matrix[j][i]),
-                           color=self.road_color)
-        if self.road_color == Color.ASPHALT:
-            return
-
-        window.render_line_edges(relative_position + self.joints[i],
-                                 relative_position + self.joints[j],
-                                 width=self.road_size * (self.matrix[i][j] + self.matrix[j][i]),
-                                 color=Color.MARKING_WHITE,
-                                 edge_width=settings.marking_size)
-
-        match self.matrix[i][j] + self.matrix[j][i]:
-            case 1:
-                pass
-            case 2:
-                window.render_line(relative_position + self.joints[i],
-                                   relative_position + self.joints[j],
-                                   width=settings.marking_size,
-                                   color=Color.MARKING_WHITE,
-                                   dash=settings.dotted_marking[0],
-                                   gap=settings.dotted_marking[1])
-            case _:
-                window.render_line(relative_position + self.joints[i],
-                                   relative_position + self.joints[j],
-                                   width=settings.marking_size,
-                                   color=Color.MARKING_WHITE)
-                for n_roads in range(2, self.matrix[i][j] + self.matrix[j][i], 2):
-                    window.render_line_edges(relative_position + self.joints[i],
-                                             relative_position + self.joints[j],
-                                             width=self.road_size * n_roads,
-                                             color=Color.MARKING_WHITE,
-                                             edge_width=settings.marking_size,
-                                             dash=settings.dotted_marking[0],
-                                             gap=settings.dotted_marking[1])
+        # The geometry is cached in world space, the camera only moves it outside of the schematic view
+        window.render_polygons(self.get_road_polygons(i, j), relative_position)
 
 
 class Car(physics.PhysicsRectAgent):
@@ -267,19 +578,43 @@ class Car(physics.PhysicsRectAgent):
                  linear_acceleration: float = 0,
                  angular_acceleration: float = 0,
                  name: str = 'Car',
-                 radius: float = None,
+                 rect: Vector2 = None,
                  mass: float = 1,
                  max_speed: float = 0,
                  turning_margin: float = 0.5,
                  crashed_sprite: Sprite = None,
                  schematic_color: tuple | list = Color.sCAR
                  ):
-        super().__init__(sprite, position, rotation, linear_acceleration, angular_acceleration, name, radius, mass, schematic_color)
+        super().__init__(sprite, position, rotation, linear_acceleration, angular_acceleration, name, rect, mass, schematic_color)
+        # The CarBlueprint the car was made from, whose sprites, rect and constants it shares
+        self.blueprint = None
         self.max_speed: float = max_speed
         self.allowed_speed: float = max_speed
 
-        self.previous_vertex: Vector2 = self.position
-        self.path: list[Vector2] = []
+        self.previous_vertex: Vector2 = self.position.copy()
+        # The whole path, waypoints before path_cursor are passed. Per waypoint, precomputed by set_path:
+        # its coordinates and their prefix sums, the unit direction of the segment to the next waypoint,
+        # the distance along the path and the last waypoint of the straight run starting at it
+        self.waypoints: list[Vector2] = []
+        self.path_cursor: int = 0
+        self.path_xs: list[float] = []
+        self.path_ys: list[float] = []
+        self.path_sums_x: list[float] = [0.0]
+        self.path_sums_y: list[float] = [0.0]
+        self.path_directions_x: list[float] = []
+        self.path_directions_y: list[float] = []
+        self.path_distances: list[float] = []
+        self.path_runs: list[int] = []
+        # For paths planned on the road graph: the roads they run along (joint pairs, lower index first),
+        # the path index after the last waypoint of each road, the next road not passed yet and the target joint
+        self.path_roads: list[tuple[int, int]] = []
+        # and the lane along each road, as (i, j, lane) keys of RoadGraph.get_lane_points
+        self.path_lanes: list[tuple[int, int, int]] = []
+        self.path_road_ends: list[int] = []
+        self.path_road_index: int = 0
+        self.path_target: int = -1
+        # Called with the car before set_path replaces its path, so the owner of the route can forget it
+        self.route_dropped = None
         self.path_min_distance: float = settings.path_min_distance
         self.turning_margin = turning_margin
 
@@ -287,31 +622,60 @@ class Car(physics.PhysicsRectAgent):
 
     def update(self, delta, collisions: list[Object] = None):
         if self.active:
-            if self.path and self.position.dist(self.path[0].x, self.path[0].y) <= self.path_min_distance:
-                self.previous_vertex = self.path.pop(0)
+            self.follow_path()
+
+        super().update(delta, collisions)
 
-            #if self.path:
-            #    road_vector = self.path[0] - self.previous_vertex
+    @property
+    def path(self) -> list[Vector2]:
+        # Copy of the waypoints left, use has_path and waypoints[path_cursor] where it matters
+        return self.waypoints[self.path_cursor:]
 
-            if not self.path:
-                self.desired_velocity = Vector2(0, 0)
-            else:
-                self.desired_velocity = self.path[0] - self.position
-                added_velocities = 1
+    @path.setter
+    def path(self, new_path: list[Vector2]):
+        self.set_path(new_path)
 
-                while added_velocities < len(self.path):
-                    next_desired_velocity = self.path[added_velocities] - self.position
+    def has_path(self) -> bool:
+        return self.path_cursor < len(self.waypoints)
 
-                    if abs(self.desired_velocity.normalize() - next_desired_velocity.normalize()) < settings.min_next_desired_difference:
-                        self.desired_velocity += next_desired_velocity
-                        added_velocities += 1
-                    else:
-                        break
+    def get_remaining_distance(self) -> float:
+        # Along the path, from the car to its last waypoint
+        cursor = self.path_cursor
+        if cursor >= len(self.waypoints):
+            return 0
+        return (self.path_distances[-1] - self.path_distances[cursor]
+                + self.position.dist(self.path_xs[cursor], self.path_ys[cursor]))
 
-            if abs(self.desired_velocity) > self.allowed_speed:
-                self.desired_velocity = self.allowed_speed * self.desired_velocity.normalize()
+    def follow_path(self):
+        position = self.position
+        cursor = self.path_cursor
 
-        super().update(delta, collisions)
+        if cursor < len(self.waypoints) and position.dist(self.path_xs[cursor], self.path_ys[cursor]) <= self.path_min_distance:
+            self.previous_vertex = self.waypoints[cursor]
+            cursor = self.path_cursor = cursor + 1
+
+        if cursor >= len(self.waypoints):
+            desired_velocity = Vector2(0, 0)
+        else:
+            desired_x = self.path_xs[cursor] - position.x
+            desired_y = self.path_ys[cursor] - position.y
+
+            # Heading onto a straight run, the car aims at the sum of the vectors to all of its waypoints
+            end = self.path_runs[cursor]
+            if end > cursor:
+                length = math.sqrt(desired_x * desired_x + desired_y * desired_y)
+                if length and math.hypot(desired_x / length - self.path_directions_x[cursor],
+                                         desired_y / length - self.path_directions_y[cursor]) < settings.min_next_desired_difference:
+                    count = end - cursor + 1
+                    desired_x = self.path_sums_x[end + 1] - self.path_sums_x[cursor] - count * position.x
+                    desired_y = self.path_sums_y[end + 1] - self.path_sums_y[cursor] - count * position.y
+
+            desired_velocity = Vector2(desired_x, desired_y)
+
+        if abs(desired_velocity) > self.allowed_speed:
+            desired_velocity = self.allowed_speed * desired_velocity.normalize()
+
+        self.desired_velocity = desired_velocity
 
     def set_allowed_speed(self, new_allowed_speed: float):
         if new_allowed_speed > self.max_speed:
@@ -320,7 +684,72 @@ class Car(physics.PhysicsRectAgent):
             self.allowed_speed = new_allowed_speed
 
     def set_path(self, new_path: list[Vector2]):
-        self.path = new_path
+        if self.route_dropped is not None:
+            self.route_dropped(self)
+
+        self.waypoints = new_path
+        self.path_cursor = 0
+        self.path_xs = [vertex.x for vertex in new_path]
+        self.path_ys = [vertex.y for vertex in new_path]
+        self.path_sums_x = list(accumulate(self.path_xs, initial=0.0))
+        self.path_sums_y = list(accumulate(self.path_ys, initial=0.0))
+
+        directions_x, directions_y, distances, runs = kernels.path_segments(
+            kernels.as_array(self.path_xs), kernels.as_array(self.path_ys), settings.min_next_desired_difference)
+        self.path_directions_x = list(directions_x)
+        self.path_directions_y = list(directions_y)
+        self.path_distances = list(distances)
+        self.path_runs = list(runs)
+
+        self.path_roads = []
+        self.path_lanes = []
+        self.path_road_ends = []
+        self.path_road_index = 0
+        self.path_target = -1
+
+    def set_route(self, new_path: list[Vector2], target: int, roads: list[tuple[int, int]],
+                  lanes: list[tuple[int, int, int]], road_ends: list[int]):
+        self.set_path(new_path)
+        self.path_roads = roads
+        self.path_lanes = lanes
+        self.path_road_ends = road_ends
+        self.path_target = target
+
+    def reset(self, blueprint, position: tuple | list | Point2 | Vector2, rotation: float = 0, name: str = 'Car'):
+        # Turns a despawned car into a new one of the blueprint, as CarBlueprint.get_car would make it.
+        # The vectors the car owns are reused, the car must not be in a batch (see CarPool)
+        x, y = position
+        self.position = self.position.set_(x, y)
+        self.rotation = rotation
+        self.previous_position = self.previous_position.set_(x, y)
+        self.previous_rotation = rotation
+        self.name = name
+
+        self.blueprint = blueprint
+        self.sprite = blueprint.sprite
+        self.crashed_sprite = blueprint.crashed_sprite
+        self.rect = blueprint.rect
+        self.render_hitbox = settings.render_hitbox
+        self.render_velocities = settings.render_velocities
+        self.schematic_color = Color.sCAR
+
+        self.mass = blueprint.mass
+        self.linear_torque = blueprint.mass * settings.linear_mu
+        self.angular_torque = blueprint.mass * settings.angular_mu
+        self.linear_acceleration = blueprint.linear_acceleration
+        self.angular_acceleration = blueprint.angular_acceleration
+        self.max_speed = blueprint.max_speed
+        self.allowed_speed = blueprint.max_speed
+
+        self.linear_velocity = self.linear_velocity.set_(0, 0)
+        self.angular_velocity = 0
+        self.desired_velocity = self.desired_velocity.set_(0, 0)
+        self.active = True
+
+        # Waypoints may be shared with the route cache, so the previous vertex is not reused
+        self.previous_vertex = self.position.copy()
+        self.set_path([])
+        self.path_min_distance = settings.path_min_distance
 
     def crash(self):
         self.active = False
@@ -336,8 +765,8 @@ class Car(physics.PhysicsRectAgent):
         if self.render_velocities:
             start = camera.get_relative_position(self.previous_vertex)
 
-            if self.path:
-                for vertex in self.path:
+            if self.has_path():
+                for vertex in self.waypoints[self.path_cursor:]:
                     end = camera.get_relative_position(vertex)
                     window.render_line(start, end, color=Color.BLUE)
                     window.render_circle(self.path_min_distance * camera.schematic_scale, end, color=Color.BLUE)
@@ -345,6 +774,52 @@ class Car(physics.PhysicsRectAgent):
                     start = end
 
 
+class CarPool:
+    # Free list of despawned cars. Spawning takes a car from it and resets it to its blueprint (Car.reset)
+    # instead of building a new one, so the simulation can be left and entered again without reallocating
+    # every car. At most max_size cars are kept, the rest are left to the garbage collector
+    def __init__(self, max_size: int):
+        self.max_size: int = max_size
+        self.free: list[Car] = []
+
+        self.counters: dict[str, int] = {
+            'hits': 0,
+            'misses': 0,
+            'released': 0,
+            'discarded': 0,
+        }
+
+    def __len__(self):
+        return len(self.free)
+
+    def acquire(self, blueprint, position: tuple | list | Point2 | Vector2, rotation: float = 0, name: str = 'Car') -> Car:
+        if not self.free:
+            self.counters['misses'] += 1
+            return blueprint.get_car(position, rotation, name)
+
+        self.counters['hits'] += 1
+        car = self.free.pop()
+        car.reset(blueprint, position, rotation, name)
+        return car
+
+    def release(self, cars):
+        # Cars made without a blueprint can't be reset and are not kept
+        for car in cars:
+            if len(self.free) >= self.max_size or car.blueprint is None:
+                self.counters['discarded'] += 1
+                continue
+
+            self.counters['released'] += 1
+            self.free.append(car)
+
+    def get_hit_rate(self) -> float:
+        acquired = self.counters['hits'] + self.counters['misses']
+        return self.counters['hits'] / acquired if acquired else 0
+
+    def clear(self):
+        self.free.clear()
+
+
 class CityPathfinding:
     def __new__(cls, *args, **kwargs):
         if not hasattr(cls, 'instance'):
@@ -361,27 +836,280 @@ class CityPathfinding:
         self.obstacles: list[Object] = obstacles
         self.objects: list[Object] = self.agents + self.obstacles
 
+        if getattr(self, 'roads', None) is not None:
+            self.roads.remove_listener(self)
+
         self.roads: RoadGraph = roads
         self.sidewalks: RoadGraph = sidewalks
 
+        # Agents whose remaining path runs along each road (joint pair, lower index first). When roads change,
+        # only their agents are routed again, toward the same target
+        self.road_agents: dict[tuple[int, int], set] = {}
+        self.replanning: set = set()
+        roads.add_listener(self)
+
+        # Cars are routed through a next hop table, kept up to date in the background while the map is edited.
+        # Larger maps get a contraction hierarchy once the simulation starts, see prepare_routes
+        if settings.next_hop_routing and roads.n_joints <= settings.next_hop_max_joints:
+            roads.enable_routing()
+
+        # Cars starting from the same joints toward the same targets share their routes
+        if settings.route_cache_bytes:
+            roads.enable_route_cache(settings.route_cache_bytes)
+
+        # Bursts of cars without a route, like right after spawning, are routed together in worker processes
+        if getattr(self, 'route_planner', None) is not None:
+            self.route_planner.close()
+        self.route_planner: BatchRoutePlanner | None = None
+        if settings.batch_route_workers != 0:
+            self.route_planner = BatchRoutePlanner(roads, settings.batch_route_workers, settings.batch_route_min_size,
+                                                   settings.path_search == 'astar')
+
         self.car_blueprints = car_blueprints
 
+        # Cars of the previous simulation are recycled when it is entered again, the pool outlives map loads
+        if getattr(self, 'car_pool', None) is None:
+            self.car_pool: CarPool | None = CarPool(settings.car_pool_size) if settings.car_pool_size else None
+
+        # Rect agents are integrated together in one vectorized step when numpy is available
+        self.batch: PhysicsBatch | None = None
+        if settings.batch_physics and batch.NUMPY_AVAILABLE:
+            self.batch = PhysicsBatch()
+            self._add_to_batch(self.agents)
+
+        # Cars slow down behind the car ahead on their lane, when numpy is available
+        self.car_following: CarFollowing | None = None
+        if settings.car_following and traffic.NUMPY_AVAILABLE:
+            self.car_following = CarFollowing(settings.following_time_headway, settings.following_min_gap,
+                                              settings.following_deceleration)
+
+        # Obstacles barely move, so they are indexed once per map load. Sleeping agents join them
+        self.static_tree: BoundingVolumeHierarchy = BoundingVolumeHierarchy(self.obstacles)
+        self.sleeping: set = set()
+
+        # Only agents sharing a grid cell reach the narrow phase. Close pairs are kept between steps
+        self.broad_phase: SpatialHash = SpatialHash(settings.collision_cell_size or settings.road_size)
+        self.contacts: ContactCache = ContactCache(self.broad_phase, settings.contact_margin, self.static_tree)
+        for agent in self.agents:
+            self.contacts.insert(agent)
+        self._fit_cell_size(self.agents)
+
+        # (agent, other object, time of impact) found by the last continuous collision pass
+        self.impacts: list[tuple] = []
+
     def update(self, delta: float):
+        self._save_state()
+
+        self._replan_agents()
+
+        waiting = [agent for agent in self.agents if isinstance(agent, Car) and agent.active and not agent.has_path()]
+        if self.route_planner is not None and len(waiting) >= self.route_planner.min_batch_size:
+            self._set_agent_random_paths(waiting, self.roads)
+        else:
+            for agent in waiting:
+                self._set_agent_random_path(agent, self.roads)
+
+        if self.car_following is not None:
+            self.car_following.update(self.agents, delta)
+
+        for agent in self.agents:
+            if getattr(agent, 'batch', None) is None:
+                agent.update(delta)
+            elif agent.active and isinstance(agent, Car):
+                agent.follow_path()
+
+            if isinstance(agent, Car):
+                self._release_passed_roads(agent)
+
+        if self.batch is not None:
+            self.batch.step(delta)
+
+        self._update_collisions()
+        self._sleep_resting_agents()
+
+    def _save_state(self):
+        if self.batch is not None:
+            self.batch.save_state()
+
+        for agent in self.agents:
+            if getattr(agent, 'batch', None) is None and hasattr(agent, 'save_state'):
+                agent.save_state()
+
+    @contextmanager
+    def interpolated(self, alpha: float):
+        # Temporarily places agents between their last two physics states, for rendering only
+        saved_batch = None
+        if self.batch is not None:
+            saved_batch = self.batch.begin_interpolation(alpha)
+
+        saved = []
+        for agent in self.agents:
+            if getattr(agent, 'batch', None) is None and hasattr(agent, 'previous_position'):
+                position, rotation = agent.position, agent.rotation
+                saved.append((agent, position, rotation))
+
+                agent.position = agent.previous_position + alpha * (position - agent.previous_position)
+                agent.rotation = agent.previous_rotation + alpha * (rotation - agent.previous_rotation)
+
+        try:
+            yield
+        finally:
+            for agent, position, rotation in saved:
+                agent.position = position
+                agent.rotation = rotation
+
+            if saved_batch is not None:
+                self.batch.end_interpolation(saved_batch)
+
+    def _update_collisions(self):
+        self.broad_phase.reset_counters()
+        self.contacts.reset_counters()
+
+        for agent in self.agents:
+            self.contacts.update(agent)
+
+        if settings.continuous_collision:
+            self._update_continuous_collisions()
+
+        # Only pairs that started touching in this step crash, touching pairs stay crashed
+        entered, _, _ = self.contacts.update_contacts(self._get_colliding_pairs)
+        for obj, obj2 in entered:
+            self.broad_phase.counters['collisions'] += 1
+
+            if hasattr(obj, 'active'):
+                obj.crash()
+
+            if hasattr(obj2, 'active'):
+                obj2.crash()
+
+    def _update_continuous_collisions(self):
+        # Agents that moved far in this step are swept against everything near their path.
+        # Colliding agents are moved back to the time of impact and crash there
+        self.impacts = []
+
+        for agent in self.agents:
+            if not (agent.active and hasattr(agent, 'previous_position')):
+                continue
+
+            motion = agent.position - agent.previous_position
+            if abs(motion) <= settings.ccd_motion_threshold * agent.get_thickness():
+                continue
+
+            min_x, min_y, max_x, max_y = agent.get_aabb()
+            swept_aabb = aabb_union((min_x, min_y, max_x, max_y),
+                                    (min_x - motion.x, min_y - motion.y, max_x - motion.x, max_y - motion.y))
+
+            candidates = self.broad_phase.query_aabb(swept_aabb)
+            candidates.update(self.static_tree.query_aabb(swept_aabb))
+            candidates.discard(agent)
+
+            first_impact = None
+            for other in candidates:
+                time = physics.get_time_of_impact(agent, other)
+                if time is not None and (first_impact is None or time < first_impact[2]):
+                    first_impact = (agent, other, time)
+
+            if first_impact:
+                self.impacts.append(first_impact)
+
+        for agent, other, time in self.impacts:
+            for obj in (agent, other):
+                if hasattr(obj, 'active') and obj in self.contacts:
+                    obj.position = obj.previous_position + time * (obj.position - obj.previous_position)
+                    self.contacts.update(obj)
+
+                if hasattr(obj, 'active'):
+                    obj.crash()
+
+            self.broad_phase.counters['collisions'] += 1
+
+    def _get_colliding_pairs(self, pairs: list[tuple]) -> list[tuple]:
+        if not pairs:
+            return []
+
+        if settings.batch_narrow_phase and batch.NUMPY_AVAILABLE:
+            # One separating axis test over all candidate pairs
+            bodies = BodyArrays(list({obj for pair in pairs for obj in pair}))
+            mask = bodies.overlap([bodies.index[obj] for obj, _ in pairs],
+                                  [bodies.index[obj2] for _, obj2 in pairs])
+            return [pair for pair, colliding in zip(pairs, mask) if colliding]
+
+        return [(obj, obj2) for obj, obj2 in pairs if obj.is_colliding_with(obj2) or obj2.is_colliding_with(obj)]
+
+    def add_obstacle(self, obstacle: Object):
+        self.obstacles.append(obstacle)
+        self.objects.append(obstacle)
+        self.static_tree.insert(obstacle)
+        self.contacts.add_static(obstacle)
+
+    def update_obstacle(self, obstacle: Object):
+        # Has to be called after an obstacle is moved or rotated outside of the simulation
+        if obstacle in self.static_tree:
+            self.static_tree.refit(obstacle)
+            self.contacts.refresh_static(obstacle)
+
+    def get_object_at(self, point: Vector2):
+        for obstacle in self.static_tree.query_point(point):
+            if obstacle.contains_point(point):
+                return obstacle
+
+        for agent in self.agents:
+            if agent.contains_point(point):
+                return agent
+
+        return None
+
+    def _sleep_resting_agents(self):
+        if self.batch is not None:
+            resting = self.batch.get_resting_agents()
+        else:
+            resting = []
+
         for agent in self.agents:
-            if (not agent.path) and agent.active:
-                if isinstance(agent, Car):
-                    self._set_agent_random_path(agent, self.roads)
+            if (getattr(agent, 'batch', None) is None and hasattr(agent, 'active') and not agent.active
+                    and not agent.angular_velocity and not abs(agent.linear_velocity)):
+                resting.append(agent)
+
+        for agent in resting:
+            self.sleep(agent)
+
+    def sleep(self, agent: Object):
+        # Sleeping agents skip integration and are collided with like obstacles
+        if agent in self.sleeping:
+            return
+
+        if self.batch is not None:
+            self.batch.remove(agent)
+
+        self.contacts.remove(agent)
+        self.agents.remove(agent)
+        if isinstance(agent, Car):
+            self._drop_route(agent)
+
+        # A sleeping agent is static, its sweep starts and ends where it stands
+        agent.save_state()
+        self.static_tree.insert(agent)
+        self.contacts.add_static(agent)
+        self.sleeping.add(agent)
+
+    def wake(self, agent: Object):
+        if agent not in self.sleeping:
+            return
 
-            agent.update(delta)
+        self.sleeping.discard(agent)
+        self.static_tree.remove(agent)
+        self.contacts.remove_static(agent)
 
-        for obj in self.objects:
-            for obj2 in self.objects:
-                if (obj != obj2) and obj.is_colliding_with(obj2):
-                    if hasattr(obj, 'active'):
-                        obj.crash()
+        self.agents.append(agent)
+        self.contacts.insert(agent)
+        self._add_to_batch([agent])
 
-                    if hasattr(obj2, 'active'):
-                        obj2.crash()
+    def prepare_routes(self):
+        # Called when the simulation starts. Maps too large for the next hop table get a contraction hierarchy
+        # of their current roads, built in the background while the first routes are searched
+        if (self.roads.routing is None and settings.contraction_hierarchy
+                and self.roads.n_joints >= settings.contraction_hierarchy_min_joints):
+            self.roads.build_contraction_hierarchy(background=True)
 
     def spawn_agents(self, density: float = 1) -> list:
         if not self.car_blueprints:
@@ -392,44 +1120,200 @@ class CityPathfinding:
             if random.uniform(0, 1) <= density: # if density = 1 or more, cars will spawn at all joints
                 blueprint_choice = random.choice(self.car_blueprints)
 
-                car = blueprint_choice.get_car(position=joint)
+                if self.car_pool is not None:
+                    car = self.car_pool.acquire(blueprint_choice, joint)
+                else:
+                    car = blueprint_choice.get_car(position=joint)
                 new_agents.append(car)
 
         self.objects += new_agents
         self.agents += new_agents
+        self._add_to_batch(new_agents)
+
+        for agent in new_agents:
+            self.contacts.insert(agent)
+        self._fit_cell_size(new_agents)
 
         return new_agents
 
     def clear_agents(self):
+        if self.batch is not None:
+            self.batch.clear()
+
+        for agent in self.agents:
+            self.contacts.remove(agent)
+
+        for agent in self.sleeping:
+            self.static_tree.remove(agent)
+            self.contacts.remove_static(agent)
+
+        # Pooled cars are spawned again as new ones, their collisions have to enter again
+        removed = set(self.agents) | self.sleeping
+        self.contacts.discard_contacts(removed)
+        self.objects = [obj for obj in self.objects if obj not in removed]
         self.agents.clear()
+        self.sleeping.clear()
+        self.road_agents.clear()
+        self.replanning.clear()
 
-    def _set_agent_random_path(self, agent: Object, graph: RoadGraph):
-        closest = graph.get_closest_joint_to(agent.position)
-        target = random.randint(0, graph.n_joints - 1)
+        if self.car_pool is not None:
+            self.car_pool.release(agent for agent in removed if isinstance(agent, Car))
 
-        index_path = graph.get_shortest_path(closest, target)
-        path = []
+    def _fit_cell_size(self, agents: list[Object]):
+        # Grows the grid cells to the largest agent, unless the cell size is set explicitly
+        if settings.collision_cell_size or not agents:
+            return
 
-        for i in range(len(index_path) - 1):
-            index = index_path[i]
-            next_index = index_path[i + 1]
+        largest = 0
+        for agent in agents:
+            min_x, min_y, max_x, max_y = agent.get_aabb()
+            largest = max(largest, max_x - min_x, max_y - min_y)
 
-            road_vector = graph.joints[next_index] - graph.joints[index]
-            lane_vector = settings.road_size * road_vector.normalize().rotate(-90)
+        if largest > self.broad_phase.cell_size:
+            self.contacts.rebuild(largest)
 
-            selected_lane = random.randint(0, graph.matrix[index][next_index] - 1)
+    def _add_to_batch(self, agents: list[Object]):
+        if self.batch is None:
+            return
 
-            path.append(graph.joints[index] + (0.5 + selected_lane) * lane_vector)
+        for agent in agents:
+            if isinstance(agent, physics.PhysicsRectAgent):
+                self.batch.add(agent)
 
-            intermediate_x = settings.path_intermediate_points_distance
-            while intermediate_x < abs(road_vector):
-                intermediate_road_vector = intermediate_x * road_vector.normalize()
-                path.append(graph.joints[index] + intermediate_road_vector + (0.5 + selected_lane) * lane_vector)
+    def _set_agent_random_path(self, agent: Object, graph: RoadGraph):
+        self._set_agent_path(agent, graph, random.randint(0, graph.n_joints - 1))
 
-                intermediate_x += settings.path_intermediate_points_distance
+    def _set_agent_path(self, agent: Object, graph: RoadGraph, target: int):
+        closest = graph.get_closest_joint_to(agent.position)
 
-            path.append(graph.joints[next_index] + (0.5 + selected_lane) * lane_vector)
+        cache = graph.route_cache
+        route = cache.get(closest, target) if cache is not None else None
+        if route is not None:
+            index_path = route.index_path
+        else:
+            # Checked first, the tree may be repaired meanwhile
+            cacheable = cache is not None and graph.is_route_up_to_date(target)
+            index_path = graph.get_route(closest, target)
+            if cacheable:
+                route = cache.put(closest, target, index_path)
+
+        self._set_agent_route(agent, graph, index_path, route)
+
+    def _set_agent_random_paths(self, agents: list[Object], graph: RoadGraph):
+        # Same as _set_agent_random_path for every agent, with the routes missing from the cache planned together
+        requests = [(graph.get_closest_joint_to(agent.position), random.randint(0, graph.n_joints - 1))
+                    for agent in agents]
+
+        cache = graph.route_cache
+        index_paths = {}
+        routes = {}
+        for request in requests:
+            if request in index_paths:
+                continue
+
+            route = cache.get(*request) if cache is not None else None
+            index_paths[request] = route.index_path if route is not None else None
+            routes[request] = route
+
+        missing = [request for request, route in routes.items() if route is None]
+        cacheable = {request for request in missing if cache is not None and graph.is_route_up_to_date(request[1])}
+        for request, index_path in zip(missing, self.route_planner.plan(missing)):
+            index_paths[request] = index_path
+            if request in cacheable:
+                routes[request] = cache.put(*request, index_path)
+
+        for agent, request in zip(agents, requests):
+            self._set_agent_route(agent, graph, index_paths[request], routes[request])
+
+    def _set_agent_route(self, agent: Object, graph: RoadGraph, index_path: list[int] | None, route):
+        # Random lanes along the route, route is its CachedRoute when the route is cached
+        if index_path is None:
+            return
 
-        path.reverse()
+        cache = graph.route_cache
+
+        lanes = tuple(random.randint(0, graph.get_lanes(index_path[i], index_path[i + 1]) - 1)
+                      for i in range(len(index_path) - 1))
+
+        path = cache.get_waypoints(route, lanes) if route is not None else None
+        if path is None:
+            path = self._get_lane_waypoints(graph, index_path, lanes)
+            if route is not None:
+                cache.put_waypoints(route, lanes, path)
+
+        # Roads in the order they are driven, the waypoints are laid out from the end of the route
+        roads = []
+        road_lanes = []
+        road_ends = []
+        end = 0
+        for k in range(len(index_path) - 2, -1, -1):
+            i, j = index_path[k], index_path[k + 1]
+            roads.append((min(i, j), max(i, j)))
+            road_lanes.append((i, j, lanes[k]))
+            end += len(graph.get_lane_points(i, j, lanes[k]))
+            road_ends.append(end)
+
+        # Cars pop their waypoints, the cached list stays whole. Any path that replaces the route, even one set
+        # by hand, takes the agent out of the index of its roads
+        agent.route_dropped = self._drop_route
+        agent.set_route(list(path), index_path[0], roads, road_lanes, road_ends)
+        for road in roads:
+            self.road_agents.setdefault(road, set()).add(agent)
+
+    def _release_passed_roads(self, agent: Car):
+        # Takes the agent out of the index of the roads whose waypoints it consumed
+        ends = agent.path_road_ends
+        while agent.path_road_index < len(ends) and agent.path_cursor >= ends[agent.path_road_index]:
+            self._discard_road_agent(agent.path_roads[agent.path_road_index], agent)
+            agent.path_road_index += 1
+
+    def _drop_route(self, agent: Car):
+        for road in agent.path_roads[agent.path_road_index:]:
+            self._discard_road_agent(road, agent)
+        agent.path_road_index = len(agent.path_roads)
+
+    def _discard_road_agent(self, road: tuple[int, int], agent: Car):
+        agents = self.road_agents.get(road)
+        if agents is not None:
+            agents.discard(agent)
+            if not agents:
+                del self.road_agents[road]
+
+    def _replan_agents(self):
+        # Agents whose route ran along a changed road, toward the same target. The unreachable ones are left
+        # without a path and get a random one. Paths set by hand since the change have no target and are kept
+        for agent in self.replanning:
+            target = agent.path_target
+            if target == -1:
+                continue
+
+            agent.set_path([])
+            if agent.active:
+                self._set_agent_path(agent, self.roads, target)
+        self.replanning.clear()
+
+    # ___ Changes reported by the road graph ___________________
+
+    def joint_added(self, index: int):
+        pass
+
+    def edges_changed(self, changes: list[tuple]):
+        # Agents driving along a changed road are routed again on the next update
+        for i, j, _, _ in changes:
+            for agent in self.road_agents.pop((min(i, j), max(i, j)), ()):
+                self._drop_route(agent)
+                self.replanning.add(agent)
+
+    def rebuild(self):
+        for agent in set().union(*self.road_agents.values()):
+            self._drop_route(agent)
+            self.replanning.add(agent)
+
+    def _get_lane_waypoints(self, graph: RoadGraph, index_path: list[int], lanes: tuple) -> list[Vector2]:
+        path = []
+
+        for i in range(len(index_path) - 1):
+            path.extend(graph.get_lane_points(index_path[i], index_path[i + 1], lanes[i]))
 
-        agent.set_path(path)
+        path.reverse()
+        return path
@@ -1,7 +1,7 @@
 import graphics
 from graphics import Sprite, Window, InputType
 import physics
-from physics import Vector2, Point2, Object, intersect
+from physics import Vector2, Point2, Object
 
 import city
 from city import Building, RoadGraph, CityPathfinding
@@ -50,7 +50,8 @@ class Camera:
 
     def get_relative_position(self, global_position: Vector2):
         if self.schematic:
-            return self.schematic_scale * (global_position - self.position)
+            return Vector2(self.schematic_scale * (global_position.x - self.position.x),
+                           self.schematic_scale * (global_position.y - self.position.y))
         return global_position - self.position
 
     def get_global_position(self, relative_position: Vector2):
@@ -73,6 +74,7 @@ class Game:
 
         self.time = igtime.Time()
         self.framerate = framerate
+        self.timestep = igtime.FixedTimestep(settings.physics_step, settings.max_physics_substeps)
 
         self.selection = None
 
@@ -98,6 +100,8 @@ class Game:
         )
 
         self.shift_x_hold = False
+        # Road graph whose joint is dragged with the right mouse button, its routing is paused until the release
+        self.dragged_graph: RoadGraph | None = None
 
         self.running: bool = True
         self.delta: float = 0
@@ -126,11 +130,18 @@ class Game:
             self.sidewalks.render_to(self.window, self.camera)
             self.roads.render_to(self.window, self.camera)
 
-            if self.input_handler == self._handle_input_default:
-                self.city.update(self.delta)
+            simulating = self.input_handler == self._handle_input_default
+            if simulating:
+                for _ in range(self.timestep.advance(self.delta)):
+                    self.city.update(self.timestep.step)
 
-            for obj in self.objects:
-                obj.render_to(self.window, self.camera)
+            if simulating and settings.interpolate_rendering:
+                with self.city.interpolated(self.timestep.alpha):
+                    for obj in self.objects:
+                        obj.render_to(self.window, self.camera)
+            else:
+                for obj in self.objects:
+                    obj.render_to(self.window, self.camera)
 
         self.ui.render_to(self.window)
 
@@ -219,6 +230,8 @@ class Game:
 
                 case InputType.RMB:
                     if self.selection:
+                        self.city.wake(self.selection)
+
                         global_click = self.camera.get_global_position(self.window.get_mouse_position())
                         if hasattr(self.selection, 'path'):
                             self.selection.set_path(self.selection.path + [global_click])
@@ -228,6 +241,7 @@ class Game:
                             self.selection.apply_force(linear_force=global_click - self.selection.position)
                         else:
                             self.selection.position = global_click
+                            self.city.update_obstacle(self.selection)
 
                         self.selection.render_hitbox = False
                         self.selection = None
@@ -235,16 +249,20 @@ class Game:
                 case InputType.SCROLL_UP:
                     if self.selection:
                         if hasattr(self.selection, 'angular_velocity'):
+                            self.city.wake(self.selection)
                             self.selection.apply_force(angular_force=-50)
                         else:
                             self.selection.rotation -= 5
+                            self.city.update_obstacle(self.selection)
 
                 case InputType.SCROLL_DOWN:
                     if self.selection:
                         if hasattr(self.selection, 'angular_velocity'):
+                            self.city.wake(self.selection)
                             self.selection.apply_force(angular_force=50)
                         else:
                             self.selection.rotation += 5
+                            self.city.update_obstacle(self.selection)
 
                 case InputType.QUIT:
                     self.running = False
@@ -300,8 +318,10 @@ class Game:
 
                     elif isinstance(self.selection, Object):
                         self.selection.position = global_click
+                        self.city.update_obstacle(self.selection)
                     elif isinstance(self.selection, int):
                         selected_graph = self._get_selected_graph()
+                        self._start_joint_drag(selected_graph)
                         selected_graph.set_joint_position(self.selection, Vector2(global_click))
 
                 case InputType.SCROLL_UP:
@@ -310,6 +330,7 @@ class Game:
                             self.selection.rotation -= 5
                         else:
                             self.selection.rotation -= 1
+                        self.city.update_obstacle(self.selection)
 
                     else:
                         self.camera.zoom_in(settings.camera_zoom_speed)
@@ -320,6 +341,7 @@ class Game:
                             self.selection.rotation += 5
                         else:
                             self.selection.rotation += 1
+                        self.city.update_obstacle(self.selection)
 
                     else:
                         self.camera.zoom_out(settings.camera_zoom_speed)
@@ -352,11 +374,15 @@ class Game:
                 case InputType.QUIT:
                     self.running = False
 
+        if InputType.RMB not in input_events:
+            self._end_joint_drag()
+
         signals = self.ui.update(input_events, self.window.get_mouse_position())
         if signals['< Back']:
             self.switch_state_to('MAIN_MENU')
 
     def switch_state_to(self, state_key: str):
+        self._end_joint_drag()
         match state_key:
             case 'MAIN_MENU':
                 self.menu_on = True
@@ -387,7 +413,9 @@ class Game:
                 self.camera.schematic_scale = 1
                 self.camera.schematic = False
 
+                self.city.prepare_routes()
                 self.objects += self.city.spawn_agents(density=settings.car_spawn_density)
+                self.timestep.reset()
 
             case _:
                 raise 'invalid game state key: "' + state_key + '"'
@@ -463,7 +491,7 @@ class Game:
 
         new_building = blueprint.get_building(global_mouse_position, height=5)
         self.objects.append(new_building)
-        self.city.obstacles.append(new_building)
+        self.city.add_obstacle(new_building)
 
         self.selection = new_building
         new_building.schematic_color = Color.sSELECTED
@@ -505,44 +533,24 @@ class Game:
 
     def _get_selected_physics_object(self, click: Vector2):
         global_click = self.camera.get_global_position(click)
-
-        for obj in self.objects:
-            if hasattr(obj, 'radius'):
-                if obj.position.dist(global_click.x, global_click.y) <= obj.radius:
-                    return obj
-
-            elif hasattr(obj, 'rect'):
-                a, b, c, d = obj.get_vertices()
-                segments = [(a, b), (b, c), (c, d), (d, a)]
-
-                r1 = global_click
-                r2 = obj.position
-
-                selected = True
-                for segment in segments:
-                    if intersect(r1, r2, segment[0], segment[1]):
-                        selected = False
-
-                if selected:
-                    return obj
-
-        return None
+        return self.city.get_object_at(global_click)
 
     def _get_selected_road_joint(self, click: Vector2):
-        global_click = self.camera.get_global_position(click)
-
-        for index, joint in enumerate(self.roads.joints):
-            radius = self.roads.get_joint_radius(index)
-            if joint.dist(global_click.x, global_click.y) <= radius:
-                return index
+        return self.roads.get_joint_at(self.camera.get_global_position(click))
 
     def _get_selected_sidewalk_joint(self, click: Vector2):
-        global_click = self.camera.get_global_position(click)
-
-        for index, joint in enumerate(self.sidewalks.joints):
-            radius = self.sidewalks.get_joint_radius(index)
-            if joint.dist(global_click.x, global_click.y) <= radius:
-                return index
+        return self.sidewalks.get_joint_at(self.camera.get_global_position(click))
+
+    def _start_joint_drag(self, graph: RoadGraph):
+        if self.dragged_graph is not graph:
+            self._end_joint_drag()
+            self.dragged_graph = graph
+            graph.pause_routing()
+
+    def _end_joint_drag(self):
+        if self.dragged_graph is not None:
+            self.dragged_graph.resume_routing()
+            self.dragged_graph = None
 
     def _get_selected_graph(self):
         if (self.roads.selected_road != [-1, -1]) or (self.roads.selected_joint != -1):
@@ -1,3 +1,5 @@
+import math
+
 import pygame
 
 import physics
@@ -60,13 +62,16 @@ class Window(object):
         pygame.draw.polygon(self.display, color, [list(i) for i in vertices])
 
     def _c_render_line(self, start: Vector2, end: Vector2, width: int, color: tuple | list):
-        line_vector = end - start
-        perpendicular = (width / 2) * Vector2(line_vector.y, -line_vector.x).normalize()
-        inverse = Vector2(-perpendicular.x, -perpendicular.y)
+        corners = get_line_polygon(start, end, width)
+        if corners:
+            pygame.draw.polygon(self.display, color, corners)
 
-        self.render_polygon([start + perpendicular, start + inverse,
-                             end + inverse, end + perpendicular],
-                            color)
+    def render_polygons(self, polygons: list[tuple], offset: Vector2):
+        # (corners, color) polygons, e.g. from get_line_polygon, moved by offset
+        offset_x = offset.x
+        offset_y = offset.y
+        for corners, color in polygons:
+            pygame.draw.polygon(self.display, color, [(x + offset_x, y + offset_y) for x, y in corners])
 
     def render(self, image: pygame.Surface, position: Vector2):
         self.display.blit(image, list(position))
@@ -85,23 +90,8 @@ class Window(object):
                     color: tuple | list = Color.WHITE,
                     dash: float = 1,
                     gap: float = 0):
-        start = Vector2(*start)
-        end = Vector2(*end)
-
-        if gap:
-            current_start = start
-
-            while abs(current_start - start) < abs(end - start):
-                current_end = current_start + dash * (end - start).normalize()
-                if abs(current_end - start) > abs(end - start):
-                    current_end = end
-
-                self._c_render_line(current_start, current_end, width, color)
-
-                current_start = current_end + gap * (end - start).normalize()
-
-        else:
-            self._c_render_line(start, end, width, color)
+        for dash_start, dash_end in get_dashes(start, end, dash, gap):
+            self._c_render_line(dash_start, dash_end, width, color)
 
     def render_line_edges(self,
                           start: Vector2,
@@ -113,14 +103,12 @@ class Window(object):
                           edge_width: int = 1,
                           left_edge: bool = True,
                           right_edge: bool = True):
-        line_vector = end - start
-        perpendicular = (width / 2) * Vector2(line_vector.y, -line_vector.x).normalize()
-        inverse = Vector2(-perpendicular.x, -perpendicular.y)
+        right, left = get_line_edges(start, end, width)
 
         if right_edge:
-            self.render_line(start + perpendicular, end + perpendicular, edge_width, color, dash, gap)
+            self.render_line(*right, edge_width, color, dash, gap)
         if left_edge:
-            self.render_line(start + inverse, end + inverse, edge_width, color, dash, gap)
+            self.render_line(*left, edge_width, color, dash, gap)
 
     def draw_text_label(self, text: str, color: tuple, position: Vector2, font_option: str = 'text'):
         font = self.fonts[font_option]
@@ -163,6 +151,56 @@ class Window(object):
         return relevant_events + list(self.pressed_keys)
 
 
+# ___ Line geometry ___________________
+# Shared by the Window's line rendering and by the geometry RoadGraph caches per road
+
+def get_line_polygon(start: Vector2, end: Vector2, width: float) -> tuple | None:
+    # Corners of a line of the given width, None for a zero length line
+    dx = end.x - start.x
+    dy = end.y - start.y
+    length = math.hypot(dx, dy)
+    if not length:
+        return None
+
+    # Half-width perpendicular (dy, -dx)
+    px = 0.5 * width * dy / length
+    py = -0.5 * width * dx / length
+
+    return (start.x + px, start.y + py), (start.x - px, start.y - py), (end.x - px, end.y - py), (end.x + px, end.y + py)
+
+
+def get_dashes(start: tuple | list | Vector2, end: tuple | list | Vector2, dash: float = 1, gap: float = 0) -> list:
+    # (start, end) of every dash of a dashed line, the whole line without a gap
+    start = Vector2(*start)
+    end = Vector2(*end)
+
+    if not gap:
+        return [(start, end)]
+
+    dashes = []
+    current_start = start
+
+    while abs(current_start - start) < abs(end - start):
+        current_end = current_start + dash * (end - start).normalize()
+        if abs(current_end - start) > abs(end - start):
+            current_end = end
+
+        dashes.append((current_start, current_end))
+
+        current_start = current_end + gap * (end - start).normalize()
+
+    return dashes
+
+
+def get_line_edges(start: Vector2, end: Vector2, width: float) -> tuple:
+    # (start, end) of the right and the left edge of a line of the given width
+    line_vector = end - start
+    perpendicular = (width / 2) * Vector2(line_vector.y, -line_vector.x).normalize()
+    inverse = Vector2(-perpendicular.x, -perpendicular.y)
+
+    return (start + perpendicular, end + perpendicular), (start + inverse, end + inverse)
+
+
 class InputType:
     QUIT = pygame.QUIT
 
@@ -12,3 +12,32 @@ class Time:
 
     def tick(self, framerate: int):
         return self.clock.tick(framerate) / 1000
+
+
+class FixedTimestep:
+    # Splits frame time into equal physics steps. The remainder carries over to the next frame,
+    # alpha tells how far rendering is between the last two physics states
+    def __init__(self, step: float, max_substeps: int):
+        self.step: float = step
+        self.max_substeps: int = max_substeps
+
+        self.accumulator: float = 0
+        self.alpha: float = 0
+
+    def advance(self, delta: float) -> int:
+        self.accumulator += delta
+
+        steps = int(self.accumulator // self.step)
+        if steps > self.max_substeps:
+            # Drops the backlog instead of spending ever longer frames catching up
+            steps = self.max_substeps
+            self.accumulator %= self.step
+        else:
+            self.accumulator -= steps * self.step
+
+        self.alpha = self.accumulator / self.step
+        return steps
+
+    def reset(self):
+        self.accumulator = 0
+        self.alpha = 0
@@ -0,0 +1,164 @@
+import math
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import settings
+
+
+NUMBA_AVAILABLE = numba is not None and np is not None
+
+BACKENDS = ('auto', 'python', 'numba')
+
+
+# ___ Pure python kernels ___________________
+# Written against plain floats and indexable sequences only, so the same source is compiled by numba.
+# Lengths use sqrt instead of math.hypot, which numba maps to the C library one with different rounding
+
+def _segments_intersect(p1x, p1y, p2x, p2y, m1x, m1y, m2x, m2y):
+    # Strict segment crossing test of physics.intersect: touching segments do not intersect
+    p1p2x = p2x - p1x
+    p1p2y = p2y - p1y
+    m1m2x = m2x - m1x
+    m1m2y = m2y - m1y
+
+    p_side = (p1p2x * (m2y - p1y) - p1p2y * (m2x - p1x)) * (p1p2x * (m1y - p1y) - p1p2y * (m1x - p1x))
+    m_side = (m1m2x * (p2y - m1y) - m1m2y * (p2x - m1x)) * (m1m2x * (p1y - m1y) - m1m2y * (p1x - m1x))
+    return p_side < 0 and m_side < 0
+
+
+def _path_segments(xs, ys, min_difference):
+    # Per waypoint k of a path: the unit direction and the length of the segment k -> k + 1 (zeros for the
+    # last waypoint), the distance along the path from the first waypoint, and the last waypoint of the straight
+    # run k belongs to. Runs are split greedily, each one lasts while its segments point almost the same way
+    # (normalized) as its first one
+    n = len(xs)
+    directions_x = [0.0] * n
+    directions_y = [0.0] * n
+    distances = [0.0] * n
+    for k in range(n - 1):
+        segment_x = xs[k + 1] - xs[k]
+        segment_y = ys[k + 1] - ys[k]
+        length = math.sqrt(segment_x * segment_x + segment_y * segment_y)
+        if length != 0:
+            directions_x[k] = segment_x / length
+            directions_y[k] = segment_y / length
+        distances[k + 1] = distances[k] + length
+
+    runs = [0] * n
+    start = 0
+    while start < n:
+        end = start
+        if directions_x[start] != 0 or directions_y[start] != 0:
+            while end < n - 1:
+                difference_x = directions_x[start] - directions_x[end]
+                difference_y = directions_y[start] - directions_y[end]
+                if math.sqrt(difference_x * difference_x + difference_y * difference_y) >= min_difference:
+                    break
+                end += 1
+
+        for k in range(start, end):
+            runs[k] = end
+
+        if end == start:
+            runs[start] = start
+            end += 1
+        start = end
+
+    return directions_x, directions_y, distances, runs
+
+
+def _lane_points(x0, y0, x1, y1, lane_offset, spacing):
+    # Waypoints along one lane of the road (x0, y0) -> (x1, y1): the start, one every `spacing`, the end.
+    # The lane is lane_offset to the right of the road axis
+    road_x = x1 - x0
+    road_y = y1 - y0
+    road_length = math.sqrt(road_x * road_x + road_y * road_y)
+    unit_x = road_x / road_length
+    unit_y = road_y / road_length
+
+    # Same as Vector2.rotate(-90), which is not exactly (y, -x) in floating point
+    cosine = math.cos(math.radians(-90))
+    sine = math.sin(math.radians(-90))
+    lane_x = lane_offset * (unit_x * cosine - unit_y * sine)
+    lane_y = lane_offset * (unit_x * sine + unit_y * cosine)
+
+    xs = [x0 + lane_x]
+    ys = [y0 + lane_y]
+
+    intermediate = spacing
+    while intermediate < road_length:
+        xs.append(x0 + intermediate * unit_x + lane_x)
+        ys.append(y0 + intermediate * unit_y + lane_y)
+        intermediate += spacing
+
+    xs.append(x1 + lane_x)
+    ys.append(y1 + lane_y)
+    return xs, ys
+
+
+def _as_list(values):
+    return list(values)
+
+
+def _as_array(values):
+    return np.array(values, dtype=np.float64)
+
+
+PYTHON_KERNELS = {
+    'segments_intersect': _segments_intersect,
+    'path_segments': _path_segments,
+    'lane_points': _lane_points,
+    'as_array': _as_list,
+}
+
+_numba_kernels = None
+
+
+def _get_numba_kernels() -> dict:
+    # Compiled lazily on the first call of each kernel, cached on disk between runs
+    global _numba_kernels
+    if _numba_kernels is None:
+        _numba_kernels = {name: numba.njit(cache=True)(function)
+                          for name, function in PYTHON_KERNELS.items() if name != 'as_array'}
+        _numba_kernels['as_array'] = _as_array
+    return _numba_kernels
+
+
+# ___ Backend selection ___________________
+# Callers look the kernels up on the module (kernels.path_segments(...)) at call time, so switching
+# the backend rebinds them everywhere
+
+backend: str = 'python'
+
+segments_intersect = _segments_intersect
+path_segments = _path_segments
+lane_points = _lane_points
+as_array = _as_list
+
+
+def use_backend(name: str = 'auto') -> str:
+    global backend
+    if name not in BACKENDS:
+        raise ValueError(f'Unknown kernel backend {name!r}, expected one of {BACKENDS}')
+
+    if name == 'auto':
+        name = 'numba' if NUMBA_AVAILABLE else 'python'
+    elif name == 'numba' and not NUMBA_AVAILABLE:
+        raise ImportError('The numba kernel backend requires numba and numpy')
+
+    selected = _get_numba_kernels() if name == 'numba' else PYTHON_KERNELS
+    globals().update(selected)
+    backend = name
+    return name
+
+
+use_backend(settings.kernel_backend)
+
@@ -1,10 +1,20 @@
+import argparse
+
 import graphics
 import settings
 import maps
+import kernels
 
 from game import Game
 
 
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='City traffic simulator')
+    parser.add_argument('--kernel-backend', choices=kernels.BACKENDS, default=settings.kernel_backend,
+                        help='backend of the per-agent kernels, auto uses numba when it is installed')
+    return parser.parse_args()
+
+
 def mainloop():
     window = graphics.Window([600, 600], 'City traffic simulator')
     game = Game(window, maps.editor_new_map)
@@ -17,4 +27,8 @@ def mainloop():
 
 
 if __name__ == '__main__':
+    arguments = parse_arguments()
+    settings.kernel_backend = arguments.kernel_backend
+    kernels.use_backend(settings.kernel_backend)
+
     mainloop()
@@ -29,6 +29,8 @@ class CarBlueprint:
     def __init__(self, sprite: Sprite, mass: float, max_speed: float, crashed_sprite: Sprite = None, linear_acceleration: float = 100, angular_acceleration: float = 60):
         self.sprite: Sprite = sprite
         self.crashed_sprite: Sprite = crashed_sprite
+        # Hitbox shared by all cars of the blueprint
+        self.rect: Vector2 = Vector2(*sprite.get_shape())
 
         self.linear_acceleration = linear_acceleration
         self.angular_acceleration = angular_acceleration
@@ -36,17 +38,20 @@ class CarBlueprint:
         self.max_speed = max_speed
 
     def get_car(self, position: tuple | list | Vector2, rotation: float = 0, name='Building'):
-        return city.Car(
+        car = city.Car(
             sprite=self.sprite,
             position=position,
             rotation=rotation,
             linear_acceleration=self.linear_acceleration,
             angular_acceleration=self.angular_acceleration,
             name=name,
+            rect=self.rect,
             mass=self.mass,
             max_speed=self.max_speed,
             crashed_sprite=self.crashed_sprite
         )
+        car.blueprint = self
+        return car
 
 
 class Blueprints:
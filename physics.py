@@ -1,10 +1,14 @@
 import math
 
+import kernels
+
 import settings
 from settings import Color
 
 
 class Point2:
+    __slots__ = ('x', 'y')
+
     def __init__(self, x, y=None, polar=False):
         if isinstance(x, Point2):
             self.x = x.x
@@ -24,7 +28,8 @@ class Point2:
     def __len__(self):
         return 2
     def __iter__(self):
-        return iter([self.x, self.y])
+        yield self.x
+        yield self.y
     def __str__(self) -> str:
         return f'({self.x}, {self.y})'
 
@@ -33,27 +38,51 @@ class Point2:
             return abs(self)
 
         if isinstance(x, Point2):
-            return math.hypot(abs(x.x - self.x), abs(x.y - self.y))
+            return math.hypot(x.x - self.x, x.y - self.y)
+
+        return math.hypot(x - self.x, y - self.y)
+
+    def dist_sq(self, x: float, y: float = None) -> float:
+        # Squared distance, for comparisons that don't need the square root
+        if isinstance(x, Point2):
+            dx = x.x - self.x
+            dy = x.y - self.y
+        else:
+            dx = x - self.x
+            dy = y - self.y
 
-        return math.hypot(abs(x - self.x), abs(y - self.y))
+        return dx * dx + dy * dy
 
 
 class Vector2(Point2):
+    __slots__ = ()
+
     def __init__(self, *args):
         match len(args):
             case 1:
                 super().__init__(args[0])
             case 2:
                 a, b = args
-                if all(map(lambda x: isinstance(x, Point2), args)):
-                    super().__init__(b.x - a.x, b.y - a.y)
-                else:
+                if isinstance(a, Point2) and isinstance(b, Point2):
+                    self.x = b.x - a.x
+                    self.y = b.y - a.y
+                elif isinstance(a, Point2):
                     super().__init__(a, b)
+                else:
+                    self.x = a
+                    self.y = b
             case 3:
                 super().__init__(*args)
             case 4:
                 ax, ay, bx, by = args
-                super().__init__(bx - ax, by - ay)
+                self.x = bx - ax
+                self.y = by - ay
+
+    def copy(self):
+        return Vector2(self.x, self.y)
+
+    def length_sq(self) -> float:
+        return self.x * self.x + self.y * self.y
 
     def dot_product(self, other):
         return self.x * other.x + self.y * other.y
@@ -65,17 +94,63 @@ class Vector2(Point2):
         return Vector2(self.x * n, self.y * n)
 
     def normalize(self):
-        return Vector2(self.x / abs(self), self.y / abs(self))
+        length = math.hypot(self.x, self.y)
+        return Vector2(self.x / length, self.y / length)
+
+    def normalized_or_zero(self):
+        length = math.hypot(self.x, self.y)
+        if not length:
+            return Vector2(0, 0)
+        return Vector2(self.x / length, self.y / length)
 
     def rotate(self, degrees: float):
-        sine = math.sin(math.radians(degrees))
-        cosine = math.cos(math.radians(degrees))
+        radians = math.radians(degrees)
+        sine = math.sin(radians)
+        cosine = math.cos(radians)
 
         return Vector2(self.x * cosine - self.y * sine, self.x * sine + self.y * cosine)
 
+    def rotate_by(self, heading):
+        # Rotation by a precomputed (cos, sin) heading instead of an angle in degrees
+        return Vector2(self.x * heading.x - self.y * heading.y, self.x * heading.y + self.y * heading.x)
+
     def get_rotation(self):
         return math.degrees(math.atan2(self.y, self.x)) - 90
 
+    # In-place mutators return self, so they can be chained. Only use them on vectors the caller owns
+
+    def set_(self, x: float, y: float):
+        self.x = x
+        self.y = y
+        return self
+
+    def scale_(self, n: float):
+        self.x *= n
+        self.y *= n
+        return self
+
+    def normalize_(self):
+        length = math.hypot(self.x, self.y)
+        self.x /= length
+        self.y /= length
+        return self
+
+    def add_scaled_(self, other, n: float):
+        # self += n * other without the temporary vector
+        self.x += n * other.x
+        self.y += n * other.y
+        return self
+
+    def __iadd__(self, other):
+        self.x += other.x
+        self.y += other.y
+        return self
+
+    def __isub__(self, other):
+        self.x -= other.x
+        self.y -= other.y
+        return self
+
     def __add__(self, other):
         return Vector2(self.x + other.x, self.y + other.y)
 
@@ -88,6 +163,9 @@ class Vector2(Point2):
     def __rsub__(self, other):
         return self.__sub__(other)
 
+    def __neg__(self):
+        return Vector2(-self.x, -self.y)
+
     def __mul__(self, other):
         return self.dot_product(other)
 
@@ -95,24 +173,98 @@ class Vector2(Point2):
         return self.cross_product(other)
 
     def __rmul__(self, other):
-        return self.mul(other)
+        return Vector2(self.x * other, self.y * other)
 
 
 def intersect(p1: Vector2, p2: Vector2, m1: Vector2, m2: Vector2):
-    p1p2 = Vector2(p1, p2)
-    p1m1 = Vector2(p1, m1)
-    p1m2 = Vector2(p1, m2)
+    return kernels.segments_intersect(p1.x, p1.y, p2.x, p2.y, m1.x, m1.y, m2.x, m2.y)
 
-    m1m2 = Vector2(m1, m2)
-    m1p1 = Vector2(m1, p1)
-    m1p2 = Vector2(m1, p2)
 
-    if (p1p2.cross_product(p1m2) * p1p2.cross_product(p1m1) < 0
-            and
-            m1m2.cross_product(m1p2) * m1m2.cross_product(m1p1) < 0):
-        return True
-    else:
-        return False
+def heading_of(degrees: float) -> Vector2:
+    radians = math.radians(degrees)
+    return Vector2(math.cos(radians), math.sin(radians))
+
+
+def obb_overlap(center_a: Vector2, normals_a: tuple, half_a: Vector2,
+                center_b: Vector2, normals_b: tuple, half_b: Vector2) -> bool:
+    # Separating axis test of two boxes given by their centers, edge normals and half extents
+    dx = center_b.x - center_a.x
+    dy = center_b.y - center_a.y
+
+    for axis in (*normals_a, *normals_b):
+        distance = abs(dx * axis.x + dy * axis.y)
+        radius_a = half_a.x * abs(normals_a[0] * axis) + half_a.y * abs(normals_a[1] * axis)
+        radius_b = half_b.x * abs(normals_b[0] * axis) + half_b.y * abs(normals_b[1] * axis)
+        if distance >= radius_a + radius_b:
+            return False
+
+    return True
+
+
+def circle_time_of_impact(offset: Vector2, motion: Vector2, radius: float):
+    # First t in [0, 1] at which a point at offset + t * motion is within radius of the origin
+    c = offset.length_sq() - radius * radius
+    if c <= 0:
+        return 0
+
+    a = motion.length_sq()
+    b = offset * motion
+    if not a or b >= 0:
+        return None
+
+    discriminant = b * b - a * c
+    if discriminant < 0:
+        return None
+
+    time = (-b - math.sqrt(discriminant)) / a
+    return time if time <= 1 else None
+
+
+def get_time_of_impact(body, other):
+    # Sweeps both bodies linearly from previous_position to position (objects without one are static).
+    # Bounding circles give the earliest possible contact, boxes are then stepped from there
+    # with their end-of-step orientation
+    body_motion = body.position - body.previous_position
+    other_previous = getattr(other, 'previous_position', other.position)
+    other_motion = other.position - other_previous
+
+    relative_motion = other_motion - body_motion
+    time = circle_time_of_impact(other_previous - body.previous_position, relative_motion,
+                                 body.get_bounding_radius() + other.get_bounding_radius())
+
+    if time is None or not (hasattr(body, 'rect') and hasattr(other, 'rect')):
+        return time
+
+    normals_a, half_a = body.get_edge_normals(), 0.5 * body.rect
+    normals_b, half_b = other.get_edge_normals(), 0.5 * other.rect
+
+    def overlap_at(t: float) -> bool:
+        return obb_overlap(body.previous_position + t * body_motion, normals_a, half_a,
+                           other_previous + t * other_motion, normals_b, half_b)
+
+    step = 0.5 * min(body.get_thickness(), other.get_thickness())
+    samples = min(settings.ccd_max_samples, math.ceil((1 - time) * abs(relative_motion) / step) + 1)
+
+    previous_t = None
+    for k in range(samples + 1):
+        t = time + (1 - time) * k / samples
+        if not overlap_at(t):
+            previous_t = t
+            continue
+
+        if previous_t is None:
+            return t
+
+        # Narrows the contact down between the last free sample and the first overlapping one
+        for _ in range(settings.ccd_refine_iterations):
+            middle = 0.5 * (previous_t + t)
+            if overlap_at(middle):
+                t = middle
+            else:
+                previous_t = middle
+        return t
+
+    return None
 
 
 def simplify_angle(angle: float):
@@ -125,6 +277,44 @@ def simplify_angle(angle: float):
     return angle
 
 
+class BatchAttribute:
+    # Stored in the agent's row of a batch.PhysicsBatch while the agent is attached to one,
+    # in the instance dictionary otherwise
+    def __init__(self, default=None, transform: bool = False):
+        self.default = default
+        # Setting a transform attribute bumps the owner's transform_version
+        self.transform: bool = transform
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+
+        if instance.batch is None:
+            if self.default is not None:
+                return instance.__dict__.get(self.name, self.default)
+            return instance.__dict__[self.name]
+        return instance.batch.get(self.name, instance.batch_index)
+
+    def __set__(self, instance, value):
+        if instance.batch is None:
+            instance.__dict__[self.name] = value
+        else:
+            instance.batch.set(self.name, instance.batch_index, value)
+
+        if self.transform:
+            instance.transform_version += 1
+
+
+class RotationAttribute(BatchAttribute):
+    # Rotation in degrees, setting it also refreshes the agent's cached heading
+    def __set__(self, instance, value):
+        super().__set__(instance, value)
+        instance.heading = heading_of(value)
+
+
 class Object:
     def __init__(self,
                  sprite,
@@ -181,26 +371,52 @@ class PhysicsDynamicCircle(Object):
         self.linear_torque: float = mass * settings.linear_mu
         self.angular_torque: float = mass * settings.angular_mu
 
+        self.previous_position: Vector2 = self.position.copy()
+        self.previous_rotation: float = self.rotation
+
         self.render_hitbox = settings.render_hitbox
 
+    def save_state(self):
+        # Remembers the transform before a physics step, for render interpolation
+        self.previous_position = self.position.copy()
+        self.previous_rotation = self.rotation
+
     def update(self, delta, collisions: list[Object] = None):
-        if abs(self.linear_velocity) > delta * self.linear_torque:
-            self.linear_velocity -= delta * self.linear_torque * self.linear_velocity.normalize()
+        linear_velocity = self.linear_velocity
+        speed = abs(linear_velocity)
+        if speed > delta * self.linear_torque:
+            linear_velocity.scale_(1 - delta * self.linear_torque / speed)
         else:
-            self.linear_velocity = Vector2(0, 0)
+            linear_velocity.set_(0, 0)
+        self.linear_velocity = linear_velocity
 
-        if abs(self.angular_velocity) > delta * self.angular_torque:
-            self.angular_velocity -= delta * self.angular_torque * self.angular_velocity / abs(self.angular_velocity)
+        angular_velocity = self.angular_velocity
+        if abs(angular_velocity) > delta * self.angular_torque:
+            angular_velocity -= delta * self.angular_torque * angular_velocity / abs(angular_velocity)
         else:
-            self.angular_velocity = 0
+            angular_velocity = 0
+        self.angular_velocity = angular_velocity
 
-        self.position += delta * self.linear_velocity
-        self.rotation += delta * self.angular_velocity
+        self.position = self.position.add_scaled_(linear_velocity, delta)
+        self.rotation += delta * angular_velocity
 
     def apply_force(self, linear_force: Vector2 = Vector2(0, 0), angular_force: float = 0):
         self.linear_velocity += (1 / self.mass) * linear_force
         self.angular_velocity += (1 / self.mass) * angular_force
 
+    def contains_point(self, point: Vector2):
+        return self.position.dist_sq(point) <= self.radius * self.radius
+
+    def get_bounding_radius(self):
+        return self.radius
+
+    def get_thickness(self):
+        return 2 * self.radius
+
+    def get_aabb(self):
+        return (self.position.x - self.radius, self.position.y - self.radius,
+                self.position.x + self.radius, self.position.y + self.radius)
+
     def is_colliding_with(self, other):
         if hasattr(other, 'radius'):
             if self.position.dist(other.position) <= self.radius + other.radius:
@@ -247,15 +463,112 @@ class PhysicsStaticRect(Object):
         self.render_hitbox = settings.render_hitbox
         self.schematic_color = schematic_color
 
+    # World-space vertices, edge normals and AABB are cached until position, rotation or rect
+    # is assigned again, which bumps transform_version
+    transform_version: int = 0
+    _transform_cache_version: int = -1
+    _transform_cache: tuple = None
+
+    @property
+    def position(self) -> Vector2:
+        return self._position
+
+    @position.setter
+    def position(self, new_position: Vector2):
+        self._position = new_position
+        self.transform_version += 1
+
+    @property
+    def rotation(self) -> float:
+        return self._rotation
+
+    @rotation.setter
+    def rotation(self, new_rotation: float):
+        # Degrees are kept for the editor and sprites, geometry uses the cached (cos, sin) heading
+        self._rotation = new_rotation
+        self.heading = heading_of(new_rotation)
+        self.transform_version += 1
+
+    def get_forward(self) -> Vector2:
+        # Unit vector the body's front points to, (0, 1) rotated by the heading
+        return Vector2(-self.heading.y, self.heading.x)
+
+    @property
+    def rect(self) -> Vector2:
+        return self._rect
+
+    @rect.setter
+    def rect(self, new_rect: Vector2):
+        self._rect = new_rect
+        self.transform_version += 1
+
+    def _get_transform_cache(self):
+        if self._transform_cache_version != self.transform_version:
+            vertices = self._compute_vertices()
+            a, b, c, d = vertices
+
+            heading = self.heading
+            normals = (Vector2(heading.x, heading.y), Vector2(-heading.y, heading.x))
+
+            aabb = (min(a.x, b.x, c.x, d.x), min(a.y, b.y, c.y, d.y),
+                    max(a.x, b.x, c.x, d.x), max(a.y, b.y, c.y, d.y))
+
+            self._transform_cache = (vertices, normals, aabb)
+            self._transform_cache_version = self.transform_version
+
+        return self._transform_cache
+
     def get_vertices(self, rotation_modifier: float = 0, scale_modifier: float = 1):
-        edge_position = self.position + -0.5 * scale_modifier * self.rect.rotate(self.rotation)
-        a = edge_position
-        b = a + Vector2(scale_modifier * self.rect.x, 0).rotate(self.rotation + rotation_modifier)
-        c = b + Vector2(0, scale_modifier * self.rect.y).rotate(self.rotation + rotation_modifier)
-        d = a + Vector2(0, scale_modifier * self.rect.y).rotate(self.rotation + rotation_modifier)
+        # The default vertices are shared with the cache and must not be modified in place
+        if rotation_modifier or scale_modifier != 1:
+            return self._compute_vertices(rotation_modifier, scale_modifier)
+        return self._get_transform_cache()[0]
+
+    def get_edge_normals(self):
+        return self._get_transform_cache()[1]
+
+    def get_aabb(self):
+        return self._get_transform_cache()[2]
+
+    def _compute_vertices(self, rotation_modifier: float = 0, scale_modifier: float = 1):
+        cosine, sine = self.heading
+
+        width = scale_modifier * self.rect.x
+        height = scale_modifier * self.rect.y
+        position = self.position
+
+        ax = position.x - 0.5 * (width * cosine - height * sine)
+        ay = position.y - 0.5 * (width * sine + height * cosine)
+
+        if rotation_modifier:
+            cosine, sine = heading_of(self.rotation + rotation_modifier)
+
+        # Rotated (width, 0) and (0, height) sides
+        wx, wy = width * cosine, width * sine
+        hx, hy = -height * sine, height * cosine
+
+        a = Vector2(ax, ay)
+        b = Vector2(ax + wx, ay + wy)
+        c = Vector2(ax + wx + hx, ay + wy + hy)
+        d = Vector2(ax + hx, ay + hy)
 
         return a, b, c, d
 
+    def get_bounding_radius(self):
+        return 0.5 * abs(self.rect)
+
+    def get_thickness(self):
+        return min(self.rect.x, self.rect.y)
+
+    def contains_point(self, point: Vector2):
+        # The point is inside if the segment from it to the center crosses no edge
+        a, b, c, d = self.get_vertices()
+        for segment in [(a, b), (b, c), (c, d), (d, a)]:
+            if intersect(point, self.position, segment[0], segment[1]):
+                return False
+
+        return True
+
     def is_colliding_with(self, other):
         a, b, c, d = self.get_vertices()
         segments = [(a, b), (b, c), (c, d), (d, a)]
@@ -277,6 +590,9 @@ class PhysicsStaticRect(Object):
                     if intersect(segment1[0], segment1[1], segment2[0], segment2[1]):
                         return True
 
+            # No crossing edges, but one box may still be fully inside the other
+            return self.contains_point(other.position) or other.contains_point(self.position)
+
         return False
 
     def render_to(self, window, camera):
@@ -319,19 +635,32 @@ class PhysicsDynamicRect(PhysicsStaticRect):
         self.linear_torque: float = mass * settings.linear_mu
         self.angular_torque: float = mass * settings.angular_mu
 
+        self.previous_position: Vector2 = self.position.copy()
+        self.previous_rotation: float = self.rotation
+
+    def save_state(self):
+        # Remembers the transform before a physics step, for render interpolation
+        self.previous_position = self.position.copy()
+        self.previous_rotation = self.rotation
+
     def update(self, delta, collisions: list[Object] = None):
-        if abs(self.linear_velocity) > delta * self.linear_torque:
-            self.linear_velocity -= delta * self.linear_torque * self.linear_velocity.normalize()
+        linear_velocity = self.linear_velocity
+        speed = abs(linear_velocity)
+        if speed > delta * self.linear_torque:
+            linear_velocity.scale_(1 - delta * self.linear_torque / speed)
         else:
-            self.linear_velocity = Vector2(0, 0)
+            linear_velocity.set_(0, 0)
+        self.linear_velocity = linear_velocity
 
-        if abs(self.angular_velocity) > delta * self.angular_torque:
-            self.angular_velocity -= delta * self.angular_torque * self.angular_velocity / abs(self.angular_velocity)
+        angular_velocity = self.angular_velocity
+        if abs(angular_velocity) > delta * self.angular_torque:
+            angular_velocity -= delta * self.angular_torque * angular_velocity / abs(angular_velocity)
         else:
-            self.angular_velocity = 0
+            angular_velocity = 0
+        self.angular_velocity = angular_velocity
 
-        self.position += delta * self.linear_velocity
-        self.rotation += delta * self.angular_velocity
+        self.position = self.position.add_scaled_(linear_velocity, delta)
+        self.rotation += delta * angular_velocity
 
     def apply_force(self, linear_force: Vector2 = Vector2(0, 0), angular_force: float = 0):
         self.linear_velocity += (1 / self.mass) * linear_force
@@ -401,6 +730,27 @@ class PhysicsCircleAgent(PhysicsDynamicCircle):
 
 
 class PhysicsRectAgent(PhysicsDynamicRect):
+    batch = None
+    batch_index: int = -1
+
+    position = BatchAttribute(transform=True)
+    rotation = RotationAttribute(transform=True)
+    heading = BatchAttribute()
+    transform_version = BatchAttribute(default=0)
+    previous_position = BatchAttribute()
+    previous_rotation = BatchAttribute()
+    mass = BatchAttribute()
+
+    linear_velocity = BatchAttribute()
+    angular_velocity = BatchAttribute()
+    linear_torque = BatchAttribute()
+    angular_torque = BatchAttribute()
+
+    linear_acceleration = BatchAttribute()
+    angular_acceleration = BatchAttribute()
+    desired_velocity = BatchAttribute()
+    active = BatchAttribute()
+
     def __init__(self,
                  sprite,
                  position: tuple | list | Point2 | Vector2,
@@ -432,13 +782,15 @@ class PhysicsRectAgent(PhysicsDynamicRect):
                     correction_angular_velocity)) * self.angular_acceleration * delta
             self.angular_velocity += correction_angular_velocity
 
-            projection_length = -self.desired_velocity.rotate(-self.rotation + 90).x
-            projection = Vector2(0, projection_length).rotate(self.rotation)
+            forward = self.get_forward()
+            projection = (self.desired_velocity * forward) * forward
 
-            correction_vector = projection - self.linear_velocity
-            if abs(correction_vector) > self.linear_acceleration * delta:
-                correction_vector = self.linear_acceleration * delta * correction_vector.normalize()
-            self.linear_velocity += correction_vector
+            linear_velocity = self.linear_velocity
+            correction_vector = projection - linear_velocity
+            correction_length = abs(correction_vector)
+            if correction_length > self.linear_acceleration * delta:
+                correction_vector.scale_(self.linear_acceleration * delta / correction_length)
+            self.linear_velocity = linear_velocity + correction_vector
 
         super().update(delta, collisions)
 
@@ -454,8 +806,8 @@ class PhysicsRectAgent(PhysicsDynamicRect):
                 end = start + camera.schematic_scale * self.desired_velocity
                 window.render_line(start, end, color=Color.RED)
 
-                projection_length = -self.desired_velocity.rotate(-self.rotation + 90).x
-                projection = Vector2(0, projection_length).rotate(self.rotation)
+                forward = self.get_forward()
+                projection = (self.desired_velocity * forward) * forward
                 end = start + camera.schematic_scale * projection
                 window.render_line(start, end, color=Color.GREEN)
 
@@ -463,5 +815,5 @@ class PhysicsRectAgent(PhysicsDynamicRect):
                 end = start + camera.schematic_scale * self.linear_velocity
                 window.render_line(start, end, color=Color.BLACK)
 
-                end = start + camera.schematic_scale * Vector2(0, 64).rotate(self.rotation)
+                end = start + (camera.schematic_scale * 64) * self.get_forward()
                 window.render_line(start, end, color=Color.YELLOW)
@@ -0,0 +1,898 @@
+import heapq
+import math
+import os
+import threading
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+
+INFINITY = float('inf')
+
+
+class NextHopTable:
+    # All pairs routing table of a road graph: for every destination d, next_hops[d][u] is the joint after u
+    # on a shortest path from u to d (-1 if d can't be reached) and distances[d][u] the length of that path.
+    # Each destination has its own shortest path tree, built by a reverse Dijkstra from d.
+    #
+    # It listens to the changes of the graph (see RoadGraph.add_listener), which are only logged: build_dirty
+    # brings the trees up to date, in a background thread unless background is False. Each tree is repaired
+    # on a copy, against a snapshot of the table's own copy of the roads, which only changes together with the
+    # log, and the changes logged since the tree's own version. Edges that got shorter or were added are
+    # repaired from the edge's start on. When a tree edge got longer or was removed, only the joints routed
+    # through it are recomputed, unless there are more than max_repair_size of them: then the whole tree is
+    # built again. Trees are committed one at a time, until then the old tree keeps answering with valid, maybe
+    # longer routes, see is_up_to_date. Its joints that couldn't reach the destination may reach it over roads
+    # added since. Only trees routed over a removed edge are dropped at once.
+    # While paused, e.g. during a joint drag, the changes pile up and are repaired together after resume.
+    # An error in the background thread stops it and is raised again by the next wait or change.
+    # Destinations without a tree are not routed, the caller falls back to searching the graph
+    def __init__(self, graph, background: bool = True, max_repair_size: int = 256):
+        self.graph = graph
+        self.background: bool = background
+        self.max_repair_size: int = max_repair_size
+
+        self.next_hops: list = []
+        self.distances: list = []
+        # The roads as of version, the graph itself changes outside the lock
+        self.incoming: list[set] = []
+        self.lengths: list[dict] = []
+        # The version of the table each tree is up to date with
+        self.tree_versions: list[int] = []
+        # Destinations without a tree, to be built
+        self.dirty: set = set()
+        # (version, changes) reported since the oldest tree version
+        self.changes: list[tuple[int, list]] = []
+
+        # Bumped on every change
+        self.version: int = 0
+        # Bumped when every tree is dropped, trees built or repaired before are thrown away
+        self.generation: int = 0
+        self.paused: bool = False
+
+        self.counters: dict[str, int] = {
+            'routes': 0,
+            'repaired': 0,
+            'invalidated': 0,
+            'rebuilt': 0,
+            'discarded': 0,
+        }
+
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._idle = threading.Event()
+        self._idle.set()
+        self._thread: threading.Thread | None = None
+        self._error: Exception | None = None
+
+        self.rebuild()
+
+    def __len__(self):
+        return len(self.next_hops)
+
+    def has_tree(self, destination: int) -> bool:
+        return destination < len(self.next_hops) and self.next_hops[destination] is not None
+
+    def is_up_to_date(self, destination: int) -> bool:
+        # False while the tree misses changes, it may then route longer or miss roads added since
+        return self.has_tree(destination) and self.tree_versions[destination] == self.version
+
+    def get_path(self, start_index: int, end_index: int) -> list[int] | None:
+        # Joint indexes from end_index back to start_index, like RoadGraph.get_shortest_path.
+        # None if end_index can't be reached or has no tree yet, check has_tree to tell them apart
+        next_hops = self.next_hops[end_index] if end_index < len(self.next_hops) else None
+        if next_hops is None:
+            return None
+
+        path = [start_index]
+        index = start_index
+        while index != end_index:
+            index = next_hops[index]
+            if index == -1 or len(path) > len(next_hops):
+                return None
+            path.append(index)
+
+        self.counters['routes'] += 1
+        path.reverse()
+        return path
+
+    # ___ Changes reported by the graph ___________________
+
+    def rebuild(self):
+        # Drops every tree, e.g. after the whole adjacency was replaced
+        with self._lock:
+            self.version += 1
+            self.generation += 1
+            n = self.graph.n_joints
+            self.incoming = [set(previous) for previous in self.graph.incoming]
+            self.lengths = [dict(lengths) for lengths in self.graph.lengths]
+            self.next_hops = [None] * n
+            self.distances = [None] * n
+            self.tree_versions = [self.version] * n
+            self.dirty = set(range(n))
+            self.changes = []
+
+        self._schedule()
+
+    def joint_added(self, index: int):
+        # Called before the edges of the new joint are reported, which then repair the trees
+        with self._lock:
+            self.version += 1
+            self.incoming.append(set())
+            self.lengths.append({})
+            for next_hops, distances in zip(self.next_hops, self.distances):
+                if next_hops is not None:
+                    next_hops.append(-1)
+                    distances.append(INFINITY)
+
+            self.next_hops.append(None)
+            self.distances.append(None)
+            self.tree_versions.append(self.version)
+            self.dirty.add(index)
+
+        self._schedule()
+
+    def edges_changed(self, changes: list[tuple]):
+        # changes are (i, j, old length, new length) of the edge i -> j, with None for a missing edge
+        with self._lock:
+            self.version += 1
+            self.changes.append((self.version, changes))
+            for i, j, _, new_length in changes:
+                if new_length is None:
+                    self.lengths[i].pop(j, None)
+                    self.incoming[j].discard(i)
+                else:
+                    self.lengths[i][j] = new_length
+                    self.incoming[j].add(i)
+
+            # Routes over a removed edge can't be driven, their trees are dropped until they are built again.
+            # Without the background thread the trees are repaired before anything reads them
+            removed = [(i, j) for i, j, old_length, new_length in changes
+                       if old_length is not None and new_length is None]
+            if removed and self.background:
+                for destination, next_hops in enumerate(self.next_hops):
+                    if next_hops is not None and any(next_hops[i] == j for i, j in removed):
+                        self.next_hops[destination] = None
+                        self.distances[destination] = None
+                        self.dirty.add(destination)
+                        self.counters['invalidated'] += 1
+
+        self._schedule()
+
+    # ___ Building and repairing ___________________
+
+    def pause(self):
+        # Changes are still logged and trees over removed edges dropped, nothing is repaired until resume
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+        self._schedule()
+
+    def _schedule(self):
+        self._raise_error()
+        if not (self.dirty or self.changes):
+            return
+
+        self._idle.clear()
+        if self.paused:
+            return
+
+        if not self.background:
+            self.build_dirty()
+            return
+
+        self._idle.clear()
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='next-hop-table', daemon=True)
+            self._thread.start()
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            try:
+                self.build_dirty()
+            except Exception as error:
+                # Handed to the main thread, a thread that dies silently would leave the trees outdated for good
+                self._error = error
+                self._thread = None
+                self._idle.set()
+                return
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError('The next hop table failed to update its trees') from error
+
+    def build_dirty(self):
+        # Builds the missing trees and repairs the outdated ones from a snapshot of the graph, so the graph can
+        # keep changing meanwhile. Each tree is committed on its own, the ones outdated by the changes since
+        # the snapshot are repaired again by the next pass
+        while not self.paused:
+            with self._lock:
+                if not (self.dirty or self.changes):
+                    self._idle.set()
+                    return
+
+                version = self.version
+                generation = self.generation
+                log = list(self.changes)
+                incoming = [list(previous) for previous in self.incoming]
+                lengths = [dict(lengths) for lengths in self.lengths]
+
+                destinations = sorted(self.dirty)
+                outdated = [(destination, next_hops, distances, tree_version) for destination, (next_hops, distances, tree_version)
+                            in enumerate(zip(self.next_hops, self.distances, self.tree_versions))
+                            if next_hops is not None and tree_version < version]
+
+            for destination in destinations:
+                if self.paused:
+                    break
+
+                next_hops, distances = build_tree(destination, incoming, lengths)
+                if self._commit(destination, generation, version, None, next_hops, distances):
+                    self.counters['rebuilt'] += 1
+
+            merged = {}
+            for destination, base_next_hops, base_distances, tree_version in outdated:
+                if self.paused:
+                    break
+
+                changes = merged.get(tree_version)
+                if changes is None:
+                    changes = merged[tree_version] = _merge_changes(log, tree_version, lengths)
+
+                next_hops, distances = base_next_hops, base_distances
+                if self._is_affected(next_hops, distances, changes):
+                    next_hops, distances = array('i', base_next_hops), array('d', base_distances)
+                    _pad_tree(next_hops, distances, len(incoming))
+                    if self._repair(next_hops, distances, changes, incoming, lengths):
+                        self.counters['repaired'] += 1
+                    else:
+                        next_hops, distances = build_tree(destination, incoming, lengths)
+                        self.counters['rebuilt'] += 1
+
+                self._commit(destination, generation, version, base_next_hops, next_hops, distances)
+
+            # Changes every tree has seen are not needed anymore
+            with self._lock:
+                oldest = min((tree_version for tree_version, next_hops in zip(self.tree_versions, self.next_hops)
+                              if next_hops is not None), default=self.version)
+                self.changes = [entry for entry in self.changes if entry[0] > oldest]
+
+    def _commit(self, destination: int, generation: int, version: int, base, next_hops, distances) -> bool:
+        # Replaces the tree built from base (None for a missing tree) with the one up to date with version,
+        # unless it was replaced meanwhile or routes over an edge removed since the snapshot
+        with self._lock:
+            if generation != self.generation or self.next_hops[destination] is not base:
+                self.counters['discarded'] += 1
+                return False
+
+            for change_version, changes in self.changes:
+                if change_version > version and any(
+                        old_length is not None and new_length is None and i < len(next_hops) and next_hops[i] == j
+                        for i, j, old_length, new_length in changes):
+                    self.counters['discarded'] += 1
+                    return False
+
+            if next_hops is not base:
+                _pad_tree(next_hops, distances, len(self.next_hops))
+                self.next_hops[destination] = next_hops
+                self.distances[destination] = distances
+            self.tree_versions[destination] = version
+            self.dirty.discard(destination)
+            return True
+
+    def _is_affected(self, next_hops, distances, changes: list[tuple]) -> bool:
+        n = len(next_hops)
+        for i, j, old_length, new_length in changes:
+            if i >= n or j >= n:
+                return True
+            if old_length is not None and next_hops[i] == j and (new_length is None or new_length > old_length):
+                return True
+            if new_length is not None and distances[j] + new_length < distances[i]:
+                return True
+        return False
+
+    def _repair(self, next_hops, distances, changes: list[tuple], incoming: list, lengths: list[dict]) -> bool:
+        # False if a longer or removed tree edge has too many joints routed through it
+        for i, j, old_length, new_length in changes:
+            # A longer or removed tree edge changes the paths of every joint routed through it
+            if old_length is not None and next_hops[i] == j and (new_length is None or new_length > old_length):
+                if not self._repair_subtree(next_hops, distances, i, incoming, lengths):
+                    return False
+
+        # Shorter or new edges only shorten paths, which is repaired from the edge's start on
+        for i, j, _, new_length in changes:
+            if new_length is not None and distances[j] + new_length < distances[i]:
+                next_hops[i] = j
+                distances[i] = distances[j] + new_length
+                _propagate(next_hops, distances, [(distances[i], i)], incoming, lengths)
+        return True
+
+    def _repair_subtree(self, next_hops, distances, root: int, incoming: list, lengths: list[dict]) -> bool:
+        # Recomputes the joints whose path goes through root, False if there are too many of them
+        subtree = {root}
+        stack = [root]
+        while stack:
+            index = stack.pop()
+            for previous in incoming[index]:
+                if next_hops[previous] == index and previous not in subtree:
+                    if len(subtree) >= self.max_repair_size:
+                        return False
+                    subtree.add(previous)
+                    stack.append(previous)
+
+        for index in subtree:
+            next_hops[index] = -1
+            distances[index] = INFINITY
+
+        # Each joint of the subtree starts from its best road leaving the subtree, then they relax each other
+        queue = []
+        for index in subtree:
+            for next_index, length in lengths[index].items():
+                if next_index not in subtree and distances[next_index] + length < distances[index]:
+                    distances[index] = distances[next_index] + length
+                    next_hops[index] = next_index
+            if next_hops[index] != -1:
+                queue.append((distances[index], index))
+
+        heapq.heapify(queue)
+        _propagate(next_hops, distances, queue, incoming, lengths)
+        return True
+
+    def wait(self, timeout: float = None) -> bool:
+        # Blocks until every tree is up to date. Returns at once while paused, False if trees are outdated
+        if self.paused:
+            return self._idle.is_set()
+        idle = self._idle.wait(timeout)
+        self._raise_error()
+        return idle
+
+
+def _merge_changes(log: list[tuple], since: int, lengths: list[dict]) -> list[tuple]:
+    # (i, j, length before the first change after since, length in lengths) of the edges changed after since
+    old_lengths = {}
+    for version, changes in log:
+        if version > since:
+            for i, j, old_length, _ in changes:
+                old_lengths.setdefault((i, j), old_length)
+
+    merged = []
+    for (i, j), old_length in old_lengths.items():
+        new_length = lengths[i].get(j) if i < len(lengths) else None
+        if new_length != old_length:
+            merged.append((i, j, old_length, new_length))
+    return merged
+
+
+def _pad_tree(next_hops: array, distances: array, n: int):
+    # Joints added since the tree was built can't reach its destination until their edges are repaired
+    if len(next_hops) < n:
+        next_hops.extend([-1] * (n - len(next_hops)))
+        distances.extend([INFINITY] * (n - len(distances)))
+
+
+def _propagate(next_hops, distances, queue: list, incoming: list, lengths: list[dict]):
+    # Dijkstra over reversed edges from joints whose distance just got shorter
+    while queue:
+        distance, index = heapq.heappop(queue)
+        if distance > distances[index]:
+            continue
+
+        for previous in incoming[index]:
+            tentative_value = distance + lengths[previous][index]
+            if tentative_value < distances[previous]:
+                distances[previous] = tentative_value
+                next_hops[previous] = index
+                heapq.heappush(queue, (tentative_value, previous))
+
+
+def build_tree(destination: int, incoming: list, lengths: list[dict]) -> tuple[array, array]:
+    # Dijkstra from the destination over reversed edges
+    n = len(incoming)
+    next_hops = array('i', [-1]) * n
+    distances = array('d', [INFINITY]) * n
+    distances[destination] = 0
+
+    queue = [(0, destination)]
+    while queue:
+        distance, index = heapq.heappop(queue)
+        if distance > distances[index]:
+            continue
+
+        for previous in incoming[index]:
+            tentative_value = distance + lengths[previous][index]
+            if tentative_value < distances[previous]:
+                distances[previous] = tentative_value
+                next_hops[previous] = index
+                heapq.heappush(queue, (tentative_value, previous))
+
+    return next_hops, distances
+
+
+def search_path(lengths: list[dict], start_index: int, end_index: int, estimate) -> list[int] | None:
+    # A* (Dijkstra with a zero estimate) from start_index, stopped once end_index is settled.
+    # Returns the joint indexes from end_index back to start_index, None if end_index can't be reached
+    path_lengths = {start_index: 0}
+    previous_joints = {start_index: -1}
+    queue = [(estimate(start_index), 0, start_index)]
+
+    while queue:
+        _, path_length, index = heapq.heappop(queue)
+        if index == end_index:
+            break
+
+        # Stale queue entry, the joint was reached by a shorter path since
+        if path_length > path_lengths[index]:
+            continue
+
+        for neighbor, length in lengths[index].items():
+            tentative_value = path_length + length
+            if tentative_value < path_lengths.get(neighbor, INFINITY):
+                path_lengths[neighbor] = tentative_value
+                previous_joints[neighbor] = index
+                heapq.heappush(queue, (tentative_value + estimate(neighbor), tentative_value, neighbor))
+
+    if end_index not in previous_joints:
+        return None
+
+    path = []
+    index = end_index
+
+    while index != start_index:
+        path.append(index)
+        index = previous_joints[index]
+
+    path.append(start_index)
+
+    return path
+
+
+class CachedRoute:
+    # A route between two joints: the joint indexes (None if unreachable) and the waypoints built for it,
+    # one list per choice of lanes along the route
+    __slots__ = ('key', 'index_path', 'waypoints', 'size')
+
+    # Rough memory cost in bytes of an entry, an index and a waypoint (a Vector2 and its list slot)
+    ENTRY_SIZE = 400
+    INDEX_SIZE = 8
+    WAYPOINT_SIZE = 72
+
+    def __init__(self, key: tuple, index_path: list[int] | None):
+        self.key: tuple = key
+        self.index_path: list[int] | None = index_path
+        self.waypoints: dict[tuple, list] = {}
+        self.size: int = self.ENTRY_SIZE + self.INDEX_SIZE * len(index_path or ())
+
+
+class RouteCache:
+    # LRU cache of routes keyed by (start, target), within a memory budget in bytes.
+    # It listens to the changes of the graph (see RoadGraph.add_listener): the routes over a changed edge are
+    # dropped, and every route when an edge got shorter or was added, which can shorten routes anywhere
+    def __init__(self, max_bytes: int):
+        self.max_bytes: int = max_bytes
+        self.size: int = 0
+
+        self.routes: OrderedDict = OrderedDict()
+        # Keys of the cached routes through each joint
+        self.joint_routes: dict[int, set] = {}
+
+        self.counters: dict[str, int] = {
+            'hits': 0,
+            'misses': 0,
+            'waypoint_hits': 0,
+            'waypoint_misses': 0,
+            'evictions': 0,
+            'outdated': 0,
+        }
+
+    def __len__(self):
+        return len(self.routes)
+
+    def __contains__(self, key: tuple):
+        return key in self.routes
+
+    def get(self, start: int, target: int) -> CachedRoute | None:
+        route = self.routes.get((start, target))
+        if route is None:
+            self.counters['misses'] += 1
+            return None
+
+        self.routes.move_to_end((start, target))
+        self.counters['hits'] += 1
+        return route
+
+    def put(self, start: int, target: int, index_path: list[int] | None) -> CachedRoute:
+        key = (start, target)
+        if key in self.routes:
+            self._remove(key)
+
+        route = CachedRoute(key, index_path)
+        self.routes[key] = route
+        self.size += route.size
+        for index in index_path or ():
+            self.joint_routes.setdefault(index, set()).add(key)
+
+        self._evict()
+        return route
+
+    def _remove(self, key: tuple) -> CachedRoute:
+        route = self.routes.pop(key)
+        self.size -= route.size
+        for index in route.index_path or ():
+            keys = self.joint_routes[index]
+            keys.discard(key)
+            if not keys:
+                del self.joint_routes[index]
+        return route
+
+    def get_waypoints(self, route: CachedRoute, lanes: tuple) -> list | None:
+        waypoints = route.waypoints.get(lanes)
+        if waypoints is None:
+            self.counters['waypoint_misses'] += 1
+        else:
+            self.counters['waypoint_hits'] += 1
+        return waypoints
+
+    def put_waypoints(self, route: CachedRoute, lanes: tuple, waypoints: list):
+        if lanes in route.waypoints:
+            return
+
+        route.waypoints[lanes] = waypoints
+        size = CachedRoute.WAYPOINT_SIZE * len(waypoints) + CachedRoute.INDEX_SIZE * len(lanes)
+        route.size += size
+
+        # The route may already have been evicted or dropped by a put or a change in between
+        if self.routes.get(route.key) is route:
+            self.size += size
+            self._evict()
+
+    def _evict(self):
+        # Least recently used first, the most recent entry is kept even if it alone is over the budget
+        while self.size > self.max_bytes and len(self.routes) > 1:
+            self._remove(next(iter(self.routes)))
+            self.counters['evictions'] += 1
+
+    # ___ Changes reported by the graph ___________________
+
+    def joint_added(self, index: int):
+        # The roads of the new joint are reported next
+        pass
+
+    def edges_changed(self, changes: list[tuple]):
+        for i, j, old_length, new_length in changes:
+            if old_length is None or (new_length is not None and new_length < old_length):
+                self.rebuild()
+                return
+
+        # Longer, moved or removed edges only change the routes that go over them
+        outdated = set()
+        for i, j, _, _ in changes:
+            outdated.update(self.joint_routes.get(i, set()) & self.joint_routes.get(j, set()))
+
+        for key in outdated:
+            self._remove(key)
+        self.counters['outdated'] += len(outdated)
+
+    def rebuild(self):
+        self.counters['outdated'] += len(self.routes)
+        self.clear()
+
+    def clear(self):
+        self.routes.clear()
+        self.joint_routes.clear()
+        self.size = 0
+
+
+class ContractionHierarchy:
+    # Contraction hierarchy of a road graph at one version, for shortest paths on large graphs that don't change.
+    # Joints are contracted one by one, least important first (fewest shortcuts added), and shortcuts keep
+    # the distances between the remaining joints. A query searches upward from both ends only and
+    # unpacks the shortcuts of the meeting path back into roads
+    # Built from the lengths of the graph's roads at the given version, which are copied first. The hierarchy
+    # has no reference to the graph, it can be built in a worker process, see RoadGraph.build_contraction_hierarchy
+    def __init__(self, lengths: list[dict], version: int, witness_settle_limit: int = 64):
+        self.version: int = version
+        self.witness_settle_limit: int = witness_settle_limit
+
+        n = len(lengths)
+        self.n_joints: int = n
+        self.rank: list[int] = [0] * n
+
+        # Edges toward higher ranked joints: up_out[u] are (w, length) of u -> w, up_in[v] are (u, length) of u -> v
+        self.up_out: list[list[tuple]] = [[] for _ in range(n)]
+        self.up_in: list[list[tuple]] = [[] for _ in range(n)]
+        # (u, w) -> the joint a shortcut u -> w goes through
+        self.middle: dict[tuple[int, int], int] = {}
+
+        self.counters: dict[str, int] = {
+            'shortcuts': 0,
+            'queries': 0,
+            'settled': 0,
+        }
+
+        self._contract_all([dict(joint_lengths) for joint_lengths in lengths])
+
+    # ___ Preprocessing ___________________
+
+    def _contract_all(self, out: list[dict]):
+        n = self.n_joints
+        incoming = [{} for _ in range(n)]
+        for u, lengths in enumerate(out):
+            lengths.pop(u, None)
+            for v, length in lengths.items():
+                incoming[v][u] = length
+
+        contracted_neighbors = [0] * n
+        queue = [(self._get_priority(v, out, incoming, contracted_neighbors)[0], v) for v in range(n)]
+        heapq.heapify(queue)
+
+        order = 0
+        while queue:
+            _, v = heapq.heappop(queue)
+
+            # Lazy update: the priority may have grown since v was queued
+            priority, shortcuts = self._get_priority(v, out, incoming, contracted_neighbors)
+            if queue and priority > queue[0][0]:
+                heapq.heappush(queue, (priority, v))
+                continue
+
+            self._contract(v, shortcuts, out, incoming, contracted_neighbors)
+            self.rank[v] = order
+            order += 1
+
+    def _get_priority(self, v: int, out: list[dict], incoming: list[dict], contracted_neighbors: list[int]) -> tuple:
+        # Edge difference plus the contracted neighbors, which spreads the contraction uniformly.
+        # Returns the shortcuts too, they are added as they are if v is contracted now
+        shortcuts = self._find_shortcuts(v, out, incoming)
+        return len(shortcuts) - len(out[v]) - len(incoming[v]) + contracted_neighbors[v], shortcuts
+
+    def _find_shortcuts(self, v: int, out: list[dict], incoming: list[dict]) -> list[tuple]:
+        # (u, w, length) of the paths u -> v -> w without a witness path u -> w avoiding v that is as short
+        shortcuts = []
+        if not out[v] or not incoming[v]:
+            return shortcuts
+
+        longest_out = max(out[v].values())
+        for u, in_length in incoming[v].items():
+            distances = self._witness_search(u, v, in_length + longest_out, out, out[v])
+            for w, out_length in out[v].items():
+                if w != u and distances.get(w, INFINITY) > in_length + out_length:
+                    shortcuts.append((u, w, in_length + out_length))
+
+        return shortcuts
+
+    def _witness_search(self, source: int, excluded: int, max_distance: float, out: list[dict], targets) -> dict:
+        # Dijkstra from source in the remaining graph without the excluded joint, until every target is settled,
+        # limited in distance and in settled joints. Missing a witness only adds an unnecessary shortcut
+        distances = {source: 0}
+        queue = [(0, source)]
+        settled = 0
+        remaining_targets = len(targets)
+        while queue and settled < self.witness_settle_limit and remaining_targets:
+            distance, index = heapq.heappop(queue)
+            if distance > distances[index]:
+                continue
+            if distance > max_distance:
+                break
+            settled += 1
+            if index in targets:
+                remaining_targets -= 1
+
+            for next_index, length in out[index].items():
+                if next_index == excluded:
+                    continue
+                tentative_value = distance + length
+                if tentative_value < distances.get(next_index, INFINITY):
+                    distances[next_index] = tentative_value
+                    heapq.heappush(queue, (tentative_value, next_index))
+
+        return distances
+
+    def _contract(self, v: int, shortcuts: list[tuple], out: list[dict], incoming: list[dict],
+                  contracted_neighbors: list[int]):
+        # Every remaining neighbor ends up ranked above v, the edges are final by now
+        self.up_out[v] = list(out[v].items())
+        self.up_in[v] = list(incoming[v].items())
+
+        for u in incoming[v]:
+            del out[u][v]
+            contracted_neighbors[u] += 1
+        for w in out[v]:
+            del incoming[w][v]
+            contracted_neighbors[w] += 1
+        out[v] = {}
+        incoming[v] = {}
+
+        for u, w, length in shortcuts:
+            if length < out[u].get(w, INFINITY):
+                out[u][w] = length
+                incoming[w][u] = length
+                self.middle[(u, w)] = v
+                self.counters['shortcuts'] += 1
+
+    # ___ Queries ___________________
+
+    def is_up_to_date(self, destination: int) -> bool:
+        # False while the tree misses changes, it may then route longer or miss roads added since
+        return self.has_tree(destination) and self.tree_versions[destination] == self.version
+
+    def get_path(self, start_index: int, end_index: int) -> list[int] | None:
+        # Joint indexes from end_index back to start_index, like RoadGraph.get_shortest_path, None if unreachable
+        self.counters['queries'] += 1
+        if start_index == end_index:
+            return [start_index]
+
+        # (distances, parents, queue, upward edges, downward edges) of the search from the start
+        # and of the one from the end
+        forward = ({start_index: 0}, {start_index: -1}, [(0, start_index)], self.up_out, self.up_in)
+        backward = ({end_index: 0}, {end_index: -1}, [(0, end_index)], self.up_in, self.up_out)
+        best = INFINITY
+        meeting = -1
+
+        searching = True
+        while searching:
+            searching = False
+            for (distances, parents, queue, edges, stall_edges), other in ((forward, backward), (backward, forward)):
+                # A direction stops once nothing in its queue can lead to a shorter meeting
+                if not queue or queue[0][0] >= best:
+                    continue
+                searching = True
+
+                distance, index = heapq.heappop(queue)
+                if distance > distances[index]:
+                    continue
+                self.counters['settled'] += 1
+
+                other_distance = other[0].get(index)
+                if other_distance is not None and distance + other_distance < best:
+                    best = distance + other_distance
+                    meeting = index
+
+                # Stall on demand: a higher joint already reached reaches this one shorter,
+                # so nothing found from here can be on the shortest path
+                if any(distances.get(higher_index, INFINITY) + length < distance
+                       for higher_index, length in stall_edges[index]):
+                    continue
+
+                for next_index, length in edges[index]:
+                    tentative_value = distance + length
+                    if tentative_value < distances.get(next_index, INFINITY):
+                        distances[next_index] = tentative_value
+                        parents[next_index] = index
+                        heapq.heappush(queue, (tentative_value, next_index))
+
+        if meeting == -1:
+            return None
+
+        # Joints of the upward path start -> meeting and of the downward path meeting -> end
+        route = []
+        index = meeting
+        while index != -1:
+            route.append(index)
+            index = forward[1][index]
+        route.reverse()
+
+        index = backward[1][meeting]
+        while index != -1:
+            route.append(index)
+            index = backward[1][index]
+
+        path = [route[0]]
+        for k in range(len(route) - 1):
+            self._unpack(route[k], route[k + 1], path)
+
+        path.reverse()
+        return path
+
+    def _unpack(self, start: int, end: int, path: list[int]):
+        # Appends the joints after start up to end, replacing shortcuts by the roads they stand for
+        stack = [(start, end)]
+        while stack:
+            start, end = stack.pop()
+            middle = self.middle.get((start, end))
+            if middle is None:
+                path.append(end)
+            else:
+                stack.append((middle, end))
+                stack.append((start, middle))
+
+
+# ___ Batch planning ___________________
+# Worker processes hold a read-only snapshot of the graph, set once by the pool initializer
+
+_snapshot: tuple | None = None
+
+
+def _set_snapshot(snapshot: tuple):
+    global _snapshot
+    _snapshot = snapshot
+
+
+def _plan_chunk(requests: list[tuple]) -> list[list[int] | None]:
+    xs, ys, lengths, heuristic, hierarchy = _snapshot
+    if hierarchy is not None:
+        return [hierarchy.get_path(start, target) for start, target in requests]
+
+    routes = []
+    for start, target in requests:
+        target_x = xs[target]
+        target_y = ys[target]
+        if heuristic:
+            def estimate(index: int) -> float:
+                return math.hypot(target_x - xs[index], target_y - ys[index])
+        else:
+            def estimate(index: int) -> float:
+                return 0
+
+        routes.append(search_path(lengths, start, target, estimate))
+    return routes
+
+
+class BatchRoutePlanner:
+    # Plans many (start, target) routes at once, e.g. for every car spawned together. Large batches are split
+    # across a pool of worker processes, each holding a snapshot of the graph taken when the pool was started.
+    # The pool is restarted once the graph changed. Like RoadGraph.get_route, the workers query the contraction
+    # hierarchy while it is up to date, it is part of the snapshot. Batches smaller than min_batch_size, and
+    # graphs with a next hop table (whose lookups cost less than sending the request), are planned in process
+    def __init__(self, graph, workers: int = None, min_batch_size: int = 64, heuristic: bool = True):
+        self.graph = graph
+        self.workers: int = workers or os.cpu_count() or 1
+        self.min_batch_size: int = min_batch_size
+        self.heuristic: bool = heuristic
+
+        self._pool: ProcessPoolExecutor | None = None
+        self._pool_version = None
+        self._pool_hierarchy: ContractionHierarchy | None = None
+
+        self.counters: dict[str, int] = {
+            'batches': 0,
+            'in_process': 0,
+            'in_pool': 0,
+            'pool_starts': 0,
+        }
+
+    def plan(self, requests: list[tuple]) -> list[list[int] | None]:
+        # Routes in the order of the requests, in the format of RoadGraph.get_route
+        self.counters['batches'] += 1
+        if len(requests) < self.min_batch_size or self.workers < 2 or self.graph.routing is not None:
+            self.counters['in_process'] += len(requests)
+            return [self.graph.get_route(start, target) for start, target in requests]
+
+        pool = self._get_pool()
+        chunk_size = -(-len(requests) // (4 * self.workers))
+        chunks = [requests[k:k + chunk_size] for k in range(0, len(requests), chunk_size)]
+
+        routes = []
+        for chunk_routes in pool.map(_plan_chunk, chunks):
+            routes.extend(chunk_routes)
+
+        self.counters['in_pool'] += len(requests)
+        return routes
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        # A hierarchy built after the pool was started is sent to new workers too
+        hierarchy = self.graph.hierarchy
+        if hierarchy is not None and hierarchy.version != self.graph.version:
+            hierarchy = None
+
+        if (self._pool is not None and self._pool_version == self.graph.version
+                and self._pool_hierarchy is hierarchy):
+            return self._pool
+
+        self.close()
+        snapshot = ([joint.x for joint in self.graph.joints], [joint.y for joint in self.graph.joints],
+                    [dict(lengths) for lengths in self.graph.lengths], self.heuristic, hierarchy)
+        self._pool = ProcessPoolExecutor(self.workers, initializer=_set_snapshot, initargs=(snapshot,))
+        self._pool_version = self.graph.version
+        self._pool_hierarchy = hierarchy
+        self.counters['pool_starts'] += 1
+        return self._pool
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
@@ -0,0 +1,582 @@
+import math
+
+
+def aabb_overlap(a: tuple, b: tuple) -> bool:
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+class SpatialHash:
+    # Uniform grid broad phase: objects are bucketed by the cells their AABB covers,
+    # only objects sharing a cell become candidate pairs
+    def __init__(self, cell_size: float):
+        self.cell_size: float = cell_size
+
+        self.cells: dict[tuple[int, int], set] = {}
+        self.object_cells: dict = {}
+
+        self.counters: dict[str, int] = {
+            'objects': 0,
+            'rebucketed': 0,
+            'candidate_pairs': 0,
+            'narrow_tests': 0,
+            'collisions': 0,
+        }
+
+    def __len__(self):
+        return len(self.object_cells)
+
+    def __contains__(self, obj):
+        return obj in self.object_cells
+
+    def reset_counters(self):
+        for key in self.counters:
+            self.counters[key] = 0
+        self.counters['objects'] = len(self.object_cells)
+
+    def _get_cell_range(self, aabb: tuple):
+        inverse = 1 / self.cell_size
+        return (math.floor(aabb[0] * inverse), math.floor(aabb[1] * inverse),
+                math.floor(aabb[2] * inverse), math.floor(aabb[3] * inverse))
+
+    def _bucket(self, obj, cell_range: tuple):
+        min_x, min_y, max_x, max_y = cell_range
+        for x in range(min_x, max_x + 1):
+            for y in range(min_y, max_y + 1):
+                cell = self.cells.get((x, y))
+                if cell is None:
+                    self.cells[(x, y)] = {obj}
+                else:
+                    cell.add(obj)
+
+    def _unbucket(self, obj, cell_range: tuple):
+        min_x, min_y, max_x, max_y = cell_range
+        for x in range(min_x, max_x + 1):
+            for y in range(min_y, max_y + 1):
+                cell = self.cells[(x, y)]
+                cell.discard(obj)
+                if not cell:
+                    del self.cells[(x, y)]
+
+    def insert(self, obj, aabb: tuple = None):
+        # aabb overrides the object's own bounds, e.g. with bounds grown by a margin
+        if obj in self.object_cells:
+            self.update(obj, aabb)
+            return
+
+        cell_range = self._get_cell_range(aabb or obj.get_aabb())
+        self.object_cells[obj] = cell_range
+        self._bucket(obj, cell_range)
+
+    def remove(self, obj):
+        cell_range = self.object_cells.pop(obj, None)
+        if cell_range is not None:
+            self._unbucket(obj, cell_range)
+
+    def update(self, obj, aabb: tuple = None):
+        # Re-buckets the object only if it moved into a different set of cells
+        cell_range = self._get_cell_range(aabb or obj.get_aabb())
+        old_cell_range = self.object_cells[obj]
+        if cell_range == old_cell_range:
+            return
+
+        self._unbucket(obj, old_cell_range)
+        self._bucket(obj, cell_range)
+        self.object_cells[obj] = cell_range
+        self.counters['rebucketed'] += 1
+
+    def rebuild(self, cell_size: float = None):
+        if cell_size:
+            self.cell_size = cell_size
+
+        objects = list(self.object_cells)
+        self.clear()
+        for obj in objects:
+            self.insert(obj)
+
+    def clear(self):
+        self.cells.clear()
+        self.object_cells.clear()
+
+    def query_aabb(self, aabb: tuple) -> set:
+        found = set()
+        min_x, min_y, max_x, max_y = self._get_cell_range(aabb)
+        for x in range(min_x, max_x + 1):
+            for y in range(min_y, max_y + 1):
+                cell = self.cells.get((x, y))
+                if cell:
+                    found |= cell
+        return found
+
+    def get_candidate_pairs(self) -> set:
+        pairs = set()
+        for cell in self.cells.values():
+            if len(cell) < 2:
+                continue
+
+            cell_objects = list(cell)
+            for i, obj in enumerate(cell_objects):
+                for obj2 in cell_objects[i + 1:]:
+                    if id(obj) < id(obj2):
+                        pairs.add((obj, obj2))
+                    else:
+                        pairs.add((obj2, obj))
+
+        self.counters['candidate_pairs'] += len(pairs)
+        return pairs
+
+
+class PointGrid:
+    # Uniform grid over points keyed by an id (e.g. the joints of a road graph), for nearest and radius queries.
+    # Cells are searched in growing square rings around the query, until no closer point can be left
+    def __init__(self, cell_size: float):
+        self.cell_size: float = cell_size
+
+        self.cells: dict[tuple[int, int], list] = {}
+        self.points: dict = {}
+        # Range of the cells ever used, rings past it are empty
+        self.bounds: tuple | None = None
+
+    def __len__(self):
+        return len(self.points)
+
+    def __contains__(self, key):
+        return key in self.points
+
+    def _get_cell(self, x: float, y: float) -> tuple[int, int]:
+        inverse = 1 / self.cell_size
+        return math.floor(x * inverse), math.floor(y * inverse)
+
+    def insert(self, key, x: float, y: float):
+        if key in self.points:
+            self.move(key, x, y)
+            return
+
+        cell = self._get_cell(x, y)
+        self.points[key] = (x, y, cell)
+        self.cells.setdefault(cell, []).append(key)
+
+        if self.bounds is None:
+            self.bounds = cell + cell
+        else:
+            min_x, min_y, max_x, max_y = self.bounds
+            self.bounds = min(min_x, cell[0]), min(min_y, cell[1]), max(max_x, cell[0]), max(max_y, cell[1])
+
+    def remove(self, key):
+        point = self.points.pop(key, None)
+        if point is None:
+            return
+
+        cell = self.cells[point[2]]
+        cell.remove(key)
+        if not cell:
+            del self.cells[point[2]]
+
+    def move(self, key, x: float, y: float):
+        if self._get_cell(x, y) == self.points[key][2]:
+            self.points[key] = (x, y, self.points[key][2])
+            return
+
+        self.remove(key)
+        self.insert(key, x, y)
+
+    def clear(self):
+        self.cells.clear()
+        self.points.clear()
+        self.bounds = None
+
+    def _get_ring(self, center: tuple[int, int], ring: int):
+        # Keys in the cells at exactly `ring` cells (Chebyshev distance) from center
+        center_x, center_y = center
+        for x in range(center_x - ring, center_x + ring + 1):
+            step = 1 if x in (center_x - ring, center_x + ring) else 2 * ring
+            for y in range(center_y - ring, center_y + ring + 1, step or 1):
+                cell = self.cells.get((x, y))
+                if cell:
+                    yield from cell
+
+    def _get_max_ring(self, center: tuple[int, int]) -> int:
+        min_x, min_y, max_x, max_y = self.bounds
+        return max(center[0] - min_x, max_x - center[0], center[1] - min_y, max_y - center[1])
+
+    def query_radius(self, x: float, y: float, radius: float) -> list:
+        # Keys of the points within radius of (x, y), in no particular order
+        found = []
+        min_x, min_y = self._get_cell(x - radius, y - radius)
+        max_x, max_y = self._get_cell(x + radius, y + radius)
+        for cell_x in range(min_x, max_x + 1):
+            for cell_y in range(min_y, max_y + 1):
+                for key in self.cells.get((cell_x, cell_y), ()):
+                    point_x, point_y, _ = self.points[key]
+                    if math.hypot(point_x - x, point_y - y) <= radius:
+                        found.append(key)
+        return found
+
+    def k_nearest(self, x: float, y: float, k: int) -> list:
+        # Keys of the k points closest to (x, y), closest first, ties by key
+        if not self.points or k <= 0:
+            return []
+
+        center = self._get_cell(x, y)
+        max_ring = self._get_max_ring(center)
+        best = []
+        for ring in range(max_ring + 1):
+            for key in self._get_ring(center, ring):
+                point_x, point_y, _ = self.points[key]
+                best.append((math.hypot(point_x - x, point_y - y), key))
+
+            best.sort()
+            del best[k:]
+            # Points of the next rings are at least `ring` whole cells away
+            if len(best) == k and best[-1][0] <= ring * self.cell_size:
+                break
+
+        return [key for _, key in best]
+
+    def nearest(self, x: float, y: float):
+        # Key of the point closest to (x, y), None if there are no points
+        found = self.k_nearest(x, y, 1)
+        return found[0] if found else None
+
+
+class ContactCache:
+    # Persistent proximity pairs over a SpatialHash. Objects are bucketed by their AABB grown by a margin
+    # and only re-bucketed once they leave it, pairs of overlapping grown AABBs are kept between steps.
+    # Each step only the kept pairs are tested again, which gives one enter, stay or exit event per pair
+    def __init__(self, broad_phase: SpatialHash, margin: float, static_tree=None):
+        self.broad_phase: SpatialHash = broad_phase
+        self.margin: float = margin
+        self.static_tree = static_tree
+
+        self.fat_aabbs: dict = {}
+        self.partners: dict = {}
+        self.pairs: set = set()
+        self.contacts: set = set()
+
+        self.counters: dict[str, int] = {
+            'pairs': 0,
+            'new_pairs': 0,
+            'refitted': 0,
+            'entered': 0,
+            'exited': 0,
+        }
+
+    def __contains__(self, obj):
+        return obj in self.fat_aabbs
+
+    def reset_counters(self):
+        for key in self.counters:
+            self.counters[key] = 0
+        self.counters['pairs'] = len(self.pairs)
+
+    def _fatten(self, aabb: tuple) -> tuple:
+        margin = self.margin
+        return aabb[0] - margin, aabb[1] - margin, aabb[2] + margin, aabb[3] + margin
+
+    def _get_fat_aabb(self, obj) -> tuple:
+        # Static objects do not move, their own AABB is used as is
+        fat_aabb = self.fat_aabbs.get(obj)
+        return fat_aabb if fat_aabb is not None else obj.get_aabb()
+
+    def _add_pair(self, obj, obj2):
+        pair = (obj, obj2) if id(obj) < id(obj2) else (obj2, obj)
+        if pair in self.pairs:
+            return
+
+        self.pairs.add(pair)
+        self.partners.setdefault(obj, set()).add(obj2)
+        self.partners.setdefault(obj2, set()).add(obj)
+        self.counters['new_pairs'] += 1
+
+    def _remove_pair(self, obj, obj2):
+        self.pairs.discard((obj, obj2) if id(obj) < id(obj2) else (obj2, obj))
+        for first, second in ((obj, obj2), (obj2, obj)):
+            partners = self.partners.get(first)
+            if partners is not None:
+                partners.discard(second)
+                if not partners:
+                    del self.partners[first]
+
+    def _remove_pairs_of(self, obj):
+        for other in list(self.partners.get(obj, ())):
+            self._remove_pair(obj, other)
+
+    def _find_pairs(self, obj, fat_aabb: tuple):
+        for other in self.broad_phase.query_aabb(fat_aabb):
+            if other is not obj and aabb_overlap(fat_aabb, self.fat_aabbs[other]):
+                self._add_pair(obj, other)
+
+        if self.static_tree is not None and obj in self.fat_aabbs:
+            for other in self.static_tree.query_aabb(fat_aabb):
+                if other is not obj:
+                    self._add_pair(obj, other)
+
+    def insert(self, obj):
+        if obj in self.fat_aabbs:
+            self.update(obj)
+            return
+
+        fat_aabb = self._fatten(obj.get_aabb())
+        self.fat_aabbs[obj] = fat_aabb
+        self.broad_phase.insert(obj, fat_aabb)
+        self._find_pairs(obj, fat_aabb)
+
+    def remove(self, obj):
+        # Contacts of removed objects are reported as exited by the next update_contacts
+        if self.fat_aabbs.pop(obj, None) is not None:
+            self.broad_phase.remove(obj)
+        self._remove_pairs_of(obj)
+
+    def discard_contacts(self, objects: set):
+        # Forgets the contacts of removed objects without reporting them as exited. For objects that are gone
+        # for good and may come back as new ones, whose contacts then have to enter again
+        self.contacts = {pair for pair in self.contacts if pair[0] not in objects and pair[1] not in objects}
+
+    def update(self, obj):
+        # Refits the grown AABB once the object's AABB leaves it, then drops and finds pairs for it only
+        aabb = obj.get_aabb()
+        fat_aabb = self.fat_aabbs[obj]
+        if fat_aabb[0] <= aabb[0] and fat_aabb[1] <= aabb[1] and aabb[2] <= fat_aabb[2] and aabb[3] <= fat_aabb[3]:
+            return
+
+        fat_aabb = self._fatten(aabb)
+        self.fat_aabbs[obj] = fat_aabb
+        self.broad_phase.update(obj, fat_aabb)
+        self.counters['refitted'] += 1
+
+        for other in list(self.partners.get(obj, ())):
+            if not aabb_overlap(fat_aabb, self._get_fat_aabb(other)):
+                self._remove_pair(obj, other)
+        self._find_pairs(obj, fat_aabb)
+
+    def add_static(self, obj):
+        # Has to be called after obj was inserted into the static tree
+        self._find_pairs(obj, obj.get_aabb())
+
+    def remove_static(self, obj):
+        self._remove_pairs_of(obj)
+
+    def refresh_static(self, obj):
+        # Has to be called after a static object was moved or rotated
+        self._remove_pairs_of(obj)
+        self.add_static(obj)
+
+    def rebuild(self, cell_size: float = None):
+        if cell_size:
+            self.broad_phase.cell_size = cell_size
+
+        self.broad_phase.clear()
+        for obj, fat_aabb in self.fat_aabbs.items():
+            self.broad_phase.insert(obj, fat_aabb)
+
+    def clear(self):
+        for obj in list(self.fat_aabbs):
+            self.remove(obj)
+
+    def update_contacts(self, test: callable) -> tuple[list, list, list]:
+        # test takes a list of pairs and returns the colliding ones.
+        # Returns the (entered, stayed, exited) pairs since the last call
+        candidates = [(obj, obj2) for obj, obj2 in self.pairs if aabb_overlap(obj.get_aabb(), obj2.get_aabb())]
+        self.broad_phase.counters['candidate_pairs'] += len(self.pairs)
+        self.broad_phase.counters['narrow_tests'] += len(candidates)
+
+        touching = test(candidates) if candidates else []
+
+        entered = [pair for pair in touching if pair not in self.contacts]
+        stayed = [pair for pair in touching if pair in self.contacts]
+
+        touching = set(touching)
+        exited = [pair for pair in self.contacts if pair not in touching]
+        self.contacts = touching
+
+        self.counters['entered'] += len(entered)
+        self.counters['exited'] += len(exited)
+        return entered, stayed, exited
+
+
+def aabb_union(a: tuple, b: tuple) -> tuple:
+    return min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])
+
+
+def _aabb_area(aabb: tuple) -> float:
+    return (aabb[2] - aabb[0]) * (aabb[3] - aabb[1])
+
+
+def aabb_overlaps_obb(aabb: tuple, vertices: tuple) -> bool:
+    # Separating axis test between an AABB and a convex quad given by its 4 vertices
+    xs = [vertex.x for vertex in vertices]
+    ys = [vertex.y for vertex in vertices]
+    if max(xs) < aabb[0] or min(xs) > aabb[2] or max(ys) < aabb[1] or min(ys) > aabb[3]:
+        return False
+
+    corners = ((aabb[0], aabb[1]), (aabb[2], aabb[1]), (aabb[2], aabb[3]), (aabb[0], aabb[3]))
+    for i in range(2):
+        edge_start = vertices[i]
+        edge_end = vertices[i + 1]
+        axis_x = edge_start.y - edge_end.y
+        axis_y = edge_end.x - edge_start.x
+
+        projections = [vertex.x * axis_x + vertex.y * axis_y for vertex in vertices]
+        box_projections = [x * axis_x + y * axis_y for x, y in corners]
+        if max(box_projections) < min(projections) or min(box_projections) > max(projections):
+            return False
+
+    return True
+
+
+class _BVHNode:
+    __slots__ = ('aabb', 'left', 'right', 'parent', 'obj')
+
+    def __init__(self, aabb: tuple, left=None, right=None, obj=None):
+        self.aabb: tuple = aabb
+        self.left: _BVHNode | None = left
+        self.right: _BVHNode | None = right
+        self.parent: _BVHNode | None = None
+        self.obj = obj
+
+
+class BoundingVolumeHierarchy:
+    # AABB tree over objects that rarely move. Built once, moved objects are refitted in place
+    def __init__(self, objects: list = ()):
+        self.root: _BVHNode | None = None
+        self.leaves: dict = {}
+
+        self.rebuild(objects)
+
+    def __len__(self):
+        return len(self.leaves)
+
+    def __contains__(self, obj):
+        return obj in self.leaves
+
+    def __iter__(self):
+        return iter(self.leaves)
+
+    def rebuild(self, objects: list = None):
+        if objects is None:
+            objects = list(self.leaves)
+
+        self.leaves = {}
+        leaves = []
+        for obj in objects:
+            leaf = _BVHNode(obj.get_aabb(), obj=obj)
+            self.leaves[obj] = leaf
+            leaves.append(leaf)
+
+        self.root = self._build(leaves) if leaves else None
+
+    def _build(self, leaves: list[_BVHNode]) -> _BVHNode:
+        if len(leaves) == 1:
+            return leaves[0]
+
+        # Median split along the longest axis of the leaf centers
+        centers_x = [leaf.aabb[0] + leaf.aabb[2] for leaf in leaves]
+        centers_y = [leaf.aabb[1] + leaf.aabb[3] for leaf in leaves]
+        if max(centers_x) - min(centers_x) >= max(centers_y) - min(centers_y):
+            leaves.sort(key=lambda leaf: leaf.aabb[0] + leaf.aabb[2])
+        else:
+            leaves.sort(key=lambda leaf: leaf.aabb[1] + leaf.aabb[3])
+
+        middle = len(leaves) // 2
+        left = self._build(leaves[:middle])
+        right = self._build(leaves[middle:])
+
+        node = _BVHNode(aabb_union(left.aabb, right.aabb), left, right)
+        left.parent = node
+        right.parent = node
+        return node
+
+    def insert(self, obj):
+        # Adds a leaf next to the sibling whose bounds grow the least, without rebalancing the tree
+        leaf = _BVHNode(obj.get_aabb(), obj=obj)
+        self.leaves[obj] = leaf
+
+        if self.root is None:
+            self.root = leaf
+            return
+
+        sibling = self.root
+        while sibling.obj is None:
+            left_growth = _aabb_area(aabb_union(sibling.left.aabb, leaf.aabb)) - _aabb_area(sibling.left.aabb)
+            right_growth = _aabb_area(aabb_union(sibling.right.aabb, leaf.aabb)) - _aabb_area(sibling.right.aabb)
+            sibling = sibling.left if left_growth <= right_growth else sibling.right
+
+        parent = sibling.parent
+        node = _BVHNode(aabb_union(sibling.aabb, leaf.aabb), sibling, leaf)
+        node.parent = parent
+        sibling.parent = node
+        leaf.parent = node
+
+        if parent is None:
+            self.root = node
+        elif parent.left is sibling:
+            parent.left = node
+        else:
+            parent.right = node
+
+        self._refit_ancestors(node)
+
+    def remove(self, obj):
+        leaf = self.leaves.pop(obj, None)
+        if leaf is None:
+            return
+
+        parent = leaf.parent
+        if parent is None:
+            self.root = None
+            return
+
+        # The sibling takes the place of the removed leaf's parent
+        sibling = parent.right if parent.left is leaf else parent.left
+        grandparent = parent.parent
+        sibling.parent = grandparent
+
+        if grandparent is None:
+            self.root = sibling
+        else:
+            if grandparent.left is parent:
+                grandparent.left = sibling
+            else:
+                grandparent.right = sibling
+            self._refit_ancestors(grandparent)
+
+    def _refit_ancestors(self, node: _BVHNode):
+        while node is not None:
+            if node.obj is None:
+                node.aabb = aabb_union(node.left.aabb, node.right.aabb)
+            node = node.parent
+
+    def refit(self, obj):
+        # Updates the object's leaf and the bounds of its ancestors after it moved or rotated
+        node = self.leaves[obj]
+        node.aabb = obj.get_aabb()
+        self._refit_ancestors(node.parent)
+
+    def _query(self, overlaps: callable) -> list:
+        found = []
+        if self.root is None:
+            return found
+
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if not overlaps(node.aabb):
+                continue
+
+            if node.obj is not None:
+                found.append(node.obj)
+            else:
+                stack.append(node.left)
+                stack.append(node.right)
+
+        return found
+
+    def query_point(self, x: float, y: float = None) -> list:
+        if y is None:
+            x, y = x.x, x.y
+        return self._query(lambda aabb: aabb[0] <= x <= aabb[2] and aabb[1] <= y <= aabb[3])
+
+    def query_aabb(self, aabb: tuple) -> list:
+        return self._query(lambda node_aabb: aabb_overlap(node_aabb, aabb))
+
+    def query_obb(self, vertices: tuple) -> list:
+        return self._query(lambda node_aabb: aabb_overlaps_obb(node_aabb, vertices))
@@ -0,0 +1,130 @@
+import os
+import random
+import time
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+import city
+import settings
+from maps import Blueprints
+from physics import Vector2
+
+
+def _get_pathfinding(joints: list[Vector2], matrix: list[list], pool_size: int = 0,
+                     agents: list = None) -> city.CityPathfinding:
+    # CityPathfinding is a singleton, every test initializes it again over its own roads
+    random.seed(0)
+    roads = city.RoadGraph(joints, matrix)
+    pathfinding = city.CityPathfinding(agents or [], [], roads, roads, [Blueprints.car_p])
+    pathfinding.car_pool = city.CarPool(pool_size) if pool_size else None
+    return pathfinding
+
+
+def test_respawned_pooled_cars_crash_again():
+    # Two joints closer than a car, the cars spawned on them overlap right away
+    pathfinding = _get_pathfinding([Vector2(0, 0), Vector2(20, 0)], [[0, 1], [1, 0]], pool_size=8)
+
+    first_cars = pathfinding.spawn_agents(density=1)
+    pathfinding.update(1 / 60)
+    assert not any(car.active for car in first_cars)
+
+    pathfinding.clear_agents()
+    cars = pathfinding.spawn_agents(density=1)
+    assert set(cars) == set(first_cars)
+    assert all(car.active for car in cars)
+
+    pathfinding.update(1 / 60)
+    assert not any(car.active for car in cars)
+
+
+def _get_routed_car() -> tuple[city.CityPathfinding, city.Car]:
+    # A car at the start of a straight road through three joints, routed to its end
+    car = Blueprints.car_p.get_car(position=Vector2(0, 0))
+    pathfinding = _get_pathfinding([Vector2(0, 0), Vector2(1000, 0), Vector2(2000, 0)],
+                                   [[0, 1, 0], [1, 0, 1], [0, 1, 0]], agents=[car])
+    pathfinding._set_agent_path(car, pathfinding.roads, 2)
+    assert car.path_target == 2
+    assert car in pathfinding.road_agents[(1, 2)]
+    return pathfinding, car
+
+
+def test_hand_set_path_is_not_replanned_after_road_edit():
+    pathfinding, car = _get_routed_car()
+
+    hand_path = [Vector2(0, 500)]
+    car.set_path(hand_path)
+    assert not any(car in agents for agents in pathfinding.road_agents.values())
+
+    pathfinding.roads.set_joint_position(1, Vector2(1000, 50))
+    pathfinding.update(1 / 60)
+    assert car.waypoints is hand_path
+
+
+def test_path_set_by_hand_after_road_edit_is_kept():
+    pathfinding, car = _get_routed_car()
+
+    pathfinding.roads.set_joint_position(1, Vector2(1000, 50))
+    assert car in pathfinding.replanning
+
+    hand_path = [Vector2(0, 500)]
+    car.set_path(hand_path)
+    pathfinding.update(1 / 60)
+    assert car.waypoints is hand_path
+
+
+def test_car_on_edited_road_is_replanned_to_same_target():
+    car = Blueprints.car_p.get_car(position=Vector2(0, 0))
+    joints = [Vector2(0, 0), Vector2(1000, 0), Vector2(2000, 0), Vector2(3000, 0)]
+    pathfinding = _get_pathfinding(joints, [[0, 1, 0, 0], [1, 0, 1, 0], [0, 1, 0, 1], [0, 0, 1, 0]], agents=[car])
+    pathfinding._set_agent_path(car, pathfinding.roads, 3)
+
+    pathfinding.roads.set_joint_position(1, Vector2(1000, 50))
+    assert car in pathfinding.replanning
+    pathfinding.update(1 / 60)
+
+    assert car.path_target == 3
+    assert car.path_roads[-1] == (2, 3)
+    assert car.waypoints[-1].dist(joints[3]) < 100
+
+
+def test_route_from_outdated_tree_is_not_cached():
+    # A road removed from the middle of a line and added back while the next hop table is paused
+    n = 200
+    pathfinding = _get_pathfinding([Vector2(100 * i, 0) for i in range(n)],
+                                   [[int(abs(i - j) == 1) for j in range(n)] for i in range(n)])
+    roads = pathfinding.roads
+    roads.set_lanes(100, 101, 0)
+    assert roads.routing.wait(5)
+
+    roads.routing.pause()
+    roads.set_lanes(100, 101, 1)
+    first_car = Blueprints.car_p.get_car(position=Vector2(0, 0))
+    pathfinding._set_agent_path(first_car, roads, 150)
+    assert (0, 150) not in roads.route_cache
+
+    roads.routing.resume()
+    assert roads.routing.wait(5)
+    car = Blueprints.car_p.get_car(position=Vector2(0, 0))
+    pathfinding._set_agent_path(car, roads, 150)
+    assert car.path_target == 150
+    assert roads.route_cache.get(0, 150).index_path == list(range(150, -1, -1))
+
+
+def test_contraction_hierarchy_is_built_when_the_simulation_starts(monkeypatch):
+    monkeypatch.setattr(settings, 'next_hop_routing', False)
+    monkeypatch.setattr(settings, 'contraction_hierarchy_min_joints', 2)
+    pathfinding = _get_pathfinding([Vector2(100 * i, 0) for i in range(4)],
+                                   [[int(abs(i - j) == 1) for j in range(4)] for i in range(4)])
+    roads = pathfinding.roads
+    assert roads.hierarchy is None
+
+    for _ in range(2):
+        pathfinding.prepare_routes()
+        deadline = time.time() + 30
+        while (roads.hierarchy is None or roads.hierarchy.version != roads.version) and time.time() < deadline:
+            time.sleep(0.01)
+        assert roads.hierarchy.version == roads.version
+        assert roads.get_route(0, 3) == [3, 2, 1, 0]
+
+        # Edited roads get a new hierarchy the next time the simulation starts
+        roads.set_joint_position(1, Vector2(100, 10))
@@ -0,0 +1,48 @@
+import random
+
+import pytest
+
+import kernels
+
+# Both backends run on the same random inputs and must return identical results
+pytestmark = pytest.mark.skipif(not kernels.NUMBA_AVAILABLE, reason='numba is not installed')
+
+CASES = 2000
+
+
+@pytest.fixture(scope='module')
+def compiled() -> dict:
+    return kernels._get_numba_kernels()
+
+
+def test_segments_intersect_parity(compiled):
+    rng = random.Random(0)
+    for _ in range(CASES):
+        arguments = tuple(rng.choice((rng.uniform(-100, 100), float(rng.randint(-3, 3)))) for _ in range(8))
+        assert compiled['segments_intersect'](*arguments) == kernels._segments_intersect(*arguments), arguments
+
+
+def test_path_segments_parity(compiled):
+    rng = random.Random(1)
+    for _ in range(CASES):
+        n = rng.randint(1, 12)
+        xs = [rng.uniform(-500, 500) for _ in range(n)]
+        ys = [rng.uniform(-500, 500) for _ in range(n)]
+        if rng.random() < 0.5:
+            # Waypoints along a straight road, which make long runs
+            ys = [ys[0] + 0.01 * rng.uniform(-1, 1) for _ in range(n)]
+            xs.sort()
+
+        min_difference = rng.choice((0.04, 0.5, 2.0))
+        expected = kernels._path_segments(xs, ys, min_difference)
+        result = compiled['path_segments'](kernels._as_array(xs), kernels._as_array(ys), min_difference)
+        assert tuple(list(values) for values in result) == expected, (xs, ys, min_difference)
+
+
+def test_lane_points_parity(compiled):
+    rng = random.Random(2)
+    for _ in range(CASES):
+        arguments = (rng.uniform(-2000, 2000), rng.uniform(-2000, 2000), rng.uniform(-2000, 2000),
+                     rng.uniform(-2000, 2000), 80 * (0.5 + rng.randint(0, 3)), rng.choice((128.0, 100.0, 7.5)))
+        xs, ys = compiled['lane_points'](*arguments)
+        assert (list(xs), list(ys)) == kernels._lane_points(*arguments), arguments
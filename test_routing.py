@@ -0,0 +1,63 @@
+import os
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+import pytest
+
+import city
+from physics import Vector2
+from routing import build_tree
+
+
+def _get_line(n: int) -> city.RoadGraph:
+    # Two way roads along a line of n joints
+    matrix = [[int(abs(i - j) == 1) for j in range(n)] for i in range(n)]
+    return city.RoadGraph([Vector2(100 * i, 0) for i in range(n)], matrix)
+
+
+def test_trees_are_repaired_from_a_consistent_snapshot():
+    graph = _get_line(6)
+    table = graph.enable_routing(background=False)
+    table.pause()
+    graph.set_lanes(2, 3, 0)
+    graph.add_joint(Vector2(600, 0), 5)
+
+    # The state the background thread may see while set_lanes is halfway through removing a road
+    length = graph.lengths[4].pop(3)
+    table.resume()
+    graph.lengths[4][3] = length
+
+    for destination in range(graph.n_joints):
+        _, distances = build_tree(destination, graph.incoming, graph.lengths)
+        assert list(table.distances[destination]) == list(distances)
+    assert table.get_path(0, 3) is None
+    assert table.get_path(6, 3) == [3, 4, 5, 6]
+
+
+def test_background_error_is_raised_on_the_main_thread():
+    graph = _get_line(4)
+    table = graph.enable_routing()
+    assert table.wait(5)
+
+    def fail():
+        raise ValueError('broken tree')
+
+    table.build_dirty = fail
+    graph.set_lanes(1, 2, 0)
+    with pytest.raises(RuntimeError) as error:
+        table.wait(5)
+    assert isinstance(error.value.__cause__, ValueError)
+
+
+def test_outdated_tree_does_not_report_re_added_road_as_unreachable():
+    graph = _get_line(200)
+    table = graph.enable_routing()
+    graph.set_lanes(100, 101, 0)
+    assert table.wait(5)
+    assert graph.get_route(0, 150) is None
+
+    table.pause()
+    graph.set_lanes(100, 101, 1)
+    assert not table.is_up_to_date(150)
+    assert graph.get_route(0, 150) == list(range(150, -1, -1))
+    table.resume()
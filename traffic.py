@@ -0,0 +1,170 @@
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+NUMPY_AVAILABLE = np is not None
+
+
+class LaneOccupancy:
+    # Cars on each lane sorted by their arc length along it, rebuilt in one vectorized sort per step.
+    # A lane is (i, j, lane), the key of RoadGraph.get_lane_points, all of its cars drive the same way.
+    # The leader of a car is the next one along its lane, or the rearmost one on the next lane of its route
+    def __init__(self):
+        if not NUMPY_AVAILABLE:
+            raise ImportError('LaneOccupancy requires numpy')
+
+        self.lane_ids: dict[tuple, int] = {}
+        self.cars: list = []
+        self.rows: dict = {}
+
+        # Per row (car): lane id, arc length from the lane start, length of the lane, id of the next lane (-1)
+        self.lanes = np.zeros(0, dtype=np.intp)
+        self.arc_lengths = np.zeros(0)
+        self.lane_lengths = np.zeros(0)
+        self.next_lanes = np.zeros(0, dtype=np.intp)
+
+        # Rows sorted by (lane, arc length), the leader row of every row (-1 without one) and the
+        # distance along the lanes to it
+        self.order = np.zeros(0, dtype=np.intp)
+        self.leaders = np.zeros(0, dtype=np.intp)
+        self.leader_distances = np.zeros(0)
+
+    def __len__(self):
+        return len(self.cars)
+
+    def _get_lane_id(self, key: tuple) -> int:
+        lane_id = self.lane_ids.get(key)
+        if lane_id is None:
+            lane_id = self.lane_ids[key] = len(self.lane_ids)
+        return lane_id
+
+    def update(self, cars: list):
+        # Places every car following a route on the road graph (see Car.set_route) on its current lane
+        self.cars = []
+        lanes = []
+        arc_lengths = []
+        lane_lengths = []
+        next_lanes = []
+
+        for car in cars:
+            road = car.path_road_index
+            if not car.active or road >= len(car.path_lanes) or not car.has_path():
+                continue
+
+            start = car.path_road_ends[road - 1] if road else 0
+            end = car.path_road_ends[road]
+            cursor = car.path_cursor
+            distances = car.path_distances
+
+            self.cars.append(car)
+            lanes.append(self._get_lane_id(car.path_lanes[road]))
+            arc_lengths.append(distances[cursor] - distances[start]
+                               - car.position.dist(car.path_xs[cursor], car.path_ys[cursor]))
+            lane_lengths.append(distances[end - 1] - distances[start])
+            next_lanes.append(self._get_lane_id(car.path_lanes[road + 1]) if road + 1 < len(car.path_lanes) else -1)
+
+        n = len(self.cars)
+        self.rows = {car: row for row, car in enumerate(self.cars)}
+        self.lanes = np.array(lanes, dtype=np.intp)
+        self.arc_lengths = np.array(arc_lengths, dtype=float)
+        self.lane_lengths = np.array(lane_lengths, dtype=float)
+        self.next_lanes = np.array(next_lanes, dtype=np.intp)
+
+        self.order = np.lexsort((self.arc_lengths, self.lanes))
+        self.leaders = np.full(n, -1, dtype=np.intp)
+        self.leader_distances = np.full(n, np.inf)
+        if not n:
+            return
+
+        # The next row in the sorted order leads if it is on the same lane
+        sorted_lanes = self.lanes[self.order]
+        same_lane = sorted_lanes[:-1] == sorted_lanes[1:]
+        followers = self.order[:-1][same_lane]
+        self.leaders[followers] = self.order[1:][same_lane]
+        self.leader_distances[followers] = self.arc_lengths[self.leaders[followers]] - self.arc_lengths[followers]
+
+        # The front car of each lane follows the rearmost car on the next lane of its route
+        rearmost = np.full(len(self.lane_ids), -1, dtype=np.intp)
+        rear_of_lane = np.ones(n, dtype=bool)
+        rear_of_lane[1:] = ~same_lane
+        rearmost[sorted_lanes[rear_of_lane]] = self.order[rear_of_lane]
+
+        front = self.order[np.append(~same_lane, True)]
+        front = front[self.next_lanes[front] != -1]
+        leaders = rearmost[self.next_lanes[front]]
+        front = front[leaders != -1]
+        leaders = leaders[leaders != -1]
+        self.leaders[front] = leaders
+        self.leader_distances[front] = (self.lane_lengths[front] - self.arc_lengths[front]) + self.arc_lengths[leaders]
+
+    def get_leader(self, car):
+        # The car ahead along the route as of the last update, None if the road ahead is free
+        row = self.rows.get(car)
+        if row is None or self.leaders[row] == -1:
+            return None
+        return self.cars[self.leaders[row]]
+
+    def get_lane(self, key: tuple) -> list:
+        # Cars on the lane, from its start to its end
+        lane_id = self.lane_ids.get(key)
+        if lane_id is None:
+            return []
+        return [self.cars[row] for row in self.order if self.lanes[row] == lane_id]
+
+
+class CarFollowing:
+    # Intelligent driver model over a LaneOccupancy: the acceleration of each car toward its max speed,
+    # reduced by how close its leader is for its speed and closing speed. The result is applied through
+    # the allowed speeds of the cars, so they slow down and queue behind each other instead of crashing.
+    # Only cars along the same route lanes see each other, crossing traffic is left to the collisions
+    # time_headway in seconds, min_gap between bumpers in pixels, deceleration (comfortable braking) in px/s^2
+    def __init__(self, time_headway: float, min_gap: float, deceleration: float):
+        self.occupancy = LaneOccupancy()
+        self.time_headway: float = time_headway
+        self.min_gap: float = min_gap
+        self.deceleration: float = deceleration
+
+    def update(self, cars: list, delta: float):
+        occupancy = self.occupancy
+        previous_cars = occupancy.cars
+        occupancy.update(cars)
+
+        # Cars that stopped following a route drive freely again
+        for car in previous_cars:
+            if car not in occupancy.rows:
+                car.set_allowed_speed(car.max_speed)
+
+        n = len(occupancy)
+        if not n:
+            return
+
+        cars = occupancy.cars
+        speeds = np.array([abs(car.linear_velocity) for car in cars], dtype=float)
+        max_speeds = np.array([car.max_speed for car in cars], dtype=float)
+        accelerations = np.array([car.linear_acceleration for car in cars], dtype=float)
+        half_lengths = np.array([0.5 * max(car.rect.x, car.rect.y) for car in cars], dtype=float)
+
+        free_road = 1 - (speeds / np.maximum(max_speeds, 1e-9)) ** 4
+
+        leaders = occupancy.leaders
+        following = leaders != -1
+        interaction = np.zeros(n)
+        if following.any():
+            leader_rows = leaders[following]
+            gaps = (occupancy.leader_distances[following] - half_lengths[following] - half_lengths[leader_rows])
+            gaps = np.maximum(gaps, 1e-3)
+
+            speed = speeds[following]
+            closing_speeds = speed - speeds[leader_rows]
+            desired_gaps = self.min_gap + np.maximum(
+                0, speed * self.time_headway
+                + speed * closing_speeds / (2 * np.sqrt(accelerations[following] * self.deceleration)))
+            interaction[following] = (desired_gaps / gaps) ** 2
+
+        acceleration = accelerations * (free_road - interaction)
+        allowed_speeds = np.clip(speeds + acceleration * delta, 0, max_speeds)
+
+        for car, allowed_speed in zip(cars, allowed_speeds.tolist()):
+            car.set_allowed_speed(allowed_speed)